@@ -47,6 +47,12 @@ def main(args):
 
     parser.add_argument("--accuracy", "-a", dest="accuracy", required=True,
                         help="Focus precision in meters")
+    parser.add_argument("--method", "-m", dest="method",
+                        choices=(autofocus.METHOD_HILL_CLIMB, autofocus.METHOD_GOLDEN),
+                        default=autofocus.METHOD_HILL_CLIMB,
+                        help="Search algorithm")
+    parser.add_argument("--binning", "-b", dest="binning", type=int, default=1,
+                        help="Binning applied on the images before measuring the focus")
 
     options = parser.parse_args(args[1:])
     accuracy = float(options.accuracy)
@@ -71,7 +77,9 @@ def main(args):
         logging.debug("Current focus level: %f", fm_cur)
 
         # Apply autofocus
-        future_focus = align.AutoFocus(ccd, None, focus, accuracy)
+        future_focus = align.AutoFocus(ccd, None, focus, accuracy,
+                                       method=options.method,
+                                       binning=options.binning)
         foc_pos, fm_final = future_focus.result()
         logging.debug("Focus level after applying autofocus: %f", fm_final)
 
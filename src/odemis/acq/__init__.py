@@ -34,10 +34,11 @@ import logging
 import math
 import numpy
 from odemis import model
-from odemis.acq import _futures
+from odemis.acq import _futures, timing
 from odemis.acq.stream import FluoStream, SEMCCDMDStream, \
-    OverlayStream, OpticalStream, EMStream
+    OverlayStream, OpticalStream, EMStream, Stream
 from odemis.util import img, fluo
+import Queue
 import sys
 import threading
 import time
@@ -50,7 +51,8 @@ import time
 # background. You are in charge of ensuring that no other acquisition is
 # going on at the same time.
 # The manager receives a list of streams to acquire, order them in the best way,
-# and then creates a separate thread to run the acquisition of each stream. It
+# and then creates a separate thread to run the acquisition of each stream.
+# Streams which don't share any hardware are acquired simultaneously. It
 # returns a special "ProgressiveFuture" which is a Future object that can be
 # stopped while already running, and reports from time to time progress on its
 # execution.
@@ -88,17 +90,18 @@ def acquire(streams):
 def estimateTime(streams):
     """
     Computes the approximate time it will take to run the acquisition for the
-     given streams (same arguments as acquire())
+     given streams (same arguments as acquire()). The estimation of each stream
+     is corrected based on the previous acquisitions on the microscope.
     streams (list of Stream): the streams to acquire
     return (0 <= float): estimated time in s.
     """
-    tot_time = 0
     # We don't use mergeStreams() as it creates new streams at every call, and
-    # anyway sum of each stream should give already a good estimation.
-    for s in streams:
-        tot_time += s.estimateAcquisitionTime()
-
-    return tot_time
+    # anyway the time of each stream should give already a good estimation.
+    streams = sorted(streams, key=_weight_stream, reverse=True)
+    deps = _get_dependencies(streams)
+    times = dict((s, timing.correctTime(s)) for s in streams)
+    ends = _estimate_ends(streams, deps, times)
+    return max(ends.values() + [0])
 
 def computeThumbnail(streamTree, acqTask):
     """
@@ -169,6 +172,84 @@ def _weight_stream(stream):
         logging.debug("Unexpected stream of type %s", stream.__class__.__name__)
         return 0
 
+def _get_hardware(stream, _seen=None):
+    """
+    Find all the hardware components used by a stream (ie, its detector,
+      emitter, actuators...)
+    stream (acq.stream.Stream): a stream
+    returns (set of str): the names of the components
+    """
+    # Looks at all the attributes of the stream, and of its sub-streams
+    if _seen is None:
+        _seen = set()
+    _seen.add(id(stream))
+
+    names = set()
+    for v in vars(stream).values():
+        if isinstance(v, (list, tuple)):
+            vals = v
+        else:
+            vals = (v,)
+        for o in vals:
+            if isinstance(o, model.ComponentBase):
+                names.add(o.name)
+            elif isinstance(o, Stream) and id(o) not in _seen:
+                names |= _get_hardware(o, _seen)
+    return names
+
+def _streams_conflict(s1, s2):
+    """
+    Checks whether two streams cannot be acquired simultaneously
+    s1 (acq.stream.Stream): a stream
+    s2 (acq.stream.Stream): another stream
+    returns (bool): True if they must be acquired one after another
+    """
+    hw1 = _get_hardware(s1)
+    hw2 = _get_hardware(s2)
+    if not hw1 or not hw2:
+        return True # Unknown hardware => be safe
+    if hw1 & hw2:
+        return True
+    # The fine overlay measure must be done after everything
+    if isinstance(s1, OverlayStream) or isinstance(s2, OverlayStream):
+        return True
+    # The e-beam would bleach the dyes and generate cathodoluminescence, and
+    # the light would disturb the electron detectors
+    ems = (EMStream, SEMCCDMDStream)
+    if ((isinstance(s1, OpticalStream) and isinstance(s2, ems)) or
+        (isinstance(s2, OpticalStream) and isinstance(s1, ems))):
+        return True
+    return False
+
+def _get_dependencies(streams):
+    """
+    Computes which streams must be acquired before each stream
+    streams (list of Streams): the streams, ordered by priority (highest first)
+    returns (dict Stream -> list of Streams): for each stream, the streams
+      with a higher priority which conflict with it
+    """
+    deps = {}
+    for i, s in enumerate(streams):
+        deps[s] = [p for p in streams[:i] if _streams_conflict(p, s)]
+    return deps
+
+def _estimate_ends(streams, deps, times):
+    """
+    Estimates when each stream acquisition will be finished, if each stream is
+      started as soon as all its dependencies are finished.
+    streams (list of Streams): the streams, ordered by priority (highest first)
+    deps (dict Stream -> list of Streams): the dependencies of each stream
+    times (dict Stream -> float): the time (from now) the acquisition of each
+      stream will take
+    returns (dict Stream -> float): the time (from now) the acquisition of each
+      stream will be finished
+    """
+    ends = {}
+    for s in streams:
+        start = max([ends[p] for p in deps[s]] + [0])
+        ends[s] = start + times[s]
+    return ends
+
 class AcquisitionTask(object):
 
     def __init__(self, streams, future):
@@ -176,15 +257,28 @@ class AcquisitionTask(object):
 
         # order the streams for optimal acquisition
         self._streams = sorted(streams, key=_weight_stream, reverse=True)
+        # Streams using the same hardware keep this order, the others are
+        # acquired simultaneously
+        self._deps = _get_dependencies(self._streams)
 
         # get the estimated time for each streams
-        self._streamTimes = {} # Stream -> float (estimated time)
+        self._timing = timing.get_model()
+        self._streamEstimates = {} # Stream -> float (time estimated by the stream)
+        self._streamTimes = {} # Stream -> float (estimated time, corrected)
         for s in streams:
-            self._streamTimes[s] = s.estimateAcquisitionTime()
-
-        self._streams_left = set(self._streams) # just for progress update
-        self._current_stream = None
-        self._current_future = None
+            est = s.estimateAcquisitionTime()
+            self._streamEstimates[s] = est
+            self._streamTimes[s] = self._timing.correct(s, est)
+
+        self._lock = threading.Lock() # protects the following attributes
+        self._streams_left = set(self._streams) # not yet started
+        self._running = {} # Future -> Stream, acquisitions on-going
+        self._start_times = {} # Stream -> float (time the acquisition started)
+        self._progress = {} # Stream -> (float, float): time of the last update, time left
+        # Futures finished. Note: futures.wait() cannot be used, as it is not
+        # notified when a running ProgressiveFuture is cancelled.
+        self._done_futures = Queue.Queue()
+        self._started = False
         self._cancelled = False
 
     def run(self):
@@ -197,60 +291,138 @@ class AcquisitionTask(object):
             Exception: if it failed before any result were acquired
         """
         exp = None
-        assert(self._current_stream is None) # Task should be used only once
-        expected_time = numpy.sum(self._streamTimes.values())
+        assert(not self._started) # Task should be used only once
+        self._started = True
         # no need to set the start time of the future: it's automatically done
         # when setting its state to running.
-        self._future.set_end_time(time.time() + expected_time)
+        self._update_end_time()
 
         raw_images = {} # stream -> list of raw images
         try:
-            for s in self._streams:
-                # Get the future of the acquisition, depending on the Stream type
-                if hasattr(s, "acquire"):
-                    f = s.acquire()
-                else: # fall-back to old style stream
-                    f = _futures.wrapSimpleStreamIntoFuture(s)
-                self._current_future = f
-                self._current_stream = s
-                self._streams_left.discard(s)
-
-                # in case acquisition was cancelled, before the future was set
-                if self._cancelled:
-                    f.cancel()
-                    raise CancelledError()
-
-                # If it's a ProgressiveFuture, listen to the time update
+            while self._running or (self._streams_left and exp is None):
+                # Start all the streams which don't wait for another one. If an
+                # error happened, just wait for the on-going acquisitions.
+                if exp is None:
+                    for s in self._streams:
+                        if (s in self._streams_left and
+                            all(p in raw_images for p in self._deps[s])):
+                            try:
+                                self._start_stream(s)
+                            except CancelledError:
+                                raise
+                            except Exception as e:
+                                logging.warning("Failed to start acquisition of stream %s: %s",
+                                                s.name.value, e)
+                                exp = e
+                                break
+
+                if not self._running:
+                    break # failed to start => nothing to wait for
+
+                # Wait for one acquisition to be finished
+                f = self._done_futures.get()
+                with self._lock:
+                    s = self._running.pop(f)
+                    start = self._start_times[s]
                 try:
-                    f.add_update_callback(self._on_progress_update)
-                except AttributeError:
-                    pass # not a ProgressiveFuture, fine
-
-                # Wait for the acquisition to be finished.
-                # Will pass down exceptions, included in case it's cancelled
-                raw_images[s] = f.result()
+                    # Will pass down exceptions, included in case it's cancelled
+                    raw_images[s] = f.result()
+                except CancelledError:
+                    raise
+                except Exception as e:
+                    # If no acquisition yet => the exception will be raised,
+                    # otherwise, the results we got might already be useful
+                    logging.warning("Acquisition of stream %s failed: %s",
+                                    s.name.value, e)
+                    if exp is None:
+                        exp = e
+                else:
+                    # Only successful acquisitions are representative
+                    self._timing.record(s, self._streamEstimates[s],
+                                        time.time() - start)
 
                 # update the time left
-                expected_time -= self._streamTimes[s]
-                self._future.set_end_time(time.time() + expected_time)
+                self._update_end_time()
+
+            if exp is not None and not raw_images:
+                raise exp
 
             # TODO: if the stream is OverlayStream, apply the metadata to all the
             # data from an optical stream. => put the data
             self._adjust_metadata(raw_images)
 
-        except CancelledError:
+        except Exception:
+            # Stop all the acquisitions still on-going
+            with self._lock:
+                self._cancelled = True
+                running = self._running.keys()
+            for f in running:
+                f.cancel()
             raise
-        except Exception as e:
-            # If no acquisition yet => just raise the exception,
-            # otherwise, the results we got might already be useful
-            if not raw_images:
-                raise
-            exp = e
+        finally:
+            try:
+                self._timing.save()
+            except Exception:
+                logging.exception("Failed to save the acquisition timing")
 
         # merge all the raw data (= list of DataArrays) into one long list
         ret = sum(raw_images.values(), [])
         return ret, exp
 
+    def _start_stream(self, s):
+        """
+        Start the acquisition of a stream
+        s (Stream): the stream to acquire
+        raise CancelledError: if the task has been cancelled
+        """
+        # Get the future of the acquisition, depending on the Stream type
+        if hasattr(s, "acquire"):
+            f = s.acquire()
+        else: # fall-back to old style stream
+            f = _futures.wrapSimpleStreamIntoFuture(s)
+
+        with self._lock:
+            self._streams_left.discard(s)
+            self._running[f] = s
+            self._start_times[s] = time.time()
+            cancelled = self._cancelled
+
+        # in case acquisition was cancelled, before the future was set
+        if cancelled:
+            f.cancel()
+            raise CancelledError()
+
+        # If it's a ProgressiveFuture, listen to the time update
+        try:
+            f.add_update_callback(self._on_progress_update)
+        except AttributeError:
+            pass # not a ProgressiveFuture, fine
+        f.add_done_callback(self._done_futures.put)
+
+    def _update_end_time(self):
+        """
+        Update the end time of the task, based on the progress of each stream
+        """
+        now = time.time()
+        with self._lock:
+            running = set(self._running.values())
+            times = {}
+            for s in self._streams:
+                if s in self._streams_left:
+                    times[s] = self._streamTimes[s]
+                elif s in running:
+                    if s in self._progress:
+                        t, left = self._progress[s]
+                        times[s] = max(0, t + left - now)
+                    else:
+                        end = self._start_times[s] + self._streamTimes[s]
+                        times[s] = max(0, end - now)
+                else: # finished
+                    times[s] = 0
+        ends = _estimate_ends(self._streams, self._deps, times)
+        time_left = max(ends.values() + [0])
+        self._future.set_end_time(now + time_left)
+
     def _adjust_metadata(self, raw_data):
         """
         Update/adjust the metadata of the raw data received based on global 
@@ -284,34 +456,35 @@ class AcquisitionTask(object):
         
     def _on_progress_update(self, f, past, left):
         """
-        Called when the current future has made a progress (and so it should
+        Called when a running future has made a progress (and so it should
         provide a better time estimation).
         """
-        if self._current_future != f:
-            logging.warning("Progress update from not the current future: %s", f)
-            return
+        with self._lock:
+            s = self._running.get(f)
+            if s is None:
+                logging.warning("Progress update from not a running future: %s", f)
+                return
+            self._progress[s] = (time.time(), left)
 
-        now = time.time()
-        time_left = left
-        for s in self._streams_left:
-            time_left += self._streamTimes[s]
-
-        self._future.set_end_time(now + time_left)
+        self._update_end_time()
 
     def cancel(self, future):
         """
         cancel the acquisition
         """
         # put the cancel flag
-        self._cancelled = True
+        with self._lock:
+            self._cancelled = True
+            running = self._running.keys()
+            streams_left = bool(self._streams_left)
 
-        if self._current_future is not None:
-            cancelled = self._current_future.cancel()
-        else:
-            cancelled = False
+        cancelled = False
+        for f in running:
+            if f.cancel():
+                cancelled = True
 
         # Report it's too late for cancellation (and so result will come)
-        if not cancelled and not self._streams_left:
+        if not cancelled and not streams_left:
             return False
 
         return True
@@ -28,6 +28,7 @@ from odemis.model._metadata import MD_PIXEL_SIZE
 from .autofocus import AutoFocus
 from .delphi import UpdateConversion
 from .find_overlay import FindOverlay
+from .focustrack import FocusTracker
 from .spot import AlignSpot, FindSpot
 from odemis.dataio import hdf5
 
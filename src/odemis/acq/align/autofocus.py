@@ -25,6 +25,7 @@ from __future__ import division
 from concurrent.futures._base import CancelledError, CANCELLED, FINISHED, \
     RUNNING
 import logging
+import math
 import numpy
 from odemis import model
 from odemis.acq._futures import executeTask
@@ -40,25 +41,50 @@ INIT_THRES_FACTOR = 4e-3  # initial autofocus threshold factor
 MAX_STEPS_NUMBER = 30  # Max steps to perform autofocus
 MAX_BS_NUMBER = 1  # Maximum number of applying binary search with a smaller max_step
 
+# Autofocus methods
+METHOD_HILL_CLIMB = "hill-climb"  # step by step, with decreasing steps
+METHOD_GOLDEN = "golden"  # bracketing + golden-section search + parabolic fit
+# Number of steps typically needed by the golden-section search
+GOLDEN_STEPS_NUMBER = 12
+GOLDEN_RATIO = (1 + math.sqrt(5)) / 2
+# Relative difference of focus level below which two measurements are
+# considered equal (ie, within the noise)
+GOLDEN_NOISE_FACTOR = 1e-4
 
-def MeasureFocus(image):
+
+def MeasureFocus(image, roi=None, binning=1):
     """
     Given an image, focus measure is calculated using the standard deviation of
     the raw data.
     image (model.DataArray): Optical image
+    roi (None or 4 floats): region of the image to measure (left, top, right,
+      bottom) in ratio of the image (0 -> 1). If None, the whole image is used.
+    binning (1<=int): the image is subsampled by averaging blocks of
+      binning x binning pixels before the measurement. It makes the measure
+      faster and less sensitive to noise.
     returns (float):    The focus level of the optical image
     """
     # Handle RGB image
     if len(image.shape) == 3:
-        # TODO find faster solution
-        r, g, b = image[:, :, 0], image[:, :, 1], image[:, :, 2]
-        gray = numpy.empty(image.shape[0:2], dtype="uint16")
-        gray[...] = r
-        gray += g
-        gray += b
+        gray = numpy.sum(image, axis=2)
     else:
         gray = image
-    return ndimage.standard_deviation(image)
+
+    if roi is not None:
+        h, w = gray.shape
+        l, t = int(round(roi[0] * w)), int(round(roi[1] * h))
+        r, b = int(round(roi[2] * w)), int(round(roi[3] * h))
+        gray = gray[t:max(b, t + 1), l:max(r, l + 1)]
+
+    if binning > 1:
+        h, w = gray.shape[0] // binning, gray.shape[1] // binning
+        if h == 0 or w == 0:
+            raise ValueError("Binning %d is too large for an image of %s px" %
+                             (binning, gray.shape))
+        gray = gray[:h * binning, :w * binning].reshape(h, binning, w, binning)
+        gray = gray.mean(axis=3).mean(axis=1)
+
+    return ndimage.standard_deviation(gray)
 
 def SubstractBackground(ccd, det_dataflow=None):
     """
@@ -87,7 +113,8 @@ def _discard_data(df, data):
     """
     pass
 
-def _DoAutoFocus(future, detector, max_step, thres_factor, et, focus, background, dataflow):
+def _DoAutoFocus(future, detector, max_step, thres_factor, et, focus, background,
+                 dataflow, roi=None, binning=1):
     """
     Iteratively acquires an optical image, measures its focus level and adjusts 
     the optical focus with respect to the focus level.
@@ -100,6 +127,8 @@ def _DoAutoFocus(future, detector, max_step, thres_factor, et, focus, background
     focus (model.Actuator): The optical focus
     background (boolean): If True apply background substraction
     dataflow (model.DataFlow): dataflow of se- or bs- detector
+    roi (None or 4 floats): region of the image used to measure the focus level
+    binning (1<=int): subsampling of the image used to measure the focus level
     returns (float):    Focus position #m
                         Focus level
     raises:    
@@ -118,13 +147,13 @@ def _DoAutoFocus(future, detector, max_step, thres_factor, et, focus, background
             step = max_step / 2
             cur_pos = focus.position.value.get('z')
             image = SubstractBackground(detector, dataflow)
-            fm_cur = MeasureFocus(image)
+            fm_cur = MeasureFocus(image, roi, binning)
             init_fm = fm_cur
             best_fm = init_fm
             #Clip within range
             new_pos = _ClippedMove(rng, focus, step)
             image = SubstractBackground(detector, dataflow)
-            fm_test = MeasureFocus(image)
+            fm_test = MeasureFocus(image, roi, binning)
             if fm_test > best_fm:
                 best_pos = new_pos
                 best_fm = fm_test
@@ -157,7 +186,7 @@ def _DoAutoFocus(future, detector, max_step, thres_factor, et, focus, background
                     shift = cur_pos - pos
                     new_pos = _ClippedMove(rng, focus, shift)
                     image = SubstractBackground(detector, dataflow)
-                    fm_new = MeasureFocus(image)
+                    fm_new = MeasureFocus(image, roi, binning)
                     if fm_new > best_fm:
                         best_pos = new_pos
                         best_fm = fm_new
@@ -166,13 +195,13 @@ def _DoAutoFocus(future, detector, max_step, thres_factor, et, focus, background
                     steps += 1
 
                 image = SubstractBackground(detector, dataflow)
-                fm_cur = MeasureFocus(image)
+                fm_cur = MeasureFocus(image, roi, binning)
                 if fm_cur > best_fm:
                     best_pos = new_pos
                     best_fm = fm_cur
                 new_pos = _ClippedMove(rng, focus, step)
                 image = SubstractBackground(detector, dataflow)
-                fm_test = MeasureFocus(image)
+                fm_test = MeasureFocus(image, roi, binning)
                 if fm_test > best_fm:
                     best_pos = new_pos
                     best_fm = fm_test
@@ -207,7 +236,7 @@ def _DoAutoFocus(future, detector, max_step, thres_factor, et, focus, background
                 if before_move == after_move:
                     sign = -sign
                 image = SubstractBackground(detector, dataflow)
-                fm_new = MeasureFocus(image)
+                fm_new = MeasureFocus(image, roi, binning)
                 if fm_new > best_fm:
                     best_pos = new_pos
                     best_fm = fm_new
@@ -237,6 +266,194 @@ def _DoAutoFocus(future, detector, max_step, thres_factor, et, focus, background
                 raise CancelledError()
             future._autofocus_state = FINISHED
 
+def _DoGoldenAutoFocus(future, detector, max_step, thres_factor, et, focus,
+                       accuracy, background, dataflow, roi, binning):
+    """
+    Finds the best focus by first bracketing the maximum of the focus level,
+    and then narrowing the bracket with a golden-section search. The final
+    position is refined by fitting a parabola on the last 3 measurements.
+    Focus levels which only differ by the noise are considered equal. When
+    two such levels are found, the middle is measured, and if it's not better,
+    the top of the focus curve is flat, so the search stops, and the centre of
+    the flat part is returned.
+    It needs much fewer acquisitions than the hill-climbing of _DoAutoFocus().
+    When the next positions are known in advance, the focus is moved while the
+    focus level of the previous image is computed.
+    future (model.ProgressiveFuture): Progressive future provided by the wrapper
+    detector: model.DigitalCamera or model.Detector
+    max_step: step used in case we are completely out of focus
+    thres_factor: threshold factor depending on type of detector and binning
+    et: exposure time if detector is a ccd,
+        dwellTime*prod(resolution) if detector is an SEM
+    focus (model.Actuator): The optical focus
+    accuracy (0<=float): Focus precision #m
+    background (boolean): If True apply background substraction
+    dataflow (model.DataFlow): dataflow of se- or bs- detector
+    roi (None or 4 floats): region of the image used to measure the focus level
+    binning (1<=int): subsampling of the image used to measure the focus level
+    returns (float):    Focus position #m
+                        Focus level
+    raises:
+            CancelledError if cancelled
+            IOError if procedure failed
+    """
+    logging.debug("Starting golden-section autofocus...")
+    rng = focus.axes["z"].range
+    init_pos = focus.position.value.get('z')
+    measures = {}  # position -> focus level
+
+    def clip(pos):
+        return min(max(rng[0], pos), rng[1])
+
+    def measure(positions):
+        """
+        Acquire an image and measure the focus level at each position. The
+        move to the next position is done while the focus level is computed.
+        returns (list of floats): the focus level at each position
+        """
+        fms = []
+        f = focus.moveAbs({"z": positions[0]})
+        for i, pos in enumerate(positions):
+            f.result()
+            if future._autofocus_state == CANCELLED:
+                raise CancelledError()
+            image = SubstractBackground(detector, dataflow)
+            if i + 1 < len(positions):
+                f = focus.moveAbs({"z": positions[i + 1]})
+            fm = MeasureFocus(image, roi, binning)
+            measures[pos] = fm
+            fms.append(fm)
+        logging.debug("Focus level at %s: %s", positions, fms)
+        return fms
+
+    try:
+        step = max_step / 2
+        a, b, c = clip(init_pos - step), init_pos, clip(init_pos + step)
+        fb, fa, fc = measure([b, a, c])
+        # Out of focus if nothing changes
+        flat_thres = thres_factor * fb
+        noise = GOLDEN_NOISE_FACTOR * fb
+        flat_top = False
+
+        # Bracket the maximum, in the form a < b < c, with f(b) >= f(a), f(c)
+        if max(fa, fc) - min(fa, fc, fb) < flat_thres:
+            # Completely out of focus => look further and further, on both sides
+            logging.info("Completely out of focus, looking further away")
+            dist = step
+            fbest = max(fa, fb, fc)
+            for i in range(MAX_STEPS_NUMBER // 2):
+                dist *= GOLDEN_RATIO
+                pl, ph = clip(init_pos - dist), clip(init_pos + dist)
+                fl, fh = measure([pl, ph])
+                if max(fl, fh) - fbest >= flat_thres:
+                    break  # found a better focus
+                fbest = max(fbest, fl, fh)
+                if fbest - max(fl, fh) >= flat_thres:
+                    break  # went past the focus on both sides
+                if pl == rng[0] and ph == rng[1]:
+                    break
+            # Restart the bracketing from the best position found
+            b = max(measures, key=measures.get)
+            a, c = clip(b - step), clip(b + step)
+            new_pos = [p for p in (a, c) if p not in measures]
+            if new_pos:
+                measure(new_pos)
+            fa, fb, fc = measures[a], measures[b], measures[c]
+
+        # Expand the bracket uphill, by the golden ratio
+        while fa > fb or fc > fb:
+            if fc > fa:
+                # maximum is towards c
+                nc = clip(c + GOLDEN_RATIO * (c - b))
+                if nc == c:  # border of the range
+                    a, b = b, c
+                    fa, fb = fb, fc
+                    break
+                a, b, c = b, c, nc
+                fa, fb = fb, fc
+                fc = measure([c])[0]
+            else:
+                # maximum is towards a
+                na = clip(a - GOLDEN_RATIO * (b - a))
+                if na == a:
+                    c, b = b, a
+                    fc, fb = fb, fa
+                    break
+                a, b, c = na, a, b
+                fb, fc = fa, fb
+                fa = measure([a])[0]
+            if len(measures) >= MAX_STEPS_NUMBER:
+                logging.warning("Failed to find the focus after %d steps", len(measures))
+                break
+
+        future.set_end_time(time.time() +
+                            estimateAutoFocusTime(et, GOLDEN_STEPS_NUMBER / 2))
+
+        # Golden-section search, until the bracket is as small as the accuracy
+        # requested (or too many images have been acquired)
+        while c - a > accuracy and len(measures) < MAX_STEPS_NUMBER:
+            # New point in the largest of the two intervals
+            if c - b > b - a:
+                x = b + (c - b) / (GOLDEN_RATIO + 1)
+            else:
+                x = b - (b - a) / (GOLDEN_RATIO + 1)
+            fx = measure([x])[0]
+            if abs(fx - fb) <= noise:
+                # Same level => the maximum is between x and b, unless it's
+                # just a shoulder of the focus curve. Check the middle.
+                lo, hi = min(x, b), max(x, b)
+                m = (lo + hi) / 2
+                fm = measure([m])[0]
+                if fm - max(fx, fb) <= noise:
+                    logging.debug("Focus level flat between %s and %s", lo, hi)
+                    flat_top = True
+                    break
+                a, b, c = lo, m, hi
+                fa, fb, fc = measures[lo], fm, measures[hi]
+            elif fx > fb:
+                if x > b:
+                    a, fa = b, fb
+                else:
+                    c, fc = b, fb
+                b, fb = x, fx
+            else:
+                if x > b:
+                    c, fc = x, fx
+                else:
+                    a, fa = x, fx
+
+        # Parabolic fit of the last 3 points
+        den = (b - a) * (fb - fc) - (b - c) * (fb - fa)
+        if den != 0 and not flat_top:
+            x = b - 0.5 * ((b - a) ** 2 * (fb - fc) - (b - c) ** 2 * (fb - fa)) / den
+            if a < x < c and abs(x - b) > accuracy / 4:
+                measure([x])
+
+        if future._autofocus_state == CANCELLED:
+            raise CancelledError()
+
+        # Go to the best measured focus position. If several positions have
+        # the same level, pick the one closest to the centre of them.
+        fbest = max(measures.values())
+        top = [p for p, fm in measures.items() if fbest - fm <= noise]
+        centre = (min(top) + max(top)) / 2
+        best_pos = min(top, key=lambda p: abs(p - centre))
+        focus.moveAbs({"z": best_pos}).result()
+        logging.debug("Autofocus found focus at %s after %d measurements",
+                      best_pos, len(measures))
+        return focus.position.value.get('z'), measures[best_pos]
+    except CancelledError:
+        if measures:
+            best_pos = max(measures, key=measures.get)
+        else:
+            best_pos = init_pos
+        focus.moveAbs({"z": best_pos}).result()
+    finally:
+        with future._autofocus_lock:
+            if future._autofocus_state == CANCELLED:
+                raise CancelledError()
+            future._autofocus_state = FINISHED
+
 def _ClippedMove(rng, focus, shift):
     """
     Clips the focus move requested within the range
@@ -276,7 +493,8 @@ def estimateAutoFocusTime(exposure_time, steps=MAX_STEPS_NUMBER):
     """
     return steps * exposure_time
 
-def AutoFocus(detector, scanner, focus, accuracy, background=False, dataflow=None):
+def AutoFocus(detector, scanner, focus, accuracy, background=False, dataflow=None,
+              method=METHOD_HILL_CLIMB, roi=None, binning=1):
     """
     Wrapper for DoAutoFocus. It provides the ability to check the progress of autofocus 
     procedure or even cancel it.
@@ -286,6 +504,12 @@ def AutoFocus(detector, scanner, focus, accuracy, background=False, dataflow=Non
     accuracy (float): Focus precision #m
     background (boolean): If True apply background substraction
     dataflow (model.DataFlow): dataflow of se- or bs- detector
+    method (METHOD_*): the search algorithm. METHOD_GOLDEN is faster, as it
+      needs fewer acquisitions.
+    roi (None or 4 floats): region of the image used to measure the focus
+      level (see MeasureFocus()).
+    binning (1<=int): subsampling of the image used to measure the focus
+      level (see MeasureFocus()).
     returns (model.ProgressiveFuture):    Progress of DoAutoFocus, whose result() will return:
             Focus position #m
             Focus level
@@ -315,19 +539,31 @@ def AutoFocus(detector, scanner, focus, accuracy, background=False, dataflow=Non
     else:
         raise IOError("The given detector does not support autofocus.")
 
+    if method == METHOD_HILL_CLIMB:
+        steps = MAX_STEPS_NUMBER
+        doAutoFocus = _DoAutoFocus
+        args = (detector, max_step, thres_factor, et, focus, background, dataflow,
+                roi, binning)
+    elif method == METHOD_GOLDEN:
+        steps = GOLDEN_STEPS_NUMBER
+        doAutoFocus = _DoGoldenAutoFocus
+        args = (detector, max_step, thres_factor, et, focus, accuracy,
+                background, dataflow, roi, binning)
+    else:
+        raise ValueError("Unknown autofocus method %s" % (method,))
+
     f = model.ProgressiveFuture(start=est_start,
-                                end=est_start + estimateAutoFocusTime(et))
+                                end=est_start + estimateAutoFocusTime(et, steps))
     f._autofocus_state = RUNNING
     f._autofocus_lock = threading.Lock()
 
     # Task to run
-    doAutoFocus = _DoAutoFocus
     f.task_canceller = _CancelAutoFocus
 
     # Run in separate thread
     autofocus_thread = threading.Thread(target=executeTask,
                   name="Autofocus",
-                  args=(f, doAutoFocus, f, detector, max_step, thres_factor, et, focus, background, dataflow))
+                  args=(f, doAutoFocus, f) + args)
 
     autofocus_thread.start()
     return f
@@ -22,17 +22,18 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 
 from __future__ import division
 
+import collections
 from itertools import compress
 import logging
 import math
 from numpy import fft
 from numpy import histogram
-from numpy import unravel_index
 import numpy
 from odemis import model
 import operator
 import scipy.signal
 from scipy.spatial import cKDTree
+import threading
 import warnings
 
 import scipy.ndimage as ndimage
@@ -45,6 +46,12 @@ MAX_STEPS_NUMBER = 100  # How many steps to perform in coordinates matching
 SHIFT_THRESHOLD = 0.04  # When to still perform the shift (percentage)
 DIFF_NUMBER = 0.95  # Number of values that should be within the allowed difference
 
+# Number of bandpass filter kernels kept in cache (one per image shape)
+KERNEL_CACHE_SIZE = 4
+# (shape, len_noise, len_object) -> numpy.array of complex
+_kernel_cache = collections.OrderedDict()
+_kernel_cache_lock = threading.Lock()
+
 def FindCenterCoordinates(subimages):
     """
     For each subimage generated by DivideInNeighborhoods, detects the center 
@@ -163,27 +170,26 @@ def DivideInNeighborhoods(data, number_of_spots, scale, sensitivity_limit=100):
     # filter window size
     filter_window_size = 8
 
+    # The filtering doesn't depend on the sensitivity, so it's done only once,
+    # and only the thresholding is done for each sensitivity.
+    max_diff = image.max() - image.min()
+    data_max = filters.maximum_filter(image, filter_window_size)
+    data_min = filters.minimum_filter(image, filter_window_size)
+    local_maxima = (image == data_max)
+    local_range = data_max - data_min
+
     # Increase sensitivity until expected number of spots is detected
     while sensitivity <= sensitivity_limit:
         subimage_coordinates = []
         subimages = []
-    
-        i_max, j_max = unravel_index(image.argmax(), image.shape)
-        i_min, j_min = unravel_index(image.argmin(), image.shape)
-        max_diff = image[i_max, j_max] - image[i_min, j_min]
-        data_max = filters.maximum_filter(image, filter_window_size)
-        data_min = filters.minimum_filter(image, filter_window_size)
-        
+
         # Determine threshold
-        i = sensitivity
-        threshold = max_diff / i
-    
+        threshold = max_diff / sensitivity
+
         # Filter the parts of the image with variance in intensity greater
         # than the threshold
-        maxima = (image == data_max)
-        diff = ((data_max - data_min) > threshold)
-        maxima[diff == 0] = 0
-    
+        maxima = local_maxima & (local_range > threshold)
+
         labeled, num_objects = ndimage.label(maxima)
     
         slices = ndimage.find_objects(labeled)
@@ -200,8 +206,8 @@ def DivideInNeighborhoods(data, number_of_spots, scale, sensitivity_limit=100):
             tab = tuple(map(operator.sub, (x_center_last, y_center_last),
                             (x_center, y_center)))
     
-            subimage = image[(dy.start - 2.5):(dy.stop + 2.5),
-                             (dx.start - 2.5):(dx.stop + 2.5)]
+            subimage = image[int(dy.start - 2.5):int(dy.stop + 2.5),
+                             int(dx.start - 2.5):int(dx.stop + 2.5)]
             
             if subimage.shape[0] == 0 or subimage.shape[1] == 0:
                 continue
@@ -342,50 +348,47 @@ def MatchCoordinates(input_coordinates, electron_coordinates, guess_scale, max_a
                         len(input_coordinates))
         return [], []
 
+    # All the computations are done on arrays, and the nearest neighbour
+    # searches on k-d trees. The tree of the electron coordinates never changes.
+    optical_array = numpy.array(optical_coordinates, dtype=numpy.float)
+    electron_array = numpy.array(electron_coordinates, dtype=numpy.float)
+    electron_tree = cKDTree(electron_array)
+
     quality = 0
-    guess_x_move, guess_y_move = 0, 0
-    guess_rotation = 0
+    max_diff = float("inf")
+    sort_diff = []
 
     # Informed guess
-    guess_coordinates = _TransformCoordinates(optical_coordinates, (guess_x_move, 
-                                                                    guess_y_move), 
-                                              guess_rotation, (guess_scale, guess_scale))
+    guess_coordinates = _TransformArray(optical_array, (0, 0), 0,
+                                        (guess_scale, guess_scale))
 
     # Overlay center
     guess_sub_electron_mean = (numpy.mean(guess_coordinates, 0) -
-                               numpy.mean(electron_coordinates, 0))
-    transformed_coordinates = [[g - m for g, m in zip(guess, guess_sub_electron_mean)]
-                                for guess in guess_coordinates]
+                               numpy.mean(electron_array, 0))
+    transformed_coordinates = guess_coordinates - guess_sub_electron_mean
 
     max_wrong_points = math.ceil(0.5 * math.sqrt(len(electron_coordinates)))
     for step in xrange(MAX_STEPS_NUMBER):
         #Calculate nearest point
-        estimated_coordinates, index1, e_wrong_points, total_shift = _MatchAndCalculate(transformed_coordinates, 
-                                                                                        optical_coordinates, 
-                                                                                        electron_coordinates)
+        estimated_coordinates, index1, e_wrong_points, total_shift = _MatchAndCalculate(transformed_coordinates,
+                                                                                        optical_array,
+                                                                                        electron_array,
+                                                                                        electron_tree)
 
-        if estimated_coordinates == []:
+        if estimated_coordinates is None:
             quality = 0
             break
 
-        # Calculate quality
-        inv_e_wrong_points = [not i for i in e_wrong_points]
-        electron_e_inv_points = [estimated_coordinates[i] for i in list(compress(index1, 
-                                                                                 inv_e_wrong_points))]
-        electron_e_points = list(compress(electron_coordinates, inv_e_wrong_points))
-
         # Calculate distance between the expected and found electron coordinates
-        coord_diff = []
-        for ta, tb in zip(electron_e_inv_points, electron_e_points):
-            tab = [a - b for a, b in  zip(ta, tb)]
-            coord_diff.append(math.hypot(tab[0], tab[1]))
-
-        sort_diff = sorted(coord_diff)
+        e_right_points = ~e_wrong_points
+        coord_diff = (estimated_coordinates[index1[e_right_points]] -
+                      electron_array[e_right_points])
+        sort_diff = numpy.sort(numpy.hypot(coord_diff[:, 0], coord_diff[:, 1]))
         diff_number_sort = math.trunc(DIFF_NUMBER * len(sort_diff)) - 1
         max_diff = sort_diff[diff_number_sort]
 
         if (max_diff < max_allowed_diff
-            and sum(e_wrong_points) <= max_wrong_points
+            and e_wrong_points.sum() <= max_wrong_points
             and total_shift <= max_allowed_diff):
             quality = 1
             break
@@ -399,14 +402,13 @@ def MatchCoordinates(input_coordinates, electron_coordinates, guess_scale, max_a
         logging.warning("SEM coordinates distances: %s", sort_diff)
         return [], []
 
-    # The ordered list gives for each electron coordinate the corresponding optical coordinates
-    ordered_coordinates_index = zip(index1, electron_coordinates)
-    ordered_coordinates_index.sort()
-    ordered_coordinates = []
-    for i in xrange(len(ordered_coordinates_index)):
-        ordered_coordinates.append(ordered_coordinates_index[i][1])
+    # The ordered list gives for each electron coordinate the corresponding
+    # optical coordinates (sorted by index, and then by coordinates)
+    order = numpy.lexsort((electron_array[:, 1], electron_array[:, 0], index1))
+    ordered_coordinates = [electron_coordinates[i] for i in order]
 
     # Remove unknown coordinates
+    inv_e_wrong_points = e_right_points.tolist()
     known_ordered_coordinates = list(compress(ordered_coordinates, inv_e_wrong_points))
     if len(optical_coordinates) == len(known_ordered_coordinates):
         known_optical_coordinates = optical_coordinates
@@ -417,17 +419,19 @@ def MatchCoordinates(input_coordinates, electron_coordinates, guess_scale, max_a
 def _KNNsearch(x_coordinates, y_coordinates):
     """
     Applies K-nearest neighbors search to the lists x_coordinates and y_coordinates.
-    x_coordinates (List of tuples): List of coordinates
-    y_coordinates (List of tuples): List of coordinates
-    returns (List of integers): Contains the index of nearest neighbor in x_coordinates 
+    x_coordinates (List of tuples, numpy.array of shape Nx2, or cKDTree): List
+      of coordinates, or the k-d tree already built from them
+    y_coordinates (List of tuples or numpy.array of shape Nx2): List of coordinates
+    returns (numpy.array of integers): Contains the index of nearest neighbor in x_coordinates 
                                 for the corresponding element in y_coordinates
     """
-    points = numpy.array(x_coordinates)
-    tree = cKDTree(points)
+    if isinstance(x_coordinates, cKDTree):
+        tree = x_coordinates
+    else:
+        tree = cKDTree(numpy.asarray(x_coordinates))
     distance, index = tree.query(y_coordinates)
-    list_index = numpy.array(index).tolist()
 
-    return list_index
+    return index
 
 def _TransformCoordinates(x_coordinates, translation, rotation, scale):
     """
@@ -438,74 +442,78 @@ def _TransformCoordinates(x_coordinates, translation, rotation, scale):
     scale (Tuple of floats): Scaling
     returns (List of tuples): Transformed coordinates
     """
-    transformed_coordinates = []
-    for ta in x_coordinates:
-        # translation-scaling-rotation
-        translated = [a + t for a, t in zip(ta, translation)]
-        scaled = [t * s for t, s in zip(translated, scale)]
-        x, y = scaled
-        x_rotated = x * math.cos(-rotation) - y * math.sin(-rotation)
-        y_rotated = x * math.sin(-rotation) + y * math.cos(-rotation)
-        rotated = (x_rotated, y_rotated)
-        transformed_coordinates.append(rotated)
-
-    return transformed_coordinates
-
-def _MatchAndCalculate(transformed_coordinates, optical_coordinates, electron_coordinates):
+    if len(x_coordinates) == 0:
+        return []
+    transformed = _TransformArray(numpy.asarray(x_coordinates, dtype=numpy.float),
+                                  translation, rotation, scale)
+    return [tuple(c) for c in transformed.tolist()]
+
+def _TransformArray(x_array, translation, rotation, scale):
+    """
+    Same as _TransformCoordinates(), but on all the coordinates at once.
+    x_array (numpy.array of shape Nx2): coordinates
+    returns (numpy.array of shape Nx2): Transformed coordinates
+    """
+    # translation-scaling-rotation
+    scaled = (x_array + translation) * scale
+    cos, sin = math.cos(-rotation), math.sin(-rotation)
+    rot = numpy.array([[cos, sin], [-sin, cos]])
+    return numpy.dot(scaled, rot)
+
+def _MatchAndCalculate(transformed_coordinates, optical_coordinates, electron_coordinates,
+                       electron_tree=None):
     """
     Applies transformation to the optical coordinates in order to match electron coordinates and returns 
     the transformed coordinates. This function must be used recursively until the transformed coordinates
     reach the required accuracy.
-    transformed_coordinates (List of tuples): List of transformed coordinates
-    optical_coordinates (List of tuples): List of optical coordinates
-    electron_coordinates (List of tuples): List of electron coordinates
-    returns estimated_coordinates (List of tuples): Estimated optical coordinates
-            index1 (List of integers): Indexes of nearest points in optical with respect to electron
-            e_wrong_points (List of booleans): Electron coordinates that have no proper match
+    transformed_coordinates (numpy.array of shape Nx2): transformed coordinates
+    optical_coordinates (numpy.array of shape Nx2): optical coordinates
+    electron_coordinates (numpy.array of shape Mx2): electron coordinates
+    electron_tree (None or cKDTree): k-d tree of the electron coordinates, to
+      avoid building it at every call
+    returns estimated_coordinates (numpy.array of shape Nx2): Estimated optical coordinates
+            index1 (numpy.array of integers): Indexes of nearest points in optical with respect to electron
+            e_wrong_points (numpy.array of booleans): Electron coordinates that have no proper match
             total_shift (float): Calculated total shift
+      If the matching is not possible, all the values are None.
     """
     total_shift = 0
+    if electron_tree is None:
+        electron_tree = cKDTree(electron_coordinates)
 
     index1 = _KNNsearch(transformed_coordinates, electron_coordinates)
     # Sort optical coordinates based on the _KNNsearch output index
-    knn_points1 = [optical_coordinates[i] for i in index1]
+    knn_points1 = optical_coordinates[index1]
 
-    index2 = _KNNsearch(electron_coordinates, transformed_coordinates)
+    index2 = _KNNsearch(electron_tree, transformed_coordinates)
     # Sort electron coordinates based on the _KNNsearch output index
-    knn_points2 = [electron_coordinates[i] for i in index2]
+    knn_points2 = electron_coordinates[index2]
 
     # Sort index1 based on index2 and the opposite
-    o_index = [index1[i] for i in index2]
-    e_index = [index2[i] for i in index1]
-
-    transformed_range = range(len(transformed_coordinates))
-    electron_range = range(len(electron_coordinates))
+    o_index = index1[index2]
+    e_index = index2[index1]
 
     # Coordinates that have no proper match (optical and electron)
-    o_wrong_points = map(operator.ne, o_index, transformed_range)
-    e_wrong_points = map(operator.ne, e_index, electron_range)
+    o_wrong_points = (o_index != numpy.arange(len(transformed_coordinates)))
+    e_wrong_points = (e_index != numpy.arange(len(electron_coordinates)))
 
-    if (all(o_wrong_points) or all(e_wrong_points)):
+    if o_wrong_points.all() or e_wrong_points.all():
         logging.warning("Cannot perform matching.")
-        return [], [], [], []
+        return None, None, None, None
 
     # Calculate the transform parameters for the correct electron_coordinates
-    #TODO: Throw exception if inv_e_wrong_points or inv_o_wrong_points has only False elements!!!
-    inv_e_wrong_points = [not i for i in e_wrong_points]
-    (x_move1, y_move1), (x_scale1, y_scale1), rotation1 = transform.CalculateTransform(list(compress(electron_coordinates,
-                                                                                                     inv_e_wrong_points))
-                                 , list(compress(knn_points1, inv_e_wrong_points)))
-    x_move1, y_move1 = x_move1, y_move1
+    inv_e_wrong_points = ~e_wrong_points
+    (x_move1, y_move1), (x_scale1, y_scale1), rotation1 = transform.CalculateTransform(
+                                 electron_coordinates[inv_e_wrong_points],
+                                 knn_points1[inv_e_wrong_points])
 
     # Calculate the transform parameters for the correct optical_coordinates
-    inv_o_wrong_points = [not i for i in o_wrong_points]
-    (x_move2, y_move2), (x_scale2, y_scale2), rotation2 = transform.CalculateTransform(list(compress(knn_points2,
-                                                                                                     inv_o_wrong_points))
-                                 , list(compress(optical_coordinates, inv_o_wrong_points)))
-    x_move2, y_move2 = x_move2, y_move2
+    inv_o_wrong_points = ~o_wrong_points
+    (x_move2, y_move2), (x_scale2, y_scale2), rotation2 = transform.CalculateTransform(
+                                 knn_points2[inv_o_wrong_points],
+                                 optical_coordinates[inv_o_wrong_points])
 
     # Average between the two parameters
-    #TODO: use numpy.mean()
     avg_x_move = (x_move1 + x_move2) / 2
     avg_y_move = (y_move1 + y_move2) / 2
     avg_x_scale = (x_scale1 + x_scale2) / 2
@@ -516,72 +524,54 @@ def _MatchAndCalculate(transformed_coordinates, optical_coordinates, electron_co
     # threshold = 2 * SHIFT_THRESHOLD * electron_coordinates.__len__()
     threshold = math.ceil(0.5 * math.sqrt(len(electron_coordinates)))
     # If the number of wrong points is above threshold perform corrections
-    if sum(o_wrong_points)>threshold and sum(e_wrong_points)>threshold:
+    if o_wrong_points.sum() > threshold and e_wrong_points.sum() > threshold:
         # Shift
-        electron_o_index2 = [electron_coordinates[i] for i in list(compress(index2, o_wrong_points))]
-        transformed_o_points = list(compress(transformed_coordinates, o_wrong_points))
-        o_wrong_diff = []
-        for ta, tb in zip(electron_o_index2, transformed_o_points):
-            o_wrong_diff.append(map(operator.sub, ta, tb))
-
-        transformed_e_index1 = [transformed_coordinates[i] for i in list(compress(index1, e_wrong_points))]
-        electron_e_points = list(compress(electron_coordinates, e_wrong_points))
-        e_wrong_diff = []
-        for ta, tb in zip(transformed_e_index1, electron_e_points):
-            e_wrong_diff.append(map(operator.sub, ta, tb))
-
-        mean_wrong_diff = numpy.mean(e_wrong_diff,0) - numpy.mean(o_wrong_diff,0)
+        o_wrong_diff = (electron_coordinates[index2[o_wrong_points]] -
+                        transformed_coordinates[o_wrong_points])
+        e_wrong_diff = (transformed_coordinates[index1[e_wrong_points]] -
+                        electron_coordinates[e_wrong_points])
+
+        mean_wrong_diff = numpy.mean(e_wrong_diff, 0) - numpy.mean(o_wrong_diff, 0)
         avg_x_move = avg_x_move - (0.65 * mean_wrong_diff[0]) / avg_x_scale
         avg_y_move = avg_y_move - (0.65 * mean_wrong_diff[1]) / avg_y_scale
         total_shift = math.hypot((0.65 * mean_wrong_diff[0]) / avg_x_scale, (0.65 * mean_wrong_diff[1]) / avg_x_scale)
 
         # Angle
         # Calculate angle with respect to its center, therefore move points towards center
-        electron_coordinates_vs_center = []
         mean_electron_coordinates = numpy.mean(electron_coordinates, 0)
-        for ta in electron_coordinates:
-            # translation
-            translated = tuple(map(operator.sub, ta, mean_electron_coordinates))
-            electron_coordinates_vs_center.append(translated)
-
-        transformed_coordinates_vs_center = []
-        for tb in transformed_coordinates:
-            # translation
-            translated = tuple(map(operator.sub, tb, mean_electron_coordinates))
-            transformed_coordinates_vs_center.append(translated)
+        electron_coordinates_vs_center = electron_coordinates - mean_electron_coordinates
+        transformed_coordinates_vs_center = transformed_coordinates - mean_electron_coordinates
 
         # Calculate the angle with its center for every point
-        angle_vect_electron = numpy.arctan2([float(i[0]) for i in electron_coordinates_vs_center], [float(i[1]) for i in electron_coordinates_vs_center])
-        angle_vect_transformed = numpy.arctan2([float(i[0]) for i in transformed_coordinates_vs_center], [float(i[1]) for i in transformed_coordinates_vs_center])
+        angle_vect_electron = numpy.arctan2(electron_coordinates_vs_center[:, 0],
+                                            electron_coordinates_vs_center[:, 1])
+        angle_vect_transformed = numpy.arctan2(transformed_coordinates_vs_center[:, 0],
+                                               transformed_coordinates_vs_center[:, 1])
 
         # Calculate the angle difference for the wrong electron_coordinates
-        angle_vect_transformed_e_index1 = [angle_vect_transformed[i] for i in list(compress(index1, e_wrong_points))]
-        angle_diff_electron_wrong = [x - y for x, y in zip(list(compress(angle_vect_electron, e_wrong_points)), angle_vect_transformed_e_index1)]
-        angle_diff_electron_wrong[angle_diff_electron_wrong > math.pi] = angle_diff_electron_wrong[angle_diff_electron_wrong > math.pi] - 2 * math.pi
-        angle_diff_electron_wrong[angle_diff_electron_wrong < -math.pi] = angle_diff_electron_wrong[angle_diff_electron_wrong < -math.pi] + 2 * math.pi
+        angle_diff_electron_wrong = (angle_vect_electron[e_wrong_points] -
+                                     angle_vect_transformed[index1[e_wrong_points]])
 
         # Calculate the angle difference for the wrong transformed_coordinates
-        angle_vect_electron_o_index2 = [angle_vect_electron[i] for i in list(compress(index2, o_wrong_points))]
-        angle_diff_transformed_wrong = [x - y for x, y in zip(list(compress(angle_vect_transformed, o_wrong_points)), angle_vect_electron_o_index2)]
-        angle_diff_transformed_wrong[angle_diff_transformed_wrong > math.pi] = angle_diff_transformed_wrong[angle_diff_transformed_wrong > math.pi] - 2 * math.pi
-        angle_diff_transformed_wrong[angle_diff_transformed_wrong < -math.pi] = angle_diff_transformed_wrong[angle_diff_transformed_wrong < -math.pi] + 2 * math.pi
+        angle_diff_transformed_wrong = (angle_vect_transformed[o_wrong_points] -
+                                        angle_vect_electron[index2[o_wrong_points]])
 
         # Apply correction
         angle_correction = 0.5 * (numpy.mean(angle_diff_electron_wrong, 0) - numpy.mean(angle_diff_transformed_wrong, 0))
         avg_rotation = avg_rotation + angle_correction
 
     # Perform transformation
-    estimated_coordinates = _TransformCoordinates(optical_coordinates,
-                                                  (avg_x_move, avg_y_move),
-                                                  avg_rotation,
-                                                  (avg_x_scale, avg_y_scale))
+    estimated_coordinates = _TransformArray(optical_coordinates,
+                                            (avg_x_move, avg_y_move),
+                                            avg_rotation,
+                                            (avg_x_scale, avg_y_scale))
     new_index1 = _KNNsearch(estimated_coordinates, electron_coordinates)
-    new_index2 = _KNNsearch(electron_coordinates, estimated_coordinates)
-    new_e_index = [new_index2[i] for i in new_index1]
-    new_e_wrong_points = map(operator.ne, new_e_index, electron_range)
-    if (all(new_e_wrong_points) or new_index1.count(new_index1[0]) == len(new_index1)):
+    new_index2 = _KNNsearch(electron_tree, estimated_coordinates)
+    new_e_index = new_index2[new_index1]
+    new_e_wrong_points = (new_e_index != numpy.arange(len(electron_coordinates)))
+    if new_e_wrong_points.all() or (new_index1 == new_index1[0]).all():
         logging.warning("Cannot perform matching..")
-        return [], [], [], []
+        return None, None, None, None
 
     return estimated_coordinates, new_index1, new_e_wrong_points, total_shift
 
@@ -631,8 +621,44 @@ def _BandPassFilter(image, len_noise, len_object):
     bandpass filter implementation. 
     Source: http://physics-server.uoregon.edu/~raghu/particle_tracking.html
     """
+    w = int(round(len_object))
+    kernel = _GetBandPassKernel(image.shape, len_noise, len_object)
+
+    res = fft.irfft2(fft.rfft2(image) * kernel, image.shape)
+    arr_out = numpy.zeros((image.shape))
+    arr_out[w:-w, w:-w] = res[2 * w:, 2 * w:]
+    res = numpy.maximum(arr_out, 0)
+    return res
+
+
+def _GetBandPassKernel(shape, len_noise, len_object):
+    """
+    Returns the (half) spectrum of the bandpass filter kernel, from the cache
+    if it was already computed for the same shape.
+    shape (int, int): shape of the image to filter
+    returns (numpy.array of complex): the kernel, as returned by rfft2
+    """
+    key = (shape, len_noise, len_object)
+    with _kernel_cache_lock:
+        try:
+            kernel = _kernel_cache.pop(key)
+        except KeyError:
+            kernel = _ComputeBandPassKernel(shape, len_noise, len_object)
+            kernel.flags.writeable = False  # shared between all the callers
+            if len(_kernel_cache) >= KERNEL_CACHE_SIZE:
+                _kernel_cache.popitem(last=False)
+        _kernel_cache[key] = kernel  # most recently used
+
+    return kernel
+
+
+def _ComputeBandPassKernel(shape, len_noise, len_object):
+    """
+    Computes the spectrum of the bandpass filter kernel.
+    See _GetBandPassKernel() for the parameters.
+    """
     b = len_noise
-    w = round(len_object)
+    w = int(round(len_object))
     N = 2 * w + 1
 
     # Gaussian Convolution Kernel
@@ -649,10 +675,4 @@ def _BandPassFilter(image, len_noise, len_object):
     # Convolution with the matrix and kernels
     gxy = gx * gy
     bxy = bx * by
-    kernel = fft.rfft2(gxy - bxy, image.shape)
-
-    res = fft.irfft2(fft.rfft2(image) * kernel)
-    arr_out = numpy.zeros((image.shape))
-    arr_out[w:-w, w:-w] = res[2 * w:, 2 * w:]
-    res = numpy.maximum(arr_out, 0)
-    return res
+    return fft.rfft2(gxy - bxy, shape)
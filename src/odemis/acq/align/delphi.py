@@ -22,6 +22,7 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 
 from __future__ import division
 
+import collections
 from concurrent.futures._base import CancelledError, CANCELLED, FINISHED, \
     RUNNING
 import cv2
@@ -32,7 +33,7 @@ from odemis import model
 from odemis.acq._futures import executeTask
 from odemis.acq.align import transform
 from odemis.acq.align import spot
-from odemis.acq.drift import CalculateDrift
+from odemis.acq.drift import CalculateDrift, DriftCalculator
 import threading
 import time
 from . import autofocus
@@ -84,8 +85,9 @@ def UpdateConversion(ccd, detector, escan, sem_stage, opt_stage, ebeam_focus,
     known_resolution_intercept (tuple of floats): intercept of linear fit (resolution shift)
     known_hfw_slope (tuple of floats): slope of linear fit (hfw shift) 
     known_spot_shift (tuple of floats): spot shift percentage 
-    returns (model.ProgressiveFuture):    Progress of DoAlignSpot,
-                                         whose result() will return:
+    returns (model.ProgressiveFuture):    Progress of DoAlignSpot. Its
+      .step_durations attribute (OrderedDict str -> float) contains the time
+      spent in each step (s), once the step is finished. Its result() will return:
             returns first_hole (tuple of floats): Coordinates of first hole
                     second_hole (tuple of floats): Coordinates of second hole
                     hole_focus (float): Focus used for hole detection
@@ -115,6 +117,8 @@ def UpdateConversion(ccd, detector, escan, sem_stage, opt_stage, ebeam_focus,
     f._hfw_shiftf = model.InstantaneousFuture()
     f._resolution_shiftf = model.InstantaneousFuture()
     f._spot_shiftf = model.InstantaneousFuture()
+    # Duration (s) of each step of the calibration, in order of execution
+    f.step_durations = collections.OrderedDict()
 
     # Run in separate thread
     conversion_thread = threading.Thread(target=executeTask,
@@ -187,9 +191,11 @@ def _DoUpdateConversion(future, ccd, detector, escan, sem_stage, opt_stage, ebea
         # Detect the holes/markers of the sample holder
         try:
             logging.debug("Detect the holes/markers of the sample holder...")
+            tstart = time.time()
             future._hole_detectionf = HoleDetection(detector, escan, sem_stage,
                                                     ebeam_focus, known_focus)
             first_hole, second_hole, hole_focus = future._hole_detectionf.result()
+            _recordStepDuration(future, "hole detection", tstart)
             logging.debug("First hole: %s (m,m) Second hole: %s (m,m)", first_hole, second_hole)
         except Exception:
             raise IOError("Conversion update failed to find sample holder holes.")
@@ -201,6 +207,10 @@ def _DoUpdateConversion(future, ccd, detector, escan, sem_stage, opt_stage, ebea
             # Update progress of the future
             future.set_end_time(time.time() +
                 estimateConversionTime(first_insertion) * (3 / 4))
+            tstart = time.time()
+            # The two stages are independent, so move them simultaneously
+            logging.debug("Move objective stage to (0,0)...")
+            fopt = opt_stage.moveAbs({"x":0, "y":0})
             logging.debug("Move SEM stage to expected offset...")
             f = sem_stage.moveAbs({"x":sem_position[0], "y":sem_position[1]})
             f.result()
@@ -218,18 +228,19 @@ def _DoUpdateConversion(future, ccd, detector, escan, sem_stage, opt_stage, ebea
                 vector = [a - b for a, b in zip(reached_pos, sem_position)]
                 dist = math.hypot(*vector)
                 logging.debug("New distance from required position: %f", dist)
-            logging.debug("Move objective stage to (0,0)...")
-            f = opt_stage.moveAbs({"x":0, "y":0})
-            f.result()
+            fopt.result()
             # Set min fov
             # We want to be as close as possible to the center when we are zoomed in
             escan.horizontalFoV.value = escan.horizontalFoV.range[0]
+            _recordStepDuration(future, "stages positioning", tstart)
 
             logging.debug("Initial calibration to align and calculate the offset...")
             try:
+                tstart = time.time()
                 future._align_offsetf = AlignAndOffset(ccd, detector, escan, sem_stage,
                                                        opt_stage, focus)
                 offset = future._align_offsetf.result()
+                _recordStepDuration(future, "align and offset", tstart)
             except Exception:
                 raise IOError("Conversion update failed to align and calculate offset.")
 
@@ -240,9 +251,11 @@ def _DoUpdateConversion(future, ccd, detector, escan, sem_stage, opt_stage, ebea
                 estimateConversionTime(first_insertion) * (2 / 4))
             logging.debug("Calculate rotation and scaling...")
             try:
+                tstart = time.time()
                 future._rotation_scalingf = RotationAndScaling(ccd, detector, escan, sem_stage,
                                                                opt_stage, focus, offset)
                 rotation, scaling = future._rotation_scalingf.result()
+                _recordStepDuration(future, "rotation and scaling", tstart)
             except Exception:
                 raise IOError("Conversion update failed to calculate rotation and scaling.")
 
@@ -252,16 +265,22 @@ def _DoUpdateConversion(future, ccd, detector, escan, sem_stage, opt_stage, ebea
             logging.debug("Calculate shift parameters...")
             try:
                 # Compute spot shift percentage
+                tstart = time.time()
                 future._spot_shiftf = SpotShiftFactor(ccd, detector, escan, focus)
                 spotshift = future._spot_shiftf.result()
+                _recordStepDuration(future, "spot shift", tstart)
 
                 # Compute resolution-related values
+                tstart = time.time()
                 future._resolution_shiftf = ResolutionShiftFactor(detector, escan, sem_stage, ebeam_focus, hole_focus)
                 resa, resb = future._resolution_shiftf.result()
+                _recordStepDuration(future, "resolution shift", tstart)
 
                 # Compute HFW-related values
+                tstart = time.time()
                 future._hfw_shiftf = HFWShiftFactor(detector, escan, sem_stage, ebeam_focus, hole_focus)
                 hfwa = future._hfw_shiftf.result()
+                _recordStepDuration(future, "HFW shift", tstart)
             except Exception:
                 raise IOError("Conversion update failed to calculate shift parameters.")
 
@@ -272,6 +291,7 @@ def _DoUpdateConversion(future, ccd, detector, escan, sem_stage, opt_stage, ebea
             offset = ((offset[0] / scaling[0]), (offset[1] / scaling[1]))
             # TODO also calculate and return Phenom shift parameters
             # Data returned needs to be filled in the calibration file
+            _logStepDurations(future)
             return first_hole, second_hole, hole_focus, offset, rotation, scaling, resa, resb, hfwa, spotshift
 
         else:
@@ -295,6 +315,7 @@ def _DoUpdateConversion(future, ccd, detector, escan, sem_stage, opt_stage, ebea
             combined_stage.updateMetadata({model.MD_PIXEL_SIZE_COR: known_scaling})
             # TODO also return Phenom shift parameters
             # Data returned should NOT be filled in the calibration file
+            _logStepDurations(future)
             return first_hole, second_hole, hole_focus, updated_offset, updated_rotation,
             known_scaling, known_resolution_slope, known_resolution_intercept, known_hfw_slope, known_spot_shift
 
@@ -305,6 +326,25 @@ def _DoUpdateConversion(future, ccd, detector, escan, sem_stage, opt_stage, ebea
                 raise CancelledError()
             future._conversion_update_state = FINISHED
 
+def _recordStepDuration(future, name, tstart):
+    """
+    Store the duration of a step of the calibration in the future
+    future (model.ProgressiveFuture): the future of the calibration
+    name (str): name of the step
+    tstart (float): time at which the step started
+    """
+    dur = time.time() - tstart
+    future.step_durations[name] = dur
+    logging.debug("Calibration step %s took %g s", name, dur)
+
+def _logStepDurations(future):
+    """
+    Log the time spent in each step of the calibration
+    """
+    total = sum(future.step_durations.values())
+    steps = ", ".join("%s: %.1f s" % (n, d) for n, d in future.step_durations.items())
+    logging.info("Calibration steps took %.1f s (%s)", total, steps)
+
 def _CancelUpdateConversion(future):
     """
     Canceller of _DoUpdateConversion task.
@@ -573,17 +613,17 @@ def _DoRotationAndScaling(future, ccd, detector, escan, sem_stage, opt_stage, fo
             if future._rotation_scaling_state == CANCELLED:
                 raise CancelledError()
             f = sem_stage.moveAbs(pos)
-            f.result()
             # Transform to coordinates in the reference frame of the objective stage
             vpos = [pos["x"], pos["y"]]
 #             P = numpy.transpose([vpos[0], vpos[1]])
 #             O = numpy.transpose([offset[0], offset[1]])
 #             q = numpy.add(P, O).tolist()
             q = [vpos[0] + offset[0], vpos[1] + offset[1]]
-            # Move objective lens correcting for offset
+            # Move objective lens correcting for offset, at the same time
             cor_pos = {"x": q[0], "y": q[1]}
-            f = opt_stage.moveAbs(cor_pos)
+            fopt = opt_stage.moveAbs(cor_pos)
             f.result()
+            fopt.result()
             # Move Phenom sample stage so that the spot should be at the center
             # of the CCD FoV
             # Simplified version of AlignSpot() but without autofocus, with
@@ -975,6 +1015,8 @@ def HFWShiftFactor(detector, escan, sem_stage, ebeam_focus, known_focus=SEM_KNOW
     # Task to run
     f.task_canceller = _CancelHFWShiftFactor
     f._hfw_shift_lock = threading.Lock()
+    # To process the images while the next one is acquired
+    f._executor = model.CancellableThreadPoolExecutor(max_workers=1)
 
     # Run in separate thread
     hfw_shift_thread = threading.Thread(target=executeTask,
@@ -994,6 +1036,7 @@ def _DoHFWShiftFactor(future, detector, escan, sem_stage, ebeam_focus, known_foc
     calculates the cummulative sum of shift between each image and the smallest 
     one and does linear fit for these shift values. From the linear fit we just 
     return the slope of the line as the intercept is expected to be 0.
+    Each pair of images is processed while the next image is acquired.
     future (model.ProgressiveFuture): Progressive future provided by the wrapper
     detector (model.Detector): The se-detector
     escan (model.Emitter): The e-beam scanner
@@ -1015,20 +1058,21 @@ def _DoHFWShiftFactor(future, detector, escan, sem_stage, ebeam_focus, known_foc
 
         # Move Phenom sample stage to the first expected hole position
         # to ensure there are some features for the phase correlation
-        f = sem_stage.moveAbs(SHIFT_DETECTION)
-        f.result()
+        fstage = sem_stage.moveAbs(SHIFT_DETECTION)
         # Start with smallest FoV
         max_hfw = 1200e-06  # m
         min_hfw = 37.5e-06  # m
         cur_hfw = min_hfw
-        shift_values = []
+        shift_futures = []
         hfw_values = []
         zoom_f = 2  # zoom factor
         # Just to force autocontrast
         escan.accelVoltage.value += 100
-        # Apply the given sem focus value for a good focus level
+        # Apply the given sem focus value for a good focus level (while the
+        # stage is moving)
         f = ebeam_focus.moveAbs({"z":known_focus})
         f.result()
+        fstage.result()
         smaller_image = None
         larger_image = None
         crop_res = (escan.resolution.value[0] / zoom_f,
@@ -1042,27 +1086,24 @@ def _DoHFWShiftFactor(future, detector, escan, sem_stage, ebeam_focus, known_foc
             larger_image = detector.data.get(asap=False)
             # If not the first iteration
             if smaller_image is not None:
-                #Crop the part of the larger image that corresponds to the
-                #smaller image Fov
-                cropped_image = larger_image[(crop_res[0] / 2):3 * (crop_res[0] / 2),
-                                          (crop_res[1] / 2):3 * (crop_res[1] / 2)]
-                # Resample the cropped image to fit the resolution of the smaller
-                # image
-                resampled_image = zoom(cropped_image, zoom=zoom_f)
-                # Apply phase correlation
-                shift_pxs = CalculateDrift(smaller_image, resampled_image, 10)
-                pixelSize = smaller_image.metadata[model.MD_PIXEL_SIZE]
-                shift = (shift_pxs[0] * pixelSize[0], shift_pxs[1] * pixelSize[1])
-                # Cummulative sum
-                new_shift = (sum([sh[0] for sh in shift_values]) + shift[0],
-                             sum([sh[1] for sh in shift_values]) + shift[1])
-                shift_values.append(new_shift)
+                # Process in the background, while acquiring the next image
+                sf = future._executor.submit(_HFWShift, smaller_image,
+                                             larger_image, crop_res, zoom_f)
+                shift_futures.append(sf)
                 hfw_values.append(cur_hfw)
 
             # Zoom out to the double hfw
             cur_hfw = zoom_f * cur_hfw
             smaller_image = larger_image
 
+        # Cummulative sum
+        shift_values = []
+        cum_shift = (0, 0)
+        for sf in shift_futures:
+            shift = sf.result()
+            cum_shift = (cum_shift[0] + shift[0], cum_shift[1] + shift[1])
+            shift_values.append(cum_shift)
+
         # Linear fit
         coefficients_x = array([hfw_values, ones(len(hfw_values))])
         c_x = 100 * linalg.lstsq(coefficients_x.T, [sh[0] for sh in shift_values])[0][0]  # obtaining the slope in x axis
@@ -1075,6 +1116,7 @@ def _DoHFWShiftFactor(future, detector, escan, sem_stage, ebeam_focus, known_foc
         return c_x, c_y
 
     finally:
+        future._executor.shutdown(wait=False)
         with future._hfw_shift_lock:
             if future._hfw_shift_state == CANCELLED:
                 raise CancelledError()
@@ -1092,8 +1134,31 @@ def _CancelHFWShiftFactor(future):
         future._hfw_shift_state = CANCELLED
         logging.debug("HFW-related shift calculation cancelled.")
 
+    future._executor.cancel()
     return True
 
+def _HFWShift(smaller_image, larger_image, crop_res, zoom_f):
+    """
+    Computes the shift between two SEM images acquired at different HFW
+    smaller_image (model.DataArray): the image with the smallest HFW
+    larger_image (model.DataArray): the image with a HFW zoom_f times larger
+    crop_res (tuple of floats): resolution of the area of the larger image
+      corresponding to the smaller image FoV
+    zoom_f (float): zoom factor between the two images
+    returns (tuple of floats): shift (m)
+    """
+    # Crop the part of the larger image that corresponds to the
+    # smaller image Fov
+    cropped_image = larger_image[int(crop_res[0] / 2):int(3 * (crop_res[0] / 2)),
+                                 int(crop_res[1] / 2):int(3 * (crop_res[1] / 2))]
+    # Resample the cropped image to fit the resolution of the smaller
+    # image
+    resampled_image = zoom(cropped_image, zoom=zoom_f)
+    # Apply phase correlation
+    shift_pxs = CalculateDrift(smaller_image, resampled_image, 10)
+    pixelSize = smaller_image.metadata[model.MD_PIXEL_SIZE]
+    return shift_pxs[0] * pixelSize[0], shift_pxs[1] * pixelSize[1]
+
 def estimateHFWShiftFactorTime(et):
     """
     Estimates HFW-related shift calculation procedure duration
@@ -1124,6 +1189,8 @@ def ResolutionShiftFactor(detector, escan, sem_stage, ebeam_focus, known_focus=S
     # Task to run
     f.task_canceller = _CancelResolutionShiftFactor
     f._resolution_shift_lock = threading.Lock()
+    # To process the images while the next one is acquired
+    f._executor = model.CancellableThreadPoolExecutor(max_workers=1)
 
     # Run in separate thread
     resolution_shift_thread = threading.Thread(target=executeTask,
@@ -1142,6 +1209,7 @@ def _DoResolutionShiftFactor(future, detector, escan, sem_stage, ebeam_focus, kn
     larger’s image resolution in order to feed it to the phase correlation. Then 
     it does linear fit for these shift values. From the linear fit we just return 
     both the slope and the intercept of the line.
+    Each image is processed while the next image is acquired.
     future (model.ProgressiveFuture): Progressive future provided by the wrapper
     detector (model.Detector): The se-detector
     escan (model.Emitter): The e-beam scanner
@@ -1164,21 +1232,23 @@ def _DoResolutionShiftFactor(future, detector, escan, sem_stage, ebeam_focus, kn
 
         # Move Phenom sample stage to the first expected hole position
         # to ensure there are some features for the phase correlation
-        f = sem_stage.moveAbs(SHIFT_DETECTION)
-        f.result()
+        fstage = sem_stage.moveAbs(SHIFT_DETECTION)
         # Start with largest resolution
         max_resolution = 2048  # pixels
         min_resolution = 256  # pixels
         cur_resolution = max_resolution
-        shift_values = []
+        shift_futures = []
         resolution_values = []
         # Just to force autocontrast
         escan.accelVoltage.value += 100
-        # Apply the given sem focus value for a good focus level
+        # Apply the given sem focus value for a good focus level (while the
+        # stage is moving)
         f = ebeam_focus.moveAbs({"z":known_focus})
         f.result()
+        fstage.result()
         smaller_image = None
         largest_image = None
+        calc_f = None  # future of the DriftCalculator of the largest image
 
         while cur_resolution >= min_resolution:
             if future._resolution_shift_state == CANCELLED:
@@ -1190,21 +1260,22 @@ def _DoResolutionShiftFactor(future, detector, escan, sem_stage, ebeam_focus, kn
             smaller_image = detector.data.get(asap=False)
             # If not the first iteration
             if largest_image is not None:
-                # Resample the smaller image to fit the resolution of the larger
-                # image
-                resampled_image = zoom(smaller_image,
-                                       zoom=(max_resolution / escan.resolution.value[0]))
-                # Apply phase correlation
-                shift_pxs = CalculateDrift(largest_image, resampled_image, 10)
-                shift_values.append(((1 / numpy.tan(2 * math.pi * shift_pxs[0] / max_resolution)),
-                                     (1 / numpy.tan(2 * math.pi * shift_pxs[1] / max_resolution))))
+                # Process in the background, while acquiring the next image
+                sf = future._executor.submit(_ResolutionShift, calc_f,
+                                             smaller_image, max_resolution)
+                shift_futures.append(sf)
                 resolution_values.append(cur_resolution)
                 cur_resolution = cur_resolution - 64
             else:
                 largest_image = smaller_image
+                # All the images are compared to the largest one, so its
+                # Fourier transform is computed only once
+                calc_f = future._executor.submit(DriftCalculator, largest_image, 10)
                 # Ignore value between 2048 and 1024
                 cur_resolution = cur_resolution - 1024
 
+        shift_values = [sf.result() for sf in shift_futures]
+
         # Linear fit
         coefficients_x = array([resolution_values, ones(len(resolution_values))])
         [a_nx, b_nx] = linalg.lstsq(coefficients_x.T, [sh[0] for sh in shift_values])[0]  # obtaining the slope and intercept in x axis
@@ -1225,6 +1296,7 @@ def _DoResolutionShiftFactor(future, detector, escan, sem_stage, ebeam_focus, kn
         return (a_x, a_y), (b_x, b_y)
 
     finally:
+        future._executor.shutdown(wait=False)
         with future._resolution_shift_lock:
             if future._resolution_shift_state == CANCELLED:
                 raise CancelledError()
@@ -1242,8 +1314,26 @@ def _CancelResolutionShiftFactor(future):
         future._resolution_shift_state = CANCELLED
         logging.debug("Resolution-related shift calculation cancelled.")
 
+    future._executor.cancel()
     return True
 
+def _ResolutionShift(calc_f, image, max_resolution):
+    """
+    Computes the shift between a SEM image and the image acquired at the
+    largest resolution
+    calc_f (Future): returns the DriftCalculator with the largest image as
+      reference
+    image (model.DataArray): the image acquired at a smaller resolution
+    max_resolution (int): resolution of the largest image
+    returns (tuple of floats): cotangent of the shift (as phase), in X and Y
+    """
+    # Resample the smaller image to fit the resolution of the larger image
+    resampled_image = zoom(image, zoom=(max_resolution / image.shape[1]))
+    # Apply phase correlation
+    shift_pxs = calc_f.result().calculate(resampled_image)
+    return ((1 / numpy.tan(2 * math.pi * shift_pxs[0] / max_resolution)),
+            (1 / numpy.tan(2 * math.pi * shift_pxs[1] / max_resolution)))
+
 def estimateResolutionShiftFactorTime(et):
     """
     Estimates Resolution-related shift calculation procedure duration
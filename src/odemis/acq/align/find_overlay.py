@@ -68,8 +68,10 @@ def FindOverlay(repetitions, dwell_time, max_allowed_diff, escan, ccd, detector)
     f._overlay_lock = threading.Lock()
     f._done = threading.Event()
 
-    # Create scanner for scan grid
-    f._scanner = GridScanner(repetitions, dwell_time, escan, ccd, detector)
+    # Create scanner for scan grid. With one image per spot, the spots are
+    # isolated while the next ones are acquired.
+    f._scanner = GridScanner(repetitions, dwell_time, escan, ccd, detector,
+                             spot_processor=_IsolateSpot)
 
     # Run in separate thread
     overlay_thread = threading.Thread(target=executeTask,
@@ -132,12 +134,10 @@ def _DoFindOverlay(future, repetitions, dwell_time, max_allowed_diff, escan,
             logging.debug("Isolating spots...")
             if isinstance(optical_image, list):
                 opt_img_shape = optical_image[0].shape
-                subimages = []
-                subimage_coordinates = []
-                for img in optical_image:
-                    subspots, subspot_coordinates = coordinates.DivideInNeighborhoods(img, (1, 1), img.shape[0] / 2)
-                    subimages.append(subspots[0])
-                    subimage_coordinates.append(subspot_coordinates[0])
+                # Already (mostly) computed during the acquisition
+                spots = future._scanner.GetSpotResults()
+                subimages = [sp[0] for sp in spots]
+                subimage_coordinates = [sp[1] for sp in spots]
             else:
                 # Distance between spots in the optical image (in optical pixels)
                 optical_dist = escan.pixelSize.value[0] * electron_scale[0] / optical_image.metadata[model.MD_PIXEL_SIZE][0]
@@ -260,6 +260,16 @@ def _CancelFindOverlay(future):
     future._done.wait(10)
     return True
 
+def _IsolateSpot(image):
+    """
+    Isolates the spot in an optical image containing a single spot
+    image (2d array): optical image of one spot
+    returns (2d array): subimage containing the spot
+            (tuple of 2 floats): coordinates of the subimage in the image
+    """
+    subspots, subspot_coordinates = coordinates.DivideInNeighborhoods(image, (1, 1), image.shape[0] / 2)
+    return subspots[0], subspot_coordinates[0]
+
 def _computeGridRatio(coord, shape):
     """
     coord (list of tuple of 2 floats): coordinates
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 19 Oct 2026
+
+@author: agent
+
+Copyright © 2026 agent
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the
+terms  of the GNU General Public License version 2 as published by the Free
+Software  Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY;  without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR  PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Odemis. If not, see http://www.gnu.org/licenses/.
+"""
+
+# Continuous focus tracking, based on the images of a live stream
+
+from __future__ import division
+
+import Queue
+import logging
+from odemis import model
+import threading
+import time
+
+from .autofocus import MeasureFocus
+
+
+# Relative difference of focus level below which the focus is considered the
+# same on both sides (ie, just noise)
+DITHER_THRES_FACTOR = 4e-3
+# Time (s) during which the tracking is paused after the focus was moved by
+# something else than the tracker (eg, the user)
+USER_HOLD_TIME = 5
+# Maximum time (s) to wait for a new image of the stream
+FRAME_TIMEOUT = 10
+
+
+class FocusInterrupted(Exception):
+    """
+    Raised when a tracking cycle has to be stopped (because the focus was moved
+    by someone else, the stream stopped, or the tracker is stopped).
+    """
+    pass
+
+
+class FocusTracker(object):
+    """
+    Keeps a live stream in focus, without interrupting it. Periodically, the
+    focus is dithered on both sides of its current position, by a small step,
+    and the focus level (cf MeasureFocus()) is measured on the images that the
+    stream acquires anyway. The focus is then moved towards the best position,
+    by at most one step per cycle.
+    As soon as the focus is moved by something else (eg, the user), the tracking
+    is paused for a little while, and restarts from the new position.
+
+    Call .start() to start tracking, and .stop() once it's not needed anymore.
+    The tracking only takes place while the stream is active.
+    """
+    def __init__(self, stream, focus, step, roi=None, binning=1, period=2,
+                 thres_factor=DITHER_THRES_FACTOR):
+        """
+        stream (Stream): the live stream providing the images
+        focus (Actuator): the focus, with a "z" axis
+        step (0<float): distance (m) of the dithering. It should be smaller than
+          the depth of field, so that the dithering is hardly visible, but
+          large enough to see a difference of focus level.
+        roi (None or 4 floats): region of the image used to measure the focus
+          level (cf MeasureFocus())
+        binning (1<=int): subsampling of the image used to measure the focus
+          level (cf MeasureFocus())
+        period (0<=float): minimum time (s) between two tracking cycles. It
+          limits the rate of the focus moves.
+        thres_factor (0<=float): relative difference of focus level below which
+          the focus is not changed.
+        """
+        if step <= 0:
+            raise ValueError("Step must be positive, but got %g" % (step,))
+        self._stream = stream
+        self._focus = focus
+        self._step = step
+        self._roi = roi
+        self._binning = binning
+        self.period = period
+        self._thres_factor = thres_factor
+        self.hold_time = USER_HOLD_TIME
+
+        try:
+            self._rng = focus.axes["z"].range
+        except (KeyError, AttributeError):
+            self._rng = None
+
+        # Protects the state shared with the position callback
+        self._lock = threading.Lock()
+        # Positions between which the focus can be, due to the tracker
+        self._own_range = None
+        self._hold_until = 0  # time until which the tracking is paused
+        self._interrupted = threading.Event()  # set when a cycle must stop
+
+        self._frames = Queue.Queue(maxsize=1)  # only the latest image
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._cycles = 0  # number of tracking cycles completed
+
+    def start(self):
+        """
+        Start tracking the focus (in a separate thread)
+        """
+        if self._thread is not None and self._thread.is_alive():
+            logging.debug("Focus tracker already running")
+            return
+
+        self._stop_event.clear()
+        pos = self._focus.position.value["z"]
+        with self._lock:
+            self._own_range = (pos, pos)
+        self._focus.position.subscribe(self._onPosition)
+        self._stream.image.subscribe(self._onImage)
+        self._thread = threading.Thread(target=self._runTracking,
+                                        name="Focus tracker")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop tracking the focus. The focus is left at the best position found.
+        Blocks until the tracking is over.
+        """
+        self._stop_event.set()
+        self._interrupted.set()
+        if self._thread is not None:
+            self._thread.join(10)
+            self._thread = None
+        self._stream.image.unsubscribe(self._onImage)
+        self._focus.position.unsubscribe(self._onPosition)
+
+    def hold(self, duration=None):
+        """
+        Pause the tracking for some time. The current cycle is stopped
+        immediately, and the tracking will restart from the position of the
+        focus at that time.
+        duration (None or float): time (s) to pause. If None, it uses .hold_time.
+        """
+        if duration is None:
+            duration = self.hold_time
+        with self._lock:
+            self._hold_until = max(self._hold_until, time.time() + duration)
+            # Don't touch the focus anymore in this cycle
+            self._own_range = None
+        self._interrupted.set()
+
+    def _onPosition(self, pos):
+        z = pos["z"]
+        with self._lock:
+            if self._own_range is None:
+                # Already paused, but the focus is still moving => pause longer
+                self._hold_until = max(self._hold_until,
+                                       time.time() + self.hold_time)
+                return
+            # Be a bit tolerant as the actuator might not reach exactly the position
+            tol = self._step / 10
+            if self._own_range[0] - tol <= z <= self._own_range[1] + tol:
+                return
+
+        logging.info("Focus moved to %g µm by something else, pausing tracking",
+                     z * 1e6)
+        self.hold()
+
+    def _onImage(self, im):
+        # The stream keeps the latest raw data, that's what we are interested in
+        try:
+            data = self._stream.raw[0]
+        except IndexError:
+            return
+
+        # Only keep the latest image: an older one is never used anyway
+        try:
+            self._frames.get(block=False)
+        except Queue.Empty:
+            pass
+        try:
+            self._frames.put(data, block=False)
+        except Queue.Full:
+            # The tracking thread doesn't put anything, so only happens if
+            # two images arrive concurrently => just drop this one
+            pass
+
+    def _runTracking(self):
+        try:
+            while not self._stop_event.is_set():
+                if not self._waitNextCycle():
+                    break
+                try:
+                    self._trackOnce()
+                    self._cycles += 1
+                except FocusInterrupted:
+                    logging.debug("Focus tracking cycle interrupted")
+        except Exception:
+            logging.exception("Focus tracker failed")
+        finally:
+            logging.debug("Focus tracker thread over")
+
+    def _waitNextCycle(self):
+        """
+        Wait until a new cycle can be started (period elapsed, not held, and
+        stream active)
+        returns (bool): False if the tracker is stopped
+        """
+        tnext = time.time() + self.period
+        while True:
+            with self._lock:
+                tnext = max(tnext, self._hold_until)
+            now = time.time()
+            if now >= tnext and self._stream.is_active.value:
+                break
+            if self._stop_event.wait(min(max(tnext - now, 0.01), 0.1)):
+                return False
+
+        pos = self._focus.position.value["z"]
+        with self._lock:
+            self._own_range = (pos, pos)
+            self._interrupted.clear()
+        return True
+
+    def _trackOnce(self):
+        """
+        Run one tracking cycle: measure the focus level at the current position,
+        and a step on each side, then move to the best estimate.
+        raises FocusInterrupted: if the cycle had to be stopped
+        """
+        step = self._step
+        center = self._focus.position.value["z"]
+        lpos, hpos = self._clip(center - step), self._clip(center + step)
+        if lpos == hpos:
+            return
+
+        try:
+            fc = self._measure(center)
+            fh = self._measure(hpos)
+            fl = self._measure(lpos)
+        except FocusInterrupted:
+            # Unless the focus was moved by someone else, go back to the center
+            with self._lock:
+                user_moved = self._own_range is None
+            if not user_moved:
+                self._move(center, force=True)
+            raise
+
+        logging.debug("Focus level around %g µm: %g, %g, %g", center * 1e6,
+                      fl, fc, fh)
+        # Fit a parabola on the 3 points, and go to its maximum, but by at most
+        # one step (to stay safe, and only make small moves)
+        curv = (fh + fl - 2 * fc)
+        diff = fh - fl
+        if abs(diff) <= self._thres_factor * max(fl, fc, fh):
+            shift = 0
+        elif curv < 0:
+            shift = -step * diff / (2 * curv)
+            shift = max(-step, min(shift, step))
+        else:
+            # Not around the maximum => just go uphill
+            shift = step if diff > 0 else -step
+
+        new_pos = self._clip(center + shift)
+        if shift:
+            logging.info("Focus tracking: moving focus by %g µm",
+                         (new_pos - center) * 1e6)
+        self._move(new_pos)
+
+    def _clip(self, pos):
+        if self._rng is None:
+            return pos
+        return min(max(self._rng[0], pos), self._rng[1])
+
+    def _move(self, pos, force=False):
+        """
+        Move the focus to the given position
+        force (bool): if True, move even if the cycle is interrupted
+        raises FocusInterrupted: if the cycle had to be stopped
+        """
+        with self._lock:
+            if self._own_range is None:  # Focus moved by someone else
+                raise FocusInterrupted()
+            if self._interrupted.is_set() and not force:
+                raise FocusInterrupted()
+            prev = self._own_range[0]
+            self._own_range = (min(prev, pos), max(prev, pos))
+        self._focus.moveAbs({"z": pos}).result()
+        with self._lock:
+            if self._own_range is None:
+                raise FocusInterrupted()
+            self._own_range = (pos, pos)
+        if self._interrupted.is_set() and not force:
+            raise FocusInterrupted()
+
+    def _measure(self, pos):
+        """
+        Move the focus and measure the focus level of the next image of the
+        stream, acquired after the move
+        returns (float): focus level
+        raises FocusInterrupted: if the cycle had to be stopped
+        """
+        self._move(pos)
+        tmove = time.time()
+        # Discard the older image
+        try:
+            self._frames.get(block=False)
+        except Queue.Empty:
+            pass
+
+        tend = tmove + FRAME_TIMEOUT
+        while True:
+            if self._interrupted.is_set() or self._stop_event.is_set():
+                raise FocusInterrupted()
+            if not self._stream.is_active.value:
+                logging.debug("Stream stopped during focus tracking")
+                raise FocusInterrupted()
+            if time.time() > tend:
+                logging.info("No image received for %g s, stopping the "
+                             "focus tracking cycle", FRAME_TIMEOUT)
+                raise FocusInterrupted()
+            try:
+                data = self._frames.get(timeout=0.1)
+            except Queue.Empty:
+                continue
+            # Make sure the image was acquired after the move
+            tacq = data.metadata.get(model.MD_ACQ_DATE, time.time())
+            if tacq >= tmove:
+                break
+
+        return MeasureFocus(data, self._roi, self._binning)
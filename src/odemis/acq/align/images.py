@@ -31,6 +31,7 @@ from odemis import util
 from odemis.util import TimeoutError
 from odemis.util import img
 import threading
+import time
 import math
 import copy
 
@@ -38,18 +39,32 @@ import copy
 # than this, one image per spot will be taken.
 SPOT_SIZE = 1.5e-6 # m
 class GridScanner(object):
-    def __init__(self, repetitions, dwell_time, escan, ccd, detector):
+    def __init__(self, repetitions, dwell_time, escan, ccd, detector,
+                 spot_processor=None):
+        """
+        spot_processor (None or callable DataArray -> anything): if provided,
+          with the "one image per spot" procedure, each image is passed to it
+          as soon as it is received. It runs in a separate thread, while the
+          next spots are acquired. See GetSpotResults().
+        """
         self.repetitions = repetitions
         self.dwell_time = dwell_time
         self.escan = escan
         self.ccd = ccd
         self.detector = detector
+        self.spot_processor = spot_processor
 
         self._acq_state = FINISHED
         self._acq_lock = threading.Lock()
         self._ccd_done = threading.Event()
         self._optical_image = None
         self._spot_images = []
+        self._spot_results = []  # futures of the spot_processor
+        # Time the acquisition of the current spot was requested, or None if
+        # no image is expected
+        self._spot_start = None
+        # To run the spot_processor, one image after another
+        self._executor = None
 
         self._hw_settings = ()
 
@@ -96,14 +111,41 @@ class GridScanner(object):
         """
         Receives the Spot image data
         """
+        # Only accept the first image acquired after the spot was requested,
+        # as the CCD might still send an image of a previous spot (eg, if the
+        # trigger was handled late).
+        spot_start = self._spot_start
+        acq_date = data.metadata.get(model.MD_ACQ_DATE, time.time())
+        if spot_start is None or acq_date < spot_start:
+            logging.warning("Discarding CCD image acquired at %f, not for the current spot",
+                            acq_date)
+            return
+        self._spot_start = None
+
         self._spot_images.append(data)
+        executor = self._executor
+        if executor is not None:
+            self._spot_results.append(executor.submit(self.spot_processor, data))
         self._ccd_done.set()
         logging.debug("Got Spot image!")
 
+    def GetSpotResults(self):
+        """
+        Returns the output of the spot_processor for each image of the last
+        "one image per spot" acquisition. Blocks until they are all processed.
+        returns (list): the value returned by the spot_processor for each spot,
+          in the same order as the images.
+        raises: any exception raised by the spot_processor
+        """
+        return [f.result() for f in self._spot_results]
+
     def _doSpotAcquisition(self, electron_coordinates, scale):
         """
         Perform acquisition spot per spot.
-        Slow, but works even if SEM FoV is small
+        Slow, but works even if SEM FoV is small.
+        If the CCD supports it, it stays subscribed during the whole scan, and
+        each image is started by its software trigger, which avoids the
+        overhead of starting the CCD acquisition at every spot.
         """
         escan = self.escan
         ccd = self.ccd
@@ -137,23 +179,49 @@ class GridScanner(object):
         logging.debug("Scanning spot grid with image per spot procedure...")
 
         self._spot_images = []
-        for spot in electron_coordinates:
-            self._ccd_done.clear()
-            escan.translation.value = spot
-            logging.debug("Scanning spot %s", escan.translation.value)
-            try:
-                if self._acq_state == CANCELLED:
-                    raise CancelledError()
-                detector.data.subscribe(self._discard_data)
-                ccd.data.subscribe(self._onSpotImage)
+        self._spot_results = []
+        if self.spot_processor is not None:
+            self._executor = model.CancellableThreadPoolExecutor(max_workers=1)
 
-                # Wait for CCD to capture the image
-                if not self._ccd_done.wait(2 * tot_time + 4):
-                    raise TimeoutError("Acquisition of CCD timed out")
+        trigger = getattr(ccd, "softwareTrigger", None)
+        try:
+            if trigger is not None:
+                ccd.data.synchronizedOn(trigger)
+                ccd.data.subscribe(self._onSpotImage)
 
-            finally:
-                detector.data.unsubscribe(self._discard_data)
+            for spot in electron_coordinates:
+                self._ccd_done.clear()
+                escan.translation.value = spot
+                logging.debug("Scanning spot %s", escan.translation.value)
+                try:
+                    if self._acq_state == CANCELLED:
+                        raise CancelledError()
+                    detector.data.subscribe(self._discard_data)
+                    self._spot_start = time.time()
+                    if trigger is not None:
+                        trigger.notify()
+                    else:
+                        ccd.data.subscribe(self._onSpotImage)
+
+                    # Wait for CCD to capture the image
+                    if not self._ccd_done.wait(2 * tot_time + 4):
+                        raise TimeoutError("Acquisition of CCD timed out")
+
+                finally:
+                    # Any image received from now on is not for this spot
+                    self._spot_start = None
+                    detector.data.unsubscribe(self._discard_data)
+                    if trigger is None:
+                        ccd.data.unsubscribe(self._onSpotImage)
+        finally:
+            if trigger is not None:
+                # Stopping the acquisition also drops the triggers not yet
+                # handled by the CCD
                 ccd.data.unsubscribe(self._onSpotImage)
+                ccd.data.synchronizedOn(None)
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
 
         with self._acq_lock:
             if self._acq_state == CANCELLED:
@@ -306,7 +374,10 @@ class GridScanner(object):
             self._acq_state = CANCELLED
             self._ccd_done.set()
             logging.debug("Scan cancelled.")
-    
+
+        executor = self._executor
+        if executor is not None:
+            executor.cancel()
         return True
 
     def get_sem_fov(self):
@@ -452,7 +523,8 @@ class GridScanner(object):
         res = [int(math.ceil(w * 2)) for w in hwidth]
         # Add margin to computed resolution because we assume that the
         # image is centered but this is not exactly the case
-        res = (res[0] + 50, res[1] + 50)
+        shape = self.ccd.shape[0:2]
+        res = (min(res[0] + 50, shape[0]), min(res[1] + 50, shape[1]))
 
         self.ccd.binning.value = (1, 1)
         self.ccd.resolution.value = res
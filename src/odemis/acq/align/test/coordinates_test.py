@@ -19,7 +19,10 @@ PURPOSE. See the GNU General Public License for more details.
 You should have received a copy of the GNU General Public License along with 
 Odemis. If not, see http://www.gnu.org/licenses/.
 '''
+from __future__ import division
+
 import logging
+import time
 import unittest
 import numpy
 import math
@@ -183,6 +186,38 @@ class TestDivideInNeighborhoods(unittest.TestCase):
 
         self.assertEqual(len(subimages), 99)
 
+# @unittest.skip("skip")
+class TestBandPassFilter(unittest.TestCase):
+    """
+    Test _BandPassFilter
+    """
+    def test_kernel_cache(self):
+        grid_data = hdf5.read_data("grid_10x10.h5")
+        C, T, Z, Y, X = grid_data[0].shape
+        grid_data[0].shape = Y, X
+        image = grid_data[0]
+
+        filtered = coordinates._BandPassFilter(image, 1, 20)
+        kernel = coordinates._GetBandPassKernel(image.shape, 1, 20)
+        # Same image shape => same kernel, and same result
+        self.assertIs(coordinates._GetBandPassKernel(image.shape, 1, 20), kernel)
+        numpy.testing.assert_array_equal(coordinates._BandPassFilter(image, 1, 20),
+                                         filtered)
+        exp_kernel = coordinates._ComputeBandPassKernel(image.shape, 1, 20)
+        numpy.testing.assert_array_equal(kernel, exp_kernel)
+
+        # Other shape (odd) => other kernel
+        sub = image[:-1, :-1]
+        filtered_sub = coordinates._BandPassFilter(sub, 1, 20)
+        self.assertEqual(filtered_sub.shape, sub.shape)
+        self.assertIsNot(coordinates._GetBandPassKernel(sub.shape, 1, 20), kernel)
+
+        # Only a limited number of kernels are kept
+        for i in range(coordinates.KERNEL_CACHE_SIZE + 1):
+            coordinates._GetBandPassKernel((100 + i, 100), 1, 20)
+        self.assertLessEqual(len(coordinates._kernel_cache),
+                             coordinates.KERNEL_CACHE_SIZE)
+
 # @unittest.skip("skip")
 class TestMatchCoordinates(unittest.TestCase):
     """
@@ -411,6 +446,28 @@ class TestMatchCoordinates(unittest.TestCase):
 
         if known_estimated_coordinates != []:
             numpy.testing.assert_equal(known_estimated_coordinates.__len__(), electron_coordinates.__len__() - 1)
-            
+
+    def test_match_coordinates_large_grids(self):
+        """
+        Test MatchCoordinates on dense grids, from 10x10 to 100x100, and report
+        the time it takes
+        """
+        rotation = 0.01
+        scale = 1.02
+        for n in (10, 40, 100):
+            electron_coordinates = [(float(x), float(y)) for x in range(n) for y in range(n)]
+            shuffled_coordinates = coordinates._TransformCoordinates(electron_coordinates, (3.5, -2.3), rotation, (scale, scale))
+            shuffle(shuffled_coordinates)
+            shuffled_coordinates = [(x + random.normal(0, 0.01), y + random.normal(0, 0.01))
+                                    for x, y in shuffled_coordinates]
+
+            tstart = time.time()
+            known_estimated_coordinates, known_optical_coordinates = coordinates.MatchCoordinates(shuffled_coordinates, electron_coordinates, 1 / scale, 0.25)
+            logging.info("Matched %dx%d grid in %g s", n, n, time.time() - tstart)
+            self.assertEqual(len(known_estimated_coordinates), n * n)
+            (calc_translation_x, calc_translation_y), (calc_scaling_x, calc_scaling_y), calc_rotation = transform.CalculateTransform(known_optical_coordinates, known_estimated_coordinates)
+            numpy.testing.assert_almost_equal((calc_translation_x, calc_translation_y, calc_scaling_x, calc_scaling_y, calc_rotation),
+                                              (3.5, -2.3, scale, scale, rotation), 1)
+
 if __name__ == '__main__':
     unittest.main()
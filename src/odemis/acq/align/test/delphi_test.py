@@ -42,6 +42,30 @@ ODEMISD_ARG = ["--log-level=2", "--log-target=testdaemon.log", "--daemonize"]
 CONFIG_PATH = os.path.dirname(odemis.__file__) + "/../../install/linux/usr/share/odemis/"
 logging.debug("Config path = %s", CONFIG_PATH)
 SECOM_LENS_CONFIG = CONFIG_PATH + "delphi-sim.odm.yaml"  # 7x7
+
+
+class TestResolutionShift(unittest.TestCase):
+    """
+    Test the image processing of ResolutionShiftFactor (doesn't need a backend)
+    """
+
+    def test_resolution_shift(self):
+        """
+        Test the processing of the images of ResolutionShiftFactor
+        """
+        data = hdf5.read_data("sem_hole.h5")
+        C, T, Z, Y, X = data[0].shape
+        data[0].shape = Y, X
+        largest = data[0][:256, :256].astype(numpy.float64)
+        smaller = largest[::2, ::2]
+
+        calc_f = model.InstantaneousFuture(delphi.DriftCalculator(largest, 10))
+        cot_shift = delphi._ResolutionShift(calc_f, smaller, 256)
+        exp_shift = delphi.CalculateDrift(largest, delphi.zoom(smaller, zoom=2), 10)
+        numpy.testing.assert_almost_equal(cot_shift,
+                          [1 / numpy.tan(2 * numpy.pi * s / 256) for s in exp_shift])
+
+
 # @unittest.skip("skip")
 class TestCalibration(unittest.TestCase):
     """
@@ -198,7 +222,9 @@ class TestCalibration(unittest.TestCase):
         combined_stage = self.combined_stage
         f = delphi.UpdateConversion(ccd, detector, escan, sem_stage, opt_stage, ebeam_focus,
                                     focus, combined_stage, True)
-        first_hole, second_hole, hole_focus, offset, rotation, scaling = f.result()
+        (first_hole, second_hole, hole_focus, offset, rotation, scaling,
+         resa, resb, hfwa, spotshift) = f.result()
+        self.assertIn("hole detection", f.step_durations)
 
     @unittest.skip("skip")
     def test_scan_pattern(self):
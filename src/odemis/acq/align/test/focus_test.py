@@ -31,6 +31,8 @@ from odemis.dataio import hdf5
 import odemis
 from odemis.acq import align
 from odemis.acq.align import autofocus
+from odemis.driver import simcam
+import numpy
 from scipy import ndimage
 
 logging.basicConfig(format=" - %(levelname)s \t%(message)s")
@@ -110,6 +112,25 @@ class TestAutofocus(unittest.TestCase):
             self.assertGreater(prev_res, res)
             prev_res = res
 
+    def test_measure_focus_roi(self):
+        """
+        Test MeasureFocus on a sub-part of the image, binned, and in RGB
+        """
+        input = self.fake_img
+        blurred = ndimage.gaussian_filter(input, sigma=3)
+        for roi, binning in ((None, 2), ((0.25, 0.25, 0.75, 0.75), 1),
+                             ((0.25, 0.25, 0.75, 0.75), 4)):
+            res = autofocus.MeasureFocus(input, roi, binning)
+            res_blurred = autofocus.MeasureFocus(blurred, roi, binning)
+            self.assertGreater(res, res_blurred)
+
+        rgb = numpy.dstack([input] * 3)
+        self.assertGreater(autofocus.MeasureFocus(rgb),
+                           autofocus.MeasureFocus(numpy.dstack([blurred] * 3)))
+
+        with self.assertRaises(ValueError):
+            autofocus.MeasureFocus(input, (0.5, 0.5, 0.51, 0.51), 16)
+
     def test_autofocus(self):
         """
         Test AutoFocus
@@ -122,6 +143,149 @@ class TestAutofocus(unittest.TestCase):
         foc_pos, fm_final = future_focus.result()
         self.assertAlmostEqual(foc_pos, 0, 4)
 
+    def test_autofocus_golden(self):
+        """
+        Test AutoFocus with the golden-section search
+        """
+        focus = self.focus
+        ebeam = self.ebeam
+        ccd = self.ccd
+        focus.moveAbs({"z": 60e-06})
+        future_focus = align.AutoFocus(ccd, ebeam, focus, 10e-06,
+                                       method=autofocus.METHOD_GOLDEN,
+                                       roi=(0.25, 0.25, 0.75, 0.75), binning=2)
+        foc_pos, fm_final = future_focus.result()
+        self.assertAlmostEqual(foc_pos, 0, 4)
+
+
+# The simcam blurs the image with a gaussian of sigma = defocus * 1e4 px, which
+# has no effect below 0.125 px. So the focus level is flat within this defocus.
+SIM_FLAT_DEFOCUS = 12.5e-6 # m
+# Up to 0.375 px, the gaussian kernel is only 3 px wide, and as the image is
+# made of integers, the focus level only varies by ~1e-4 (relative) compared to
+# the flat top, with local maxima. With a ROI and binning, this is within the
+# noise, so the focus can only be found within this defocus.
+SIM_SHOULDER_DEFOCUS = 37.5e-6 # m
+
+class TestAutofocusSim(unittest.TestCase):
+    """
+    Compare the autofocus methods on the focus curve simulated by the simcam
+    (which doesn't need a backend)
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cwd = os.getcwd()
+        try:
+            cls.ccd = simcam.Camera("camera", "overview-ccd",
+                                    image="songbird-sim-ccd.h5",
+                                    children={"focus": {"name": "focus",
+                                                        "role": "focus"}})
+        finally:
+            os.chdir(cwd)  # simcam changes the current directory
+        cls.focus = list(cls.ccd.children.value)[0]
+        cls.ccd.exposureTime.value = 0.01
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.ccd.terminate()
+
+    def _run_autofocus(self, start, accuracy=1e-6, **kwargs):
+        """
+        return (float, int, float): focus position, number of images, duration
+        """
+        self.focus.moveAbs({"z": start}).result()
+        nimages = [0]
+        orig_sub = autofocus.SubstractBackground
+        def counting_sub(*args):
+            nimages[0] += 1
+            return orig_sub(*args)
+
+        autofocus.SubstractBackground = counting_sub
+        try:
+            tstart = time.time()
+            f = autofocus.AutoFocus(self.ccd, None, self.focus, accuracy, **kwargs)
+            foc_pos, fm_final = f.result()
+            dur = time.time() - tstart
+        finally:
+            autofocus.SubstractBackground = orig_sub
+
+        logging.info("Autofocus %s from %g: found %g in %d images and %g s",
+                     kwargs, start, foc_pos, nimages[0], dur)
+        self.assertAlmostEqual(self.focus.position.value["z"], foc_pos)
+        return foc_pos, nimages[0], dur
+
+    def test_golden(self):
+        accuracy = 2e-6
+        for start in (30e-6, 200e-6, -150e-6):
+            foc_pos, nimages, dur = self._run_autofocus(start, accuracy,
+                                                method=autofocus.METHOD_GOLDEN)
+            self.assertLess(abs(foc_pos), SIM_FLAT_DEFOCUS + accuracy)
+            self.assertLessEqual(nimages, autofocus.MAX_STEPS_NUMBER)
+
+            foc_pos, nimages, dur = self._run_autofocus(start, accuracy,
+                                                method=autofocus.METHOD_GOLDEN,
+                                                roi=(0.25, 0.25, 0.75, 0.75),
+                                                binning=4)
+            self.assertLess(abs(foc_pos), SIM_SHOULDER_DEFOCUS + accuracy)
+            self.assertLessEqual(nimages, autofocus.MAX_STEPS_NUMBER)
+
+    def test_benchmark(self):
+        """
+        Compare the number of images and accuracy of the golden-section search
+        to the hill-climbing
+        """
+        accuracy = 2e-6
+        results = {}
+        for method in (autofocus.METHOD_HILL_CLIMB, autofocus.METHOD_GOLDEN):
+            for start in (30e-6, 50e-6, 200e-6, -150e-6):
+                foc_pos, nimages, dur = self._run_autofocus(start, accuracy,
+                                                            method=method)
+                results[(method, start)] = (abs(foc_pos), nimages)
+
+        for (method, start), (err, nimages) in sorted(results.items()):
+            logging.info("%s from %g um: error = %g um, %d images",
+                         method, start * 1e6, err * 1e6, nimages)
+
+        for start in (30e-6, 50e-6, 200e-6, -150e-6):
+            err_g, n_g = results[(autofocus.METHOD_GOLDEN, start)]
+            err_h, n_h = results[(autofocus.METHOD_HILL_CLIMB, start)]
+            self.assertLess(err_g, SIM_FLAT_DEFOCUS + accuracy)
+            self.assertLessEqual(err_g, err_h + accuracy)
+
+    def test_hill_climb_roi(self):
+        """
+        The ROI and binning are also used by the hill-climbing method
+        """
+        calls = []
+        orig_measure = autofocus.MeasureFocus
+        def recording_measure(image, roi=None, binning=1):
+            calls.append((roi, binning))
+            return orig_measure(image, roi, binning)
+
+        autofocus.MeasureFocus = recording_measure
+        try:
+            self._run_autofocus(50e-6, method=autofocus.METHOD_HILL_CLIMB,
+                                roi=(0.25, 0.25, 0.75, 0.75), binning=4)
+        finally:
+            autofocus.MeasureFocus = orig_measure
+
+        self.assertGreater(len(calls), 0)
+        for c in calls:
+            self.assertEqual(c, ((0.25, 0.25, 0.75, 0.75), 4))
+
+    def test_cancel(self):
+        self.focus.moveAbs({"z": 200e-6}).result()
+        f = autofocus.AutoFocus(self.ccd, None, self.focus, 1e-6,
+                                method=autofocus.METHOD_GOLDEN)
+        time.sleep(0.2)
+        self.assertTrue(f.cancel())
+        self.assertTrue(f.cancelled())
+
+    def test_unknown_method(self):
+        with self.assertRaises(ValueError):
+            autofocus.AutoFocus(self.ccd, None, self.focus, 1e-6, method="foo")
+
+
 if __name__ == '__main__':
-    suite = unittest.TestLoader().loadTestsFromTestCase(TestAutofocus)
-    unittest.TextTestRunner(verbosity=2).run(suite)
+    unittest.main()
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 19 Oct 2026
+
+@author: agent
+
+Copyright © 2026 agent
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Odemis. If not, see http://www.gnu.org/licenses/.
+'''
+from __future__ import division
+
+import logging
+import math
+from odemis.acq import stream
+from odemis.acq.align import focustrack
+from odemis.driver import simcam
+import os
+import threading
+import time
+import unittest
+
+
+logging.getLogger().setLevel(logging.DEBUG)
+
+# The simulated camera image is identical up to this distance from the focus
+SIM_FLAT_DEFOCUS = 12.5e-6  # m
+# Maximum duration of a tracking cycle on the simulator (3 images + 4 moves)
+CYCLE_TIMEOUT = 10  # s
+
+
+class TestFocusTracker(unittest.TestCase):
+    """
+    Test the focus tracking on the simulated camera (which blurs the image
+    proportionally to the distance to the focus position 0)
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cwd = os.getcwd()
+        try:
+            cls.ccd = simcam.Camera("camera", "overview-ccd",
+                                    image="songbird-sim-ccd.h5",
+                                    children={"focus": {"name": "focus",
+                                                        "role": "focus"}})
+        finally:
+            os.chdir(cwd)  # simcam changes the current directory
+        cls.focus = list(cls.ccd.children.value)[0]
+        cls.ccd.exposureTime.value = 0.05
+        cls.ccd.data.get()  # the new exposure time is used after the next image
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.ccd.terminate()
+
+    def setUp(self):
+        self.stream = stream.CameraStream("test", self.ccd, self.ccd.data, None)
+        self.stream.should_update.value = True
+        self.stream.is_active.value = True
+        self.tracker = None
+
+    def tearDown(self):
+        if self.tracker:
+            self.tracker.stop()
+        self.stream.is_active.value = False
+
+    def _wait_cycles(self, n, timeout=None):
+        """
+        Wait until the tracker has completed (at least) n cycles in total
+        timeout (None or float): maximum time to wait (s). If None, it's long
+          enough for n cycles.
+        """
+        if timeout is None:
+            timeout = n * CYCLE_TIMEOUT
+        tend = time.time() + timeout
+        while self.tracker._cycles < n:
+            if time.time() > tend:
+                self.fail("Only %d cycles done after %g s, while expected %d" %
+                          (self.tracker._cycles, timeout, n))
+            time.sleep(0.01)
+
+    def _wait_frames(self, n):
+        """
+        Wait until the camera has acquired n new images
+        """
+        received = threading.Semaphore(0)
+        def on_image(df, data):
+            received.release()
+
+        self.ccd.data.subscribe(on_image)
+        try:
+            for i in range(n):
+                tend = time.time() + CYCLE_TIMEOUT
+                while not received.acquire(False):
+                    if time.time() > tend:
+                        self.fail("No image received from the camera")
+                    time.sleep(0.01)
+        finally:
+            self.ccd.data.unsubscribe(on_image)
+
+    def test_track(self):
+        """
+        From far away, the focus converges to the best position, one step per
+        cycle, and then stays there
+        """
+        start, step = 150e-6, 20e-6
+        self.focus.moveAbs({"z": start}).result()
+        self.tracker = focustrack.FocusTracker(self.stream, self.focus, step,
+                                               binning=2, period=0,
+                                               thres_factor=1e-3)
+        self.tracker.start()
+        # It moves by at most a step per cycle, so give it a few more cycles
+        ncycles = int(math.ceil(start / step)) + 2
+        self._wait_cycles(ncycles)
+        pos = self.focus.position.value["z"]
+        # The simulator image is the same up to SIM_FLAT_DEFOCUS, so the
+        # tracker can only get close to it, within the step dithering.
+        self.assertLessEqual(abs(pos), SIM_FLAT_DEFOCUS + 2 * step)
+
+        # Once converged, it stays there
+        self._wait_cycles(ncycles + 2)
+        self.assertAlmostEqual(self.focus.position.value["z"], pos)
+
+        # Once stopped, it doesn't move anymore
+        thread = self.tracker._thread
+        self.tracker.stop()
+        self.assertFalse(thread.is_alive())
+        pos = self.focus.position.value["z"]
+        self._wait_frames(5)
+        self.assertEqual(self.focus.position.value["z"], pos)
+
+    def test_user_move(self):
+        """
+        The tracking is paused when the focus is moved by someone else
+        """
+        self.focus.moveAbs({"z": 150e-6}).result()
+        self.tracker = focustrack.FocusTracker(self.stream, self.focus, 20e-6,
+                                               period=0, thres_factor=1e-3)
+        self.tracker.hold_time = 2
+        self.tracker.start()
+        self._wait_cycles(1)
+
+        moves = []  # time, position
+        def on_position(pos):
+            moves.append((time.time(), pos["z"]))
+
+        self.focus.position.subscribe(on_position)
+        try:
+            tuser = time.time()
+            self.focus.moveAbs({"z": 300e-6}).result()
+            tuser_end = time.time()
+            # The tracker noticed the move, and holds until hold_time after it
+            self.assertIsNone(self.tracker._own_range)
+            self.assertGreaterEqual(self.tracker._hold_until,
+                                    tuser + self.tracker.hold_time)
+
+            # After the hold time, the tracking starts again
+            ncycles = self.tracker._cycles
+            self._wait_cycles(ncycles + 1, self.tracker.hold_time + CYCLE_TIMEOUT)
+            self.assertLess(self.focus.position.value["z"], 300e-6)
+        finally:
+            self.focus.position.unsubscribe(on_position)
+
+        # During the hold time, the focus stayed where the "user" put it
+        hold_until = tuser_end + self.tracker.hold_time
+        for t, z in moves:
+            if tuser_end < t < hold_until:
+                self.assertEqual(z, 300e-6)
+
+    def test_stream_paused(self):
+        """
+        No tracking when the stream is not active
+        """
+        self.focus.moveAbs({"z": 150e-6}).result()
+        self.stream.is_active.value = False
+        self.tracker = focustrack.FocusTracker(self.stream, self.focus, 20e-6,
+                                               period=0)
+        self.tracker.start()
+        # Give it the time to run several cycles, if it were not paused
+        self.ccd.data.get()  # the stream is off, so get at least one image
+        self._wait_frames(10)
+        self.assertEqual(self.tracker._cycles, 0)
+        self.assertEqual(self.focus.position.value["z"], 150e-6)
+
+        # As soon as the stream is active, the tracking starts
+        self.stream.is_active.value = True
+        self._wait_cycles(1)
+
+    def test_latest_frame(self):
+        """
+        While the images are not used, only the latest one is kept
+        """
+        self.tracker = focustrack.FocusTracker(self.stream, self.focus, 20e-6)
+        # Only receive the images, without tracking
+        self.stream.image.subscribe(self.tracker._onImage)
+        self._wait_frames(5)
+        self.assertEqual(self.tracker._frames.qsize(), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
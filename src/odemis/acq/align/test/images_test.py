@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 19 Oct 2026
+
+@author: agent
+
+Copyright © 2026 agent
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Odemis. If not, see http://www.gnu.org/licenses/.
+'''
+from __future__ import division
+
+from concurrent.futures._base import CancelledError
+import logging
+import numpy
+from odemis import model
+from odemis.acq.align import images, find_overlay
+from odemis.driver import simsem, andorcam2
+import os
+import threading
+import time
+import unittest
+
+
+logging.getLogger().setLevel(logging.DEBUG)
+
+CONFIG_SED = {"name": "sed", "role": "se-detector"}
+CONFIG_SCANNER = {"name": "scanner", "role": "ebeam"}
+CONFIG_SEM = {"name": "sem", "role": "sem", "image": "songbird-sim-ccd.h5",
+              "children": {"scanner": CONFIG_SCANNER, "detector0": CONFIG_SED}}
+
+# With such a small pixel size, the CCD sees only a small part of the SEM
+# field of view, so the spots are too close and one image per spot is acquired
+CCD_PIXEL_SIZE = (1e-9, 1e-9) # m
+REPETITIONS = (4, 4)
+DWELL_TIME = 0.01 # s
+
+
+class NoTriggerCCD(object):
+    """
+    Gives access to a CCD, but without its software trigger, to use the
+    subscribe/unsubscribe per spot
+    """
+    def __init__(self, ccd):
+        self._ccd = ccd
+
+    def __getattr__(self, name):
+        if name == "softwareTrigger":
+            raise AttributeError(name)
+        return getattr(self._ccd, name)
+
+
+class TestGridScannerSpot(unittest.TestCase):
+    """
+    Test the "one image per spot" acquisition of the GridScanner, with the
+    simulated SEM and CCD (which don't need a backend)
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cwd = os.getcwd()
+        try:
+            cls.sem = simsem.SimSEM(**CONFIG_SEM)
+        finally:
+            os.chdir(cwd) # simsem changes the current directory
+        for child in cls.sem.children.value:
+            if child.name == CONFIG_SED["name"]:
+                cls.sed = child
+            elif child.name == CONFIG_SCANNER["name"]:
+                cls.ebeam = child
+        cls.ccd = andorcam2.FakeAndorCam2("camera", "ccd")
+        cls.ccd.updateMetadata({model.MD_PIXEL_SIZE: CCD_PIXEL_SIZE})
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.ccd.terminate()
+        cls.sem.terminate()
+
+    def _acquire(self, ccd, spot_processor=None):
+        """
+        return (GridScanner, list of DataArray, float): the scanner used, the
+          spot images, and the duration of the acquisition
+        """
+        gscanner = images.GridScanner(REPETITIONS, DWELL_TIME, self.ebeam, ccd,
+                                      self.sed, spot_processor=spot_processor)
+        tstart = time.time()
+        spots, coords, scale = gscanner.DoAcquisition()
+        dur = time.time() - tstart
+        self.assertIsInstance(spots, list) # one image per spot
+        self.assertEqual(len(spots), numpy.prod(REPETITIONS))
+        self.assertEqual(len(coords), len(spots))
+        return gscanner, spots, dur
+
+    def test_trigger(self):
+        """
+        The CCD is only subscribed once, and each image is started by the
+        software trigger
+        """
+        self.assertTrue(hasattr(self.ccd, "softwareTrigger"))
+        nsub = [0]
+        orig_subscribe = self.ccd.data.subscribe
+        def counting_subscribe(listener):
+            nsub[0] += 1
+            orig_subscribe(listener)
+
+        self.ccd.data.subscribe = counting_subscribe
+        try:
+            gscanner, spots, dur = self._acquire(self.ccd)
+        finally:
+            del self.ccd.data.subscribe
+
+        self.assertEqual(nsub[0], 1)
+        # Everything is back to normal
+        self.assertEqual(self.ccd.exposureTime.value, gscanner._hw_settings[-1])
+        im = self.ccd.data.get()
+        self.assertEqual(im.ndim, 2)
+
+    def test_no_trigger(self):
+        """
+        Without software trigger, the CCD is subscribed for each spot
+        """
+        gscanner, spots, dur = self._acquire(NoTriggerCCD(self.ccd))
+        for im in spots:
+            self.assertEqual(im.ndim, 2)
+
+    def test_spot_processor(self):
+        """
+        The spot_processor is called on each image, in order
+        """
+        processed = []
+        def processor(im):
+            processed.append(im)
+            return im.metadata[model.MD_ACQ_DATE], im.shape
+
+        for ccd in (self.ccd, NoTriggerCCD(self.ccd)):
+            processed[:] = []
+            gscanner, spots, dur = self._acquire(ccd, processor)
+            results = gscanner.GetSpotResults()
+            self.assertEqual(len(results), len(spots))
+            self.assertEqual(len(processed), len(spots))
+            for im, p, r in zip(spots, processed, results):
+                self.assertIs(p, im)
+                self.assertEqual(r, (im.metadata[model.MD_ACQ_DATE], im.shape))
+            # Executor is stopped after the acquisition
+            self.assertIsNone(gscanner._executor)
+
+    def test_spot_processor_error(self):
+        """
+        An error in the spot_processor is reported by GetSpotResults()
+        """
+        def processor(im):
+            raise ValueError("Failed to process")
+
+        gscanner, spots, dur = self._acquire(self.ccd, processor)
+        with self.assertRaises(ValueError):
+            gscanner.GetSpotResults()
+
+    def test_cancel(self):
+        """
+        Cancelling stops the acquisition and the processing of the spots not
+        yet processed
+        """
+        processing = threading.Event()
+        nprocessed = [0]
+        def slow_processor(im):
+            processing.set()
+            time.sleep(0.5)
+            nprocessed[0] += 1
+            return im.shape
+
+        # Many spots, so that the acquisition is still running when cancelled
+        rep = (8, 8)
+        gscanner = images.GridScanner(rep, DWELL_TIME, self.ebeam,
+                                      self.ccd, self.sed,
+                                      spot_processor=slow_processor)
+        exc = []
+        def acquire():
+            try:
+                gscanner.DoAcquisition()
+            except Exception as ex:
+                exc.append(ex)
+
+        acq_thread = threading.Thread(target=acquire)
+        acq_thread.start()
+        self.assertTrue(processing.wait(30))
+        # Let some spot images queue up behind the slow processor
+        tend = time.time() + 30
+        while len(gscanner._spot_results) < 3 and time.time() < tend:
+            time.sleep(0.01)
+        self.assertTrue(gscanner.CancelAcquisition())
+        acq_thread.join(30)
+        self.assertFalse(acq_thread.isAlive())
+
+        self.assertEqual(len(exc), 1)
+        self.assertIsInstance(exc[0], CancelledError)
+        nspots = numpy.prod(rep)
+        self.assertLess(len(gscanner._spot_images), nspots)
+        # The queued processing is cancelled
+        self.assertTrue(any(f.cancelled() for f in gscanner._spot_results))
+        time.sleep(1) # the spot being processed can still finish
+        self.assertLess(nprocessed[0], len(gscanner._spot_results))
+
+    def test_speed(self):
+        """
+        Compare the duration with and without software trigger
+        """
+        # Once first, to be sure the hardware is in the same state for both
+        self._acquire(self.ccd)
+
+        # Best of 2, to reduce the noise
+        dur_trigger = min(self._acquire(self.ccd)[2] for i in range(2))
+        dur_sub = min(self._acquire(NoTriggerCCD(self.ccd))[2] for i in range(2))
+        # On the fake CCD, starting an acquisition is cheap, so the gain is
+        # small, and too dependent on the load of the computer to be checked
+        logging.info("Grid of %s spots scanned in %g s with software trigger, "
+                     "and %g s with subscription per spot",
+                     REPETITIONS, dur_trigger, dur_sub)
+
+    def test_stale_image(self):
+        """
+        An image acquired before the spot was requested, or after the image of
+        the spot was received, is discarded
+        """
+        gscanner = images.GridScanner(REPETITIONS, DWELL_TIME, self.ebeam,
+                                      self.ccd, self.sed)
+        now = time.time()
+        old_im = model.DataArray(numpy.zeros((4, 4), dtype=numpy.uint16),
+                                 {model.MD_ACQ_DATE: now - 1})
+        new_im = model.DataArray(numpy.zeros((4, 4), dtype=numpy.uint16),
+                                 {model.MD_ACQ_DATE: now + 0.1})
+
+        gscanner._spot_start = now
+        gscanner._onSpotImage(self.ccd.data, old_im)
+        self.assertFalse(gscanner._ccd_done.is_set())
+        self.assertEqual(gscanner._spot_images, [])
+
+        gscanner._onSpotImage(self.ccd.data, new_im)
+        self.assertTrue(gscanner._ccd_done.is_set())
+        self.assertEqual(len(gscanner._spot_images), 1)
+        self.assertIs(gscanner._spot_images[0], new_im)
+
+        # Only one image per spot
+        gscanner._onSpotImage(self.ccd.data, new_im)
+        self.assertEqual(len(gscanner._spot_images), 1)
+
+
+class TestIsolateSpot(unittest.TestCase):
+    """
+    Test the processing of each spot image of FindOverlay
+    """
+
+    def test_one_spot(self):
+        y, x = numpy.mgrid[0:200, 0:200]
+        im = 1000 * numpy.exp(-((x - 120) ** 2 + (y - 80) ** 2) / (2 * 3 ** 2)) + 100
+        im = model.DataArray(im.astype(numpy.uint16))
+
+        subimage, coord = find_overlay._IsolateSpot(im)
+        self.assertAlmostEqual(coord[0], 120, delta=1)
+        self.assertAlmostEqual(coord[1], 80, delta=1)
+        # The spot is at the center of the subimage
+        maxpos = numpy.unravel_index(subimage.argmax(), subimage.shape)
+        for p, s in zip(maxpos, subimage.shape):
+            self.assertAlmostEqual(p, s / 2, delta=1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -25,15 +25,19 @@ from __future__ import division
 import itertools
 import logging
 import numpy
+from odemis import model
 import threading
 import math
 
-from .calculation import CalculateDrift
+from .calculation import CalculateDrift, DriftCalculator
 from .dc_region import GuessAnchorRegion
+from .registration import RegisterStack
 
 
 MIN_RESOLUTION = (20, 20) # seems 10x10 sometimes work, but let's not tent it
 MAX_PIXELS = 128 ** 2 # px 
+# Drift estimations with a lower confidence are considered failed, and ignored
+MIN_CONFIDENCE = 0.1
 
 class AnchoredEstimator(object):
     """
@@ -43,7 +47,9 @@ class AnchoredEstimator(object):
     
     To use, call .acquire() periodically (and preferably at specific places of 
     the global acquire, such as at the beginning of a line), and call .estimate()
-    to measure the drift.
+    to measure the drift. Alternatively, call .estimateAsync() to compute the
+    drift in a separate thread while the global acquisition goes on. In such
+    case, call .close() once the estimator is not used anymore.
     """
     def __init__(self, scanner, detector, region, dwell_time):
         """
@@ -57,8 +63,15 @@ class AnchoredEstimator(object):
         self._dwell_time = dwell_time
         self.orig_drift = (0, 0)
         self.max_drift = (0, 0)
+        self.confidence = 1 # confidence of the last drift estimation (0->1)
         self.raw = [] # all the anchor areas acquired (in order)
         self._acq_sem_complete = threading.Event()
+        self._executor = None # to run the drift computation in the background
+        self._est_future = None # last estimation started in the background
+        # Drift calculators with the first and the last anchor area as reference
+        # (to only compute the FFT of each anchor area once)
+        self._first_calc = None
+        self._last_calc = None
 
         # Calculate initial translation for anchor region acquisition
         self._roi = region
@@ -108,6 +121,9 @@ class AnchoredEstimator(object):
         """
         Scan the anchor area
         """
+        # The position of the anchor depends on the latest drift estimated
+        self._waitEstimation()
+
         # Save current SEM settings
         cur_dwell_time = self._emitter.dwellTime.value
         cur_scale = self._emitter.scale.value
@@ -135,26 +151,118 @@ class AnchoredEstimator(object):
         """
         return (float, float): estimated current drift in X/Y SEM px
         """
-        # Calculate the drift between the last two frames and
-        # between the last and first frame
+        self._waitEstimation()
         if len(self.raw) > 1:
-            prev_drift = CalculateDrift(self.raw[-2],
-                                        self.raw[-1], 10)
-            self.orig_drift = CalculateDrift(self.raw[0],
-                                             self.raw[-1], 10)
-
-            logging.debug("Current drift: %s", self.orig_drift)
-            logging.debug("Previous frame diff: %s", prev_drift)
-            if (abs(self.orig_drift[0] - prev_drift[0]) > 5 or
-                abs(self.orig_drift[1] - prev_drift[1]) > 5):
-                logging.warning("Drift cannot be measured precisely, "
-                                "hesitating between %s and %s px",
-                                 self.orig_drift, prev_drift)
-            # Update max_drift
-            if abs(numpy.prod(self.orig_drift)) > abs(numpy.prod(self.max_drift)):
-                self.max_drift = self.orig_drift
+            self._computeDrift(self.raw[0], self.raw[-2], self.raw[-1])
         return self.orig_drift
-    
+
+    def estimateAsync(self):
+        """
+        Start the estimation of the drift based on the anchor areas acquired so
+        far, in a separate thread. The next call to .acquire() or .estimate()
+        waits for the estimation to be finished.
+        return (Future): its result is the same as the return value of
+          .estimate()
+        """
+        self._waitEstimation()
+        if self._executor is None:
+            self._executor = model.CancellableThreadPoolExecutor(max_workers=1)
+
+        if len(self.raw) > 1:
+            # Pass the frames explicitly, as .raw may be extended meanwhile
+            f = self._executor.submit(self._computeDrift,
+                                      self.raw[0], self.raw[-2], self.raw[-1])
+        else:
+            f = self._executor.submit(lambda: self.orig_drift)
+        self._est_future = f
+        return f
+
+    def close(self):
+        """
+        Stop the background thread used by .estimateAsync() (if any)
+        """
+        if self._executor is not None:
+            self._executor.cancel()
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._est_future = None
+
+    def _waitEstimation(self):
+        """
+        Wait for the estimation started by .estimateAsync() to be finished
+        """
+        f = self._est_future
+        if f is not None:
+            self._est_future = None
+            try:
+                f.result()
+            except Exception:
+                logging.exception("Failed to estimate the drift")
+
+    def _computeDrift(self, first, prev, last):
+        """
+        Calculate the drift between the last two frames and between the last
+        and first frame. Updates .orig_drift and .max_drift.
+        first (DataArray): first anchor area acquired
+        prev (DataArray): anchor area acquired before the last one
+        last (DataArray): last anchor area acquired
+        return (float, float): estimated current drift in X/Y SEM px
+        """
+        if self._first_calc is None or self._first_calc.reference is not first:
+            self._first_calc = DriftCalculator(first, 10)
+        last_fft = self._first_calc.transform(last)
+        orig_drift, self.confidence = self._first_calc.calculateMultiScale(last, last_fft)
+
+        # The previous anchor area was normally the last one of the previous call
+        if self._last_calc is None or self._last_calc.reference is not prev:
+            self._last_calc = DriftCalculator(prev, 10)
+        prev_drift, prev_conf = self._last_calc.calculateMultiScale(last, last_fft)
+        self._last_calc = DriftCalculator(last, 10, last_fft)
+
+        logging.debug("Current drift: %s (confidence = %g)", orig_drift, self.confidence)
+        logging.debug("Previous frame diff: %s (confidence = %g)", prev_drift, prev_conf)
+        if self.confidence < MIN_CONFIDENCE:
+            # Better not correct than correct wrongly
+            logging.warning("Drift estimation failed (confidence = %g), "
+                            "keeping previous drift %s", self.confidence,
+                            self.orig_drift)
+            return self.orig_drift
+
+        self.orig_drift = orig_drift
+        if (abs(self.orig_drift[0] - prev_drift[0]) > 5 or
+            abs(self.orig_drift[1] - prev_drift[1]) > 5):
+            logging.warning("Drift cannot be measured precisely, "
+                            "hesitating between %s and %s px",
+                             self.orig_drift, prev_drift)
+        # Update max_drift
+        if abs(numpy.prod(self.orig_drift)) > abs(numpy.prod(self.max_drift)):
+            self.max_drift = self.orig_drift
+        return self.orig_drift
+
+    def getState(self):
+        """
+        return (dict): the drift measured so far, which allows to continue the
+          drift correction later, with .setState()
+        """
+        self._waitEstimation()
+        return {"orig_drift": self.orig_drift,
+                "max_drift": self.max_drift,
+                "trans": self._trans}
+
+    def setState(self, state, raw):
+        """
+        Continue the drift correction of a previous acquisition
+        state (dict): as returned by .getState()
+        raw (list of DataArrays): the anchor areas acquired previously (in order)
+        """
+        self._waitEstimation()
+        self.orig_drift = state["orig_drift"]
+        self.max_drift = state["max_drift"]
+        self._trans = state["trans"]
+        self.raw = list(raw)
+        self._first_calc = None
+        self._last_calc = None
+
     def estimateAcquisitionTime(self):
         """
         return (float): estimated time to acquire 1 anchor area
@@ -29,6 +29,10 @@ import math
 from numpy import arange
 from numpy import fft
 
+# Minimum size (in px) of the smallest side of the block-averaged images used
+# for the coarse estimation of the multi-scale drift calculation
+MIN_PYRAMID_SIZE = 32
+
 def CalculateDrift(previous_img, current_img, precision=1):
     """
     Given two images, it calculates the drift in x and y axis. It first computes
@@ -45,80 +49,214 @@ def CalculateDrift(previous_img, current_img, precision=1):
     precision (1<=int): Calculate drift within 1/precision of a pixel
     returns (tuple of floats): Drift in pixels
     """
-    if precision < 1:
-        raise ValueError("Precision cannot be less than 1, got %s." % (precision,))
-    assert previous_img.shape == current_img.shape
+    return DriftCalculator(previous_img, precision).calculate(current_img)
 
-    previous_fft = fft.fft2(previous_img)
-    current_fft = fft.fft2(current_img)
-    (m, n) = previous_fft.shape
 
-    if precision == 1:
-        # Cross-correlation computation
-        CC = fft.ifft2(previous_fft * current_fft.conj())
-
-        # Locate the peak
-        ACC = abs(CC)
-        loc1 = ACC.argmax(0)
-        max1 = ACC[(loc1, range(ACC.shape[1]))]
-        loc2 = max1.argmax(0)
-
-        rloc = loc1[loc2]
-        cloc = loc2
-
-        # Calculate shift from the peak
-        md2 = numpy.fix(m / 2)
-        nd2 = numpy.fix(n / 2)
-        if rloc > md2:
-            row_shift = rloc - m
-        else:
-            row_shift = rloc
+def CalculateDriftMultiScale(previous_img, current_img, precision=1):
+    """
+    Same as CalculateDrift(), but the drift is first estimated on
+    block-averaged images, and then refined at full resolution only around
+    this estimation. It is faster on large images, and more robust to noise.
+    previous_img (numpy.array): 2d array with the previous frame
+    current_img (numpy.array): 2d array with the last frame, must be of same
+      shape as previous_img
+    precision (1<=int): Calculate drift within 1/precision of a pixel
+    returns:
+      (tuple of floats): Drift in pixels
+      (0<=float<=1): confidence of the estimation (see
+        DriftCalculator.calculateMultiScale())
+    """
+    return DriftCalculator(previous_img, precision).calculateMultiScale(current_img)
 
-        if cloc > nd2:
-            col_shift = cloc - n
-        else:
-            col_shift = cloc
 
-    else:
-        mlarge, nlarge = m * 2, n * 2
+class DriftCalculator(object):
+    """
+    Calculates the drift of images compared to the same reference image (see
+    CalculateDrift()). The Fourier transform of the reference image is computed
+    only once, so each new image only costs one (real) FFT and the subpixel
+    refinement.
+    The images are considered real. As the FFT of a real image is symmetric,
+    only half of it is computed and used.
+    Not thread-safe: the work arrays are shared between the calls.
+    """
+    def __init__(self, reference, precision=1, reference_fft=None):
+        """
+        reference (numpy.array): 2d array with the reference frame
+        precision (1<=int): Calculate drift within 1/precision of a pixel
+        reference_fft (None or numpy.array): the Fourier transform of the
+          reference, as returned by .transform(), if it is already known.
+        """
+        if precision < 1:
+            raise ValueError("Precision cannot be less than 1, got %s." % (precision,))
+        if reference.ndim != 2:
+            raise ValueError("Reference must be a 2D image, got shape %s" % (reference.shape,))
+        self.reference = reference
+        self.precision = precision
+        self.shape = reference.shape
+        m, n = self.shape
+
+        if reference_fft is None:
+            reference_fft = self.transform(reference)
+        elif reference_fft.shape != (m, n // 2 + 1):
+            raise ValueError("Reference FFT has shape %s while expected %s" %
+                             (reference_fft.shape, (m, n // 2 + 1)))
+        self.reference_fft = reference_fft
+        self._reference_fft_conj = reference_fft.conj()
+        self._coarse_calc = None # calculator on the block-averaged images
+
+        # Work arrays
+        self._prod = numpy.empty(reference_fft.shape, dtype=numpy.complex128)
+        if precision > 1:
+            # Half spectrum of the cross-correlation upsampled by 2
+            self._large = numpy.zeros((2 * m, n + 1), dtype=numpy.complex128)
+
+        # Frequency of each row and column (of the half spectrum)
+        self._freq_r = fft.ifftshift(arange(m)) - m // 2
+        freq_c = arange(n // 2 + 1)
+        # Each column (but the 0th and the Nyquist frequency) also
+        # represents its symmetric (negative) column
+        weight_c = numpy.full(n // 2 + 1, 2.0)
+        weight_c[0] = 1
+        if n % 2 == 0:
+            freq_c[-1] = -(n // 2)
+            weight_c[-1] = 1
+        self._freq_c = freq_c
+        self._weight_c = weight_c
+
+    def transform(self, img):
+        """
+        Compute the Fourier transform of an image, in the format needed by
+        .calculate()
+        img (numpy.array): 2d array of the same shape as the reference
+        returns (numpy.array of complex): half of the spectrum
+        """
+        if img.shape != self.shape:
+            raise ValueError("Image has shape %s while expected %s" % (img.shape, self.shape))
+        if numpy.iscomplexobj(img):
+            img = img.real
+        return fft.rfft2(img)
+
+    def calculate(self, current_img, current_fft=None):
+        """
+        Calculates the drift between the reference and the given image
+        current_img (numpy.array): 2d array with the last frame, must be of same
+          shape as the reference
+        current_fft (None or numpy.array): the Fourier transform of the image,
+          as returned by .transform(), if it is already known.
+        returns (tuple of floats): Drift in pixels
+        """
+        if current_fft is None:
+            current_fft = self.transform(current_img)
+        (m, n) = self.shape
+        precision = self.precision
+
+        # Cross-power spectrum
+        prod = numpy.multiply(self.reference_fft, current_fft.conj(), out=self._prod)
+
+        if precision == 1:
+            # Cross-correlation computation
+            CC = fft.irfft2(prod, s=(m, n))
+            row_shift, col_shift = _FindShift(CC)
+            return col_shift, row_shift
 
         # Upsample by factor of 2 to obtain initial estimation and
         # embed Fourier data in a 2x larger array
-        CC = numpy.zeros((mlarge, nlarge), dtype=numpy.complex)
-        CC[m - numpy.fix(m / 2):m + 1 + numpy.fix((m - 1) / 2),
-           n - numpy.fix(n / 2):n + 1 + numpy.fix((n - 1) / 2)] = \
-				fft.fftshift(previous_fft) * fft.fftshift(current_fft).conj()
+        large = self._large
+        hm = (m - 1) // 2 + 1 # number of non-negative frequencies
+        large[:hm, :n // 2 + 1] = prod[:hm]
+        large[2 * m - m // 2:, :n // 2 + 1] = prod[hm:]
+        if n % 2 == 0:
+            # The Nyquist frequency was only counted once
+            large[:, n // 2] *= 0.5
 
         # Cross-correlation computation
-        CC = fft.ifft2(fft.ifftshift(CC))
-
-        # Locate the peak
-        ACC = abs(CC)
-        loc1 = ACC.argmax(0)
-        max1 = ACC[(loc1, range(ACC.shape[1]))]
-        loc2 = max1.argmax(0)
-
-        rloc = loc1[loc2]
-        cloc = loc2
-       
-        # Calculate shift in previous pixel grid from the position of the peak
-        (m, n) = CC.shape
-        md2 = numpy.fix(m / 2)
-        nd2 = numpy.fix(n / 2)
-
-        if rloc > md2:
-            row_shift = rloc - m
-        else:
-            row_shift = rloc
-
-        if cloc > nd2:
-            col_shift = cloc - n
-        else:
-            col_shift = cloc
-
+        CC = fft.irfft2(large, s=(2 * m, 2 * n))
+        row_shift, col_shift = _FindShift(CC)
         row_shift = row_shift / 2
         col_shift = col_shift / 2
 
+        row_shift, col_shift, _ = self._refine(prod, row_shift, col_shift)
+        return col_shift, row_shift
+
+    def calculateMultiScale(self, current_img, current_fft=None):
+        """
+        Calculates the drift between the reference and the given image, using
+        first block-averaged images, to find the approximate drift, and then
+        refining it at full resolution.
+        current_img (numpy.array): 2d array with the last frame, must be of same
+          shape as the reference
+        current_fft (None or numpy.array): the Fourier transform of the image,
+          as returned by .transform(), if it is already known.
+        returns:
+          (tuple of floats): Drift in pixels
+          (0<=float<=1): confidence of the estimation. It is the correlation
+            coefficient between the reference and the image shifted back by
+            the drift. It is typically > 0.5 for a reliable estimation, and
+            close to 0 if the images have nothing in common.
+        """
+        if current_fft is None:
+            current_fft = self.transform(current_img)
+        (m, n) = self.shape
+        prod = numpy.multiply(self.reference_fft, current_fft.conj(), out=self._prod)
+
+        # Coarse estimation, on images small enough to be fast
+        scale = 1
+        while min(m, n) // (scale * 2) >= MIN_PYRAMID_SIZE:
+            scale *= 2
+        if scale == 1:
+            row_shift, col_shift = _FindShift(fft.irfft2(prod, s=(m, n)))
+        else:
+            if self._coarse_calc is None:
+                self._coarse_calc = DriftCalculator(_BlockAverage(self.reference, scale))
+            col_shift, row_shift = self._coarse_calc.calculate(_BlockAverage(current_img, scale))
+            row_shift *= scale
+            col_shift *= scale
+        logging.debug("Coarse drift estimation at scale %d: %s", scale, (col_shift, row_shift))
+
+        # Find the pixel precise shift, within the uncertainty of the coarse
+        # estimation
+        win = 2 * scale + 1
+        CC = self._UpsampledDFT(prod.conj(), win, win,
+                                scale - row_shift, scale - col_shift, 1)
+        rloc, cloc = numpy.unravel_index(abs(CC).argmax(), CC.shape)
+        row_shift += rloc - scale
+        col_shift += cloc - scale
+        peak = CC[rloc, cloc]
+
+        if self.precision > 1:
+            row_shift, col_shift, peak = self._refine(prod, row_shift, col_shift)
+        else:
+            if m // 2 == 1:
+                row_shift = 0
+            if n // 2 == 1:
+                col_shift = 0
+
+        # The DFT at the peak is the (non-normalized) cross-correlation. Remove
+        # the mean of the images (= the DC component) and normalize.
+        img = current_img.real if numpy.iscomplexobj(current_img) else current_img
+        ref = self.reference.real if numpy.iscomplexobj(self.reference) else self.reference
+        norm = (m * n) ** 2 * numpy.std(ref) * numpy.std(img)
+        if norm == 0: # flat image => no way to know
+            confidence = 0
+        else:
+            confidence = (peak - prod[0, 0].real) / norm
+            confidence = min(max(0, confidence), 1)
+
+        return (col_shift, row_shift), confidence
+
+    def _refine(self, prod, row_shift, col_shift):
+        """
+        Refine the drift to the precision, using an upsampled DFT
+        prod (numpy.array): the cross-power spectrum (half spectrum)
+        row_shift, col_shift (floats): the drift, with an accuracy of 0.5 px
+        returns:
+          row_shift, col_shift (floats): the drift at the precision
+          peak (float): the value of the (non-normalized) cross-correlation
+            at the drift
+        """
+        (m, n) = self.shape
+        precision = self.precision
+
         # DFT computation
         # Initial shift estimation in upsampled grid
         row_shift = numpy.round(row_shift * precision) / precision
@@ -126,23 +264,15 @@ def CalculateDrift(previous_img, current_img, precision=1):
         dft_shift = numpy.fix(numpy.ceil(precision * 1.5) / 2)  # Center of output at dft_shift+1
 
         # Matrix multiply DFT around the current shift estimation
-        CC = (_UpsampledDFT(current_fft * previous_fft.conj(),
-                            numpy.ceil(precision * 1.5),
-                            numpy.ceil(precision * 1.5),
-                            precision,
-                            dft_shift - row_shift * precision,
-                            dft_shift - col_shift * precision)
-              ) / (md2 * nd2 * (precision ** 2))
-        # was .conj(), but as we just need the abs(), it's not needed
+        # (current_fft * previous_fft.conj() == prod.conj())
+        size = int(numpy.ceil(precision * 1.5))
+        CC = self._UpsampledDFT(prod.conj(), size, size,
+                                dft_shift - row_shift * precision,
+                                dft_shift - col_shift * precision)
 
         # Locate maximum and map back to original pixel grid
-        ACC = abs(CC)
-        loc1 = ACC.argmax(0)
-        max1 = ACC[(loc1, range(ACC.shape[1]))]
-        loc2 = max1.argmax(0)
-
-        rloc = loc1[loc2]
-        cloc = loc2
+        rloc, cloc = numpy.unravel_index(abs(CC).argmax(), CC.shape)
+        peak = CC[rloc, cloc]
 
         rloc -= dft_shift
         cloc -= dft_shift
@@ -150,33 +280,76 @@ def CalculateDrift(previous_img, current_img, precision=1):
         row_shift += rloc / precision
         col_shift += cloc / precision
 
-        if md2 == 1:
+        if m // 2 == 1:
             row_shift = 0
-        if nd2 == 1:
+        if n // 2 == 1:
             col_shift = 0
 
-    return col_shift, row_shift
+        return row_shift, col_shift, peak
+
+    def _UpsampledDFT(self, data, nor, noc, roff=0, coff=0, precision=None):
+        """
+        Upsampled DFT by matrix multiplies.
+        data (numpy.array): half spectrum, as returned by rfft2
+        nor, noc (ints): Number of pixels in the output upsampled DFT, in units
+        of upsampled pixels
+        roff, coff (floats): Row and column offsets, allow to shift the output array
+                        to a region of interest on the DFT
+        precision (None or 1<=int): upsampling factor, default is the precision
+          of the calculator
+        returns (numpy.array of floats): the upsampled DFT (which is real)
+        """
+        nr, nc = self.shape
+        if precision is None:
+            precision = self.precision
+
+        # Compute kernels and obtain DFT by matrix products
+        kernc = numpy.exp((-2j * math.pi / (nc * precision)) *
+                          (arange(noc) - coff)[:, None] * self._freq_c[None, :])
+        kernr = numpy.exp((-2j * math.pi / (nr * precision)) *
+                          (arange(nor) - roff)[:, None] * self._freq_r[None, :])
+
+        # As the data comes from real images, the DFT of the whole spectrum is
+        # real: the negative columns just double the real part.
+        dft = numpy.dot(numpy.dot(kernr, data * self._weight_c), kernc.T)
+        return dft.real
+
+
+def _BlockAverage(img, scale):
+    """
+    Reduce the size of an image by averaging blocks of pixels
+    img (numpy.array): 2d array
+    scale (1<=int): size of the (square) blocks
+    returns (numpy.array of floats): the image with a shape divided by scale.
+      If the shape is not a multiple of scale, the last pixels are dropped.
+    """
+    if numpy.iscomplexobj(img):
+        img = img.real
+    if scale == 1:
+        return img
+    m, n = img.shape[0] // scale, img.shape[1] // scale
+    blocks = img[:m * scale, :n * scale].reshape(m, scale, n, scale)
+    return blocks.mean(axis=3).mean(axis=1)
 
 
-def _UpsampledDFT(data, nor, noc, precision=1, roff=0, coff=0):
+def _FindShift(CC):
     """
-    Upsampled DFT by matrix multiplies. 
-    data (numpy.array): 2d array 
-    nor, noc (ints): Number of pixels in the output upsampled DFT, in units
-    of upsampled pixels
-    precision (int): Calculate drift within 1/precision of a pixel
-    roff, coff (ints): Row and column offsets, allow to shift the output array
-                    to a region of interest on the DFT 
-    returns (tuple of floats): Drift in pixels
+    Locate the peak of a cross-correlation
+    CC (numpy.array): 2d array with the cross-correlation
+    returns (ints): row and column shift corresponding to the peak
     """
-    z = 1j  # imaginary unit
-    nr, nc = data.shape
+    m, n = CC.shape
+    rloc, cloc = numpy.unravel_index(abs(CC).argmax(), CC.shape)
 
-    # Compute kernels and obtain DFT by matrix products
-    kernc = numpy.power(math.e, (-z * 2 * math.pi / (nc * precision)) * ((fft.ifftshift((arange(0, nc)))[:, None]).transpose() \
-                                - numpy.floor(nc / 2)) * (arange(0, noc) - coff)[:, None])
+    # Calculate shift from the peak
+    if rloc > m // 2:
+        row_shift = rloc - m
+    else:
+        row_shift = rloc
 
-    kernr = numpy.power(math.e, (-z * 2 * math.pi / (nr * precision)) * ((fft.ifftshift(arange(0, nr)))[:, None] \
-                                - numpy.floor(nr / 2)) * ((arange(0, nor)[:, None]).transpose() - roff))
+    if cloc > n // 2:
+        col_shift = cloc - n
+    else:
+        col_shift = cloc
 
-    return numpy.dot(numpy.dot((kernr.transpose()), data), kernc.transpose())
+    return row_shift, col_shift
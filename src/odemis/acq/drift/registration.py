@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 19 Oct 2026
+
+@author: agent
+
+Copyright © 2026 agent
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the
+terms  of the GNU General Public License version 2 as published by the Free
+Software  Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY;  without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR  PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Odemis. If not, see http://www.gnu.org/licenses/.
+"""
+
+# Registration of a stack of images (eg, a time-lapse), to compensate for the
+# drift between the frames.
+
+from __future__ import division
+
+import collections
+from concurrent.futures.thread import ThreadPoolExecutor
+import logging
+import math
+import multiprocessing
+import numpy
+from numpy import fft
+from odemis import model
+from odemis.util import img
+import threading
+
+from .calculation import DriftCalculator
+
+
+def RegisterStack(images, reference=0, precision=10, running_mean=False,
+                  average=False, min_confidence=0.1, nthreads=None):
+    """
+    Calculates the drift of each image of a stack compared to a reference.
+    The Fourier transform of each image is computed only once, and the images
+    are processed in parallel.
+    images (list of DataArrays or numpy.arrays): the frames, all 2D (or with
+      all the dimensions but the last 2 of size 1) and of the same shape.
+    reference (int): index of the frame used as reference
+    precision (1<=int): Calculate drift within 1/precision of a pixel
+    running_mean (bool): if True, each frame is registered against the mean of
+      all the frames already aligned (starting from the reference, and in
+      order), instead of only the reference frame. It's more robust to noise
+      and slow changes of the sample, but the frames cannot be processed in
+      parallel.
+    average (bool): if True, also compute the average of all the frames after
+      alignment.
+    min_confidence (0<=float<=1): frames registered with a lower confidence
+      are not included in the average (nor in the running mean)
+    nthreads (None or 0<int): number of threads to use. None means as many
+      as CPUs available.
+    returns:
+      shifts (list of tuples of floats): for each frame, its drift in pixels
+        (X, Y), as returned by CalculateDrift(). To align it on the reference,
+        the frame must be shifted by the opposite.
+      confidences (list of 0<=floats<=1): for each frame, the confidence of the
+        registration (see DriftCalculator.calculateMultiScale())
+      average (None or DataArray of float): the average of the aligned frames,
+        with the metadata of the reference frame. Near the borders, each pixel
+        is the average of only the frames which cover it. None if average is
+        False.
+    raises ValueError: if the frames have different shapes
+    """
+    frames = [img.ensure2DImage(im) for im in images]
+    if not frames:
+        raise ValueError("No image to register")
+    if not 0 <= reference < len(frames):
+        raise IndexError("Reference %d is not in the stack of %d images" %
+                         (reference, len(frames)))
+    shape = frames[reference].shape
+    for i, f in enumerate(frames):
+        if f.shape != shape:
+            raise ValueError("Image %d has shape %s, while reference has shape %s"
+                             % (i, f.shape, shape))
+
+    ref_calc = DriftCalculator(frames[reference], precision)
+    shifts = [None] * len(frames)
+    confidences = [None] * len(frames)
+    # Sum of the aligned frames, and number of frames summed in each pixel (as
+    # the borders of the frames are not all valid after alignment)
+    acc = numpy.array(frames[reference], dtype=numpy.float64)
+    acc_count = numpy.ones(shape, dtype=numpy.int32)
+    nacc = 1
+    shifts[reference] = (0, 0)
+    confidences[reference] = 1
+
+    # Order in which the frames are processed
+    order = range(reference + 1, len(frames)) + range(reference - 1, -1, -1)
+
+    if running_mean:
+        calc = ref_calc
+        for i in order:
+            if nacc > 1:
+                # New reference: the mean of all the aligned frames
+                calc = DriftCalculator(acc / acc_count, precision)
+            frame_fft = calc.transform(frames[i])
+            shifts[i], confidences[i] = calc.calculateMultiScale(frames[i], frame_fft)
+            if _checkConfidence(i, confidences[i], min_confidence):
+                _AccumulateFrame(acc, acc_count,
+                                 _ShiftImage(frame_fft, shifts[i], shape))
+                nacc += 1
+    else:
+        if nthreads is None:
+            nthreads = multiprocessing.cpu_count()
+        # The work arrays of the calculators cannot be shared between threads,
+        # but the spectrum of the reference can.
+        local = threading.local()
+        def register(i):
+            if not hasattr(local, "calc"):
+                local.calc = DriftCalculator(frames[reference], precision,
+                                             ref_calc.reference_fft)
+            frame_fft = local.calc.transform(frames[i])
+            shift, conf = local.calc.calculateMultiScale(frames[i], frame_fft)
+            if average:
+                shifted = _ShiftImage(frame_fft, shift, shape)
+            else:
+                shifted = None
+            return shift, conf, shifted
+
+        executor = ThreadPoolExecutor(max_workers=nthreads)
+        try:
+            # Only a few frames in advance, to keep the memory usage bounded
+            todo = collections.deque(order)
+            queue = collections.deque()
+            while todo or queue:
+                while todo and len(queue) < 2 * nthreads:
+                    i = todo.popleft()
+                    queue.append((i, executor.submit(register, i)))
+                i, f = queue.popleft()
+                shifts[i], confidences[i], shifted = f.result()
+                if average and _checkConfidence(i, confidences[i], min_confidence):
+                    _AccumulateFrame(acc, acc_count, shifted)
+                    nacc += 1
+        finally:
+            executor.shutdown(wait=False)
+
+    logging.debug("Registered %d frames: %s", len(frames), shifts)
+
+    if average:
+        # The reference is valid everywhere, so each pixel has at least one frame
+        avg = acc / acc_count
+        md = getattr(frames[reference], "metadata", {})
+        avg = model.DataArray(avg, md.copy())
+        avg.metadata[model.MD_DESCRIPTION] = "%s (average of %d aligned frames)" % (
+                           md.get(model.MD_DESCRIPTION, "Stack"), nacc)
+    else:
+        avg = None
+
+    return shifts, confidences, avg
+
+
+def _checkConfidence(i, confidence, min_confidence):
+    """
+    return (bool): True if the confidence is good enough
+    """
+    if confidence < min_confidence:
+        logging.warning("Registration of frame %d failed (confidence = %g), "
+                        "it will be ignored", i, confidence)
+        return False
+    return True
+
+
+def _ShiftSpectrum(img_fft, shift, shape):
+    """
+    Shift an image in the Fourier domain, by the opposite of its drift
+    img_fft (numpy.array of complex): the half spectrum of the image, as
+      returned by rfft2
+    shift (float, float): the drift in pixels (X, Y)
+    shape (int, int): the shape of the image
+    returns (numpy.array of complex): the half spectrum of the shifted image
+    """
+    m, n = shape
+    freq_r = fft.fftfreq(m)
+    freq_c = fft.rfftfreq(n)
+    # Subpixel shift is possible thanks to the phase ramp
+    phase_r = numpy.exp(-2j * math.pi * freq_r * shift[1])
+    phase_c = numpy.exp(-2j * math.pi * freq_c * shift[0])
+    return img_fft * phase_r[:, None] * phase_c[None, :]
+
+
+def _ShiftImage(img_fft, shift, shape):
+    """
+    Shift an image by the opposite of its drift (with subpixel precision)
+    img_fft (numpy.array of complex): the half spectrum of the image, as
+      returned by rfft2
+    shift (float, float): the drift in pixels (X, Y)
+    shape (int, int): the shape of the image
+    returns:
+      shifted (numpy.array of float): the shifted image
+      valid (numpy.array of bool): True for the pixels of the shifted image
+        which come from the image. The shift in the Fourier domain is circular,
+        so the pixels on the border opposite to the shift contain the content
+        which has been shifted out on the other border.
+    """
+    shifted = fft.irfft2(_ShiftSpectrum(img_fft, shift, shape), s=shape)
+    valid = numpy.ones(shape, dtype=numpy.bool)
+    for axis, s in ((1, shift[0]), (0, shift[1])):
+        # Any partial pixel shift also mixes the wrapped content into the
+        # border pixel (but ignore the tiny imprecisions of the drift)
+        nb = min(int(math.ceil(round(abs(s), 3))), shape[axis])
+        if nb == 0:
+            continue
+        border = [slice(None), slice(None)]
+        border[axis] = slice(None, nb) if s > 0 else slice(-nb, None)
+        valid[tuple(border)] = False
+    return shifted, valid
+
+
+def _AccumulateFrame(acc, count, shifted):
+    """
+    Add the valid pixels of an aligned frame to the sum of the frames
+    acc (numpy.array of float): sum of the frames, updated
+    count (numpy.array of int): number of frames summed for each pixel, updated
+    shifted (numpy.array, numpy.array of bool): the aligned frame and its
+      valid pixels, as returned by _ShiftImage()
+    """
+    im, valid = shifted
+    acc[valid] += im[valid]
+    count += valid
@@ -202,5 +202,80 @@ class TestDriftCalculation(unittest.TestCase):
         drift = calculation.CalculateDrift(self.small_data, self.small_data_random_drifted_noisy, 10)
         numpy.testing.assert_almost_equal(drift, (self.small_deltac, self.small_deltar), 0)
 
+    def test_calculator(self):
+        """
+        Tests DriftCalculator gives the same drift as CalculateDrift, when
+        reused for several images.
+        """
+        calc = calculation.DriftCalculator(self.data[0], 10)
+        for img, exp_drift, dec in ((self.data[0], (0, 0), 1),
+                                    (self.data_drifted[0], (-3, 5), 0),
+                                    (self.data_random_drifted, (self.deltac, self.deltar), 1),
+                                    (self.data_drifted_noisy, (-3, 5), 0)):
+            drift = calc.calculate(img)
+            numpy.testing.assert_almost_equal(drift, exp_drift, dec)
+            numpy.testing.assert_almost_equal(drift,
+                             calculation.CalculateDrift(self.data[0], img, 10))
+
+        # With the FFT already computed
+        img_fft = calc.transform(self.data_drifted[0])
+        drift = calc.calculate(self.data_drifted[0], img_fft)
+        numpy.testing.assert_almost_equal(drift, (-3, 5), 0)
+        calc2 = calculation.DriftCalculator(self.data_drifted[0], 10, img_fft)
+        drift = calc2.calculate(self.data[0])
+        numpy.testing.assert_almost_equal(drift, (3, -5), 0)
+
+        # Wrong shape
+        with self.assertRaises(ValueError):
+            calc.calculate(self.small_data)
+
+    def test_calculator_odd_shape(self):
+        """
+        Tests DriftCalculator on images with an odd number of pixels
+        """
+        for shape in ((51, 37), (37, 52)):
+            img = self.data[0][300:300 + shape[0], 300:300 + shape[1]]
+            nr, nc = shape
+            deltar, deltac = numpy.random.uniform(-5, 5, 2)
+            Nr = fft.ifftshift(numpy.arange(-numpy.fix(nr / 2), numpy.ceil(nr / 2)))
+            Nc = fft.ifftshift(numpy.arange(-numpy.fix(nc / 2), numpy.ceil(nc / 2)))
+            [Nc, Nr] = numpy.meshgrid(Nc, Nr)
+            drifted = fft.ifft2(fft.fft2(img) * numpy.exp(
+                                2j * math.pi * (deltar * Nr / nr + deltac * Nc / nc)))
+
+            calc = calculation.DriftCalculator(img, 100)
+            drift = calc.calculate(drifted)
+            numpy.testing.assert_almost_equal(drift, (deltac, deltar), 1)
+
+    def test_multiscale(self):
+        """
+        Tests the multi-scale drift calculation gives the same drift as the
+        full resolution one, and a confidence which allows to detect failures.
+        """
+        for img, prec, dec in ((self.data_random_drifted, 10, 1),
+                               (self.data_random_drifted, 100, 2),
+                               (self.data_random_drifted_noisy, 10, 1)):
+            drift, conf = calculation.CalculateDriftMultiScale(self.data[0], img, prec)
+            numpy.testing.assert_almost_equal(drift, (self.deltac, self.deltar), dec)
+            numpy.testing.assert_almost_equal(drift,
+                                 calculation.CalculateDrift(self.data[0], img, prec))
+            self.assertGreater(conf, 0.5)
+
+        # Small images are not block-averaged
+        drift, conf = calculation.CalculateDriftMultiScale(self.small_data,
+                                        self.small_data_random_drifted, 10)
+        numpy.testing.assert_almost_equal(drift, (self.small_deltac, self.small_deltar), 0)
+        self.assertGreater(conf, 0.5)
+
+        # Identical images => perfect confidence
+        drift, conf = calculation.CalculateDriftMultiScale(self.data[0], self.data[0], 10)
+        numpy.testing.assert_almost_equal(drift, (0, 0), 1)
+        self.assertAlmostEqual(conf, 1, 3)
+
+        # Images with nothing in common => no confidence
+        noise = random.normal(0, 3000, self.data[0].shape)
+        drift, conf = calculation.CalculateDriftMultiScale(self.data[0], noise, 10)
+        self.assertLess(conf, 0.1)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 19 Oct 2026
+
+@author: agent
+
+Copyright © 2026 agent
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Odemis. If not, see http://www.gnu.org/licenses/.
+'''
+from __future__ import division
+
+import logging
+import math
+import numpy
+from numpy import fft
+from odemis import model
+from odemis.acq.drift import registration
+from odemis.dataio import hdf5
+import unittest
+
+
+logging.getLogger().setLevel(logging.DEBUG)
+
+
+def shift_image(im, shift):
+    """
+    Shift an image by a subpixel amount (in the same convention as the drift)
+    shift (float, float): X, Y
+    """
+    nr, nc = im.shape
+    Nr = fft.ifftshift(numpy.arange(-numpy.fix(nr / 2), numpy.ceil(nr / 2)))
+    Nc = fft.ifftshift(numpy.arange(-numpy.fix(nc / 2), numpy.ceil(nc / 2)))
+    [Nc, Nr] = numpy.meshgrid(Nc, Nr)
+    return fft.ifft2(fft.fft2(im) * numpy.power(math.e,
+                     2j * math.pi * (shift[1] * Nr / nr + shift[0] * Nc / nc))).real
+
+
+class TestRegisterStack(unittest.TestCase):
+
+    def setUp(self):
+        data = hdf5.read_data("example_input.h5")[0]
+        self.ref = data.reshape(data.shape[-2:])[100:356, 150:406].astype(numpy.float64)
+        self.ref = model.DataArray(self.ref, {model.MD_DESCRIPTION: "SEM",
+                                              model.MD_PIXEL_SIZE: (1e-6, 1e-6)})
+        self.shifts = [(0, 0), (1.5, -2.3), (-10.2, 4.7), (25.4, 30.1), (-3, 0.5)]
+        numpy.random.seed(0)
+        self.stack = []
+        for s in self.shifts:
+            im = shift_image(self.ref, s)
+            im += numpy.random.normal(0, self.ref.std() / 4, im.shape)
+            self.stack.append(im)
+
+    def test_reference(self):
+        for nthreads in (1, 3):
+            shifts, confs, avg = registration.RegisterStack(self.stack, nthreads=nthreads)
+            self.assertIsNone(avg)
+            numpy.testing.assert_allclose(shifts, self.shifts, atol=0.2)
+            for c in confs:
+                self.assertGreater(c, 0.5)
+
+        # Another reference => the shifts are relative to it
+        shifts, confs, avg = registration.RegisterStack(self.stack, reference=2)
+        exp_shifts = numpy.array(self.shifts) - self.shifts[2]
+        numpy.testing.assert_allclose(shifts, exp_shifts, atol=0.2)
+
+    def test_average(self):
+        stack = [model.DataArray(im, {model.MD_DESCRIPTION: "SEM"}) for im in self.stack]
+        shifts, confs, avg = registration.RegisterStack(stack, average=True)
+        self.assertEqual(avg.shape, self.ref.shape)
+        self.assertIn("SEM", avg.metadata[model.MD_DESCRIPTION])
+
+        # Averaging aligned frames reduces the noise => closer to the original
+        # image than any frame (excluding the borders, which are averaged over
+        # fewer frames)
+        err_avg = numpy.std((avg - self.ref)[40:-40, 40:-40])
+        err_first = numpy.std((self.stack[0] - self.ref)[40:-40, 40:-40])
+        self.assertLess(err_avg, err_first * 0.7)
+
+    def test_average_border(self):
+        """
+        The content on a border of a frame doesn't wrap around to the opposite
+        border of the average
+        """
+        # Frames cropped from a larger image, so that the drift brings new
+        # content on the borders (instead of wrapping it around)
+        data = hdf5.read_data("example_input.h5")[0]
+        full = data.reshape(data.shape[-2:])[80:376, 130:426].astype(numpy.float64)
+        m = 20 # margin around the reference
+        # A bright feature on the left border of the reference
+        full[:, m:m + 3] = 3 * full.max()
+        ref = full[m:-m, m:-m]
+        drifts = [(0, 0), (5, -3), (-7, 4), (12, 9), (-15, -11)]
+        stack = [full[m + dy:m + dy + ref.shape[0], m + dx:m + dx + ref.shape[1]]
+                 for dx, dy in drifts]
+
+        for nthreads in (1, 3):
+            shifts, confs, avg = registration.RegisterStack(stack, precision=1,
+                                                            average=True,
+                                                            nthreads=nthreads)
+            numpy.testing.assert_allclose(shifts, drifts)
+            # With integer drifts, the aligned frames are identical to the
+            # reference, including on all the borders
+            numpy.testing.assert_allclose(avg, ref, atol=1e-6 * full.max())
+
+    def test_running_mean(self):
+        shifts, confs, avg = registration.RegisterStack(self.stack, running_mean=True,
+                                                        average=True)
+        numpy.testing.assert_allclose(shifts, self.shifts, atol=0.2)
+        self.assertEqual(avg.shape, self.ref.shape)
+
+    def test_bad_frame(self):
+        """
+        A frame which doesn't correspond is not used in the average
+        """
+        stack = self.stack + [numpy.random.normal(0, 1, self.ref.shape)]
+        shifts, confs, avg = registration.RegisterStack(stack, average=True)
+        self.assertLess(confs[-1], 0.1)
+        self.assertIn("average of 5 ", avg.metadata[model.MD_DESCRIPTION])
+
+    def test_wrong_shape(self):
+        stack = self.stack + [self.ref[:100, :100]]
+        with self.assertRaises(ValueError):
+            registration.RegisterStack(stack)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -28,12 +28,16 @@ from odemis.acq import drift
 from odemis.acq.align import FindEbeamCenter
 from odemis.model import MD_POS, MD_POS_COR, MD_PIXEL_SIZE_COR, \
     MD_ROTATION_COR
-from odemis.util import img, limit_invocation, conversion, fluo
+from odemis.util import img, limit_invocation, conversion, fluo, timeseries
 import time
 
 from ._base import Stream, UNDEFINED_ROI
 
 
+# Maximum number of values kept by the CameraCountStream
+COUNT_BUFFER_SIZE = 2 ** 16
+
+
 class SEMStream(Stream):
     """ Stream containing images obtained via Scanning electron microscope.
 
@@ -522,16 +526,25 @@ class CameraCountStream(CameraStream):
     time.
     The .image is a one dimension DataArray with the mean of the whole sensor
      data over time. The last acquired data is the last value in the array.
+    The counts are stored in a fixed-size ring buffer, so that the memory usage
+    and the cost of each new count stay constant, even over very long sessions.
     """
-    def __init__(self, name, detector, dataflow, emitter):
+    def __init__(self, name, detector, dataflow, emitter,
+                 capacity=COUNT_BUFFER_SIZE, spill_file=None):
+        """
+        capacity (0<int): maximum number of counts kept in memory. If the window
+          contains more counts, only the latest ones are shown.
+        spill_file (None or str): if not None, name of an HDF5 file where the
+          counts which don't fit in memory anymore are saved.
+        """
         CameraStream.__init__(self, name, detector, dataflow, emitter)
-        self._raw_date = [] # time of each raw acquisition (=count)
+        self._counts = timeseries.TimeSeriesBuffer(capacity, spill_file=spill_file)
         self.image.value = model.DataArray([]) # start with an empty array
 
         # time over which to accumulate the data. 0 indicates that only the last
         # value should be included
-        # TODO: immediately cut window when the value changes
         self.windowPeriod = model.FloatContinuous(30, range=[0, 1e6], unit="s")
+        self.windowPeriod.subscribe(self._onWindowPeriod)
 
     def _getCount(self, data):
         """
@@ -549,28 +562,23 @@ class CameraCountStream(CameraStream):
 
     def _append(self, count, date):
         """
-        Adds a new count and updates the window
+        Adds a new count (and drops the oldest one if the buffer is full)
         """
-        # delete all old data
-        oldest = date - self.windowPeriod.value
-        first = 0 # first element still part of the window
-        for i, d in enumerate(self._raw_date):
-            if d >= oldest:
-                first = i
-                break
-        self._raw_date = self._raw_date[first:]
-        self.raw = self.raw[first:]
+        self._counts.append(count, date)
 
-        self._raw_date.append(date)
-        self.raw.append(count)
+    def _onWindowPeriod(self, period):
+        # immediately cut (or extend) the window
+        self._updateImage()
 
     @limit_invocation(0.1)
     def _updateImage(self):
-        # convert the list into a DataArray
-        im = model.DataArray(self.raw)
+        # Copy the window, as the buffer will be overwritten later
+        counts, dates = self._counts.get_window(self.windowPeriod.value)
+        im = model.DataArray(counts.copy())
         # save the time of each point as ACQ_DATE, unorthodox but should not
         # cause much problems as the data is so special anyway.
-        im.metadata[model.MD_ACQ_DATE] = self._raw_date
+        im.metadata[model.MD_ACQ_DATE] = dates.copy()
+        self.raw = [im]
         self.image.value = im
 
     def onNewImage(self, dataflow, data):
@@ -23,12 +23,14 @@ from __future__ import division
 import collections
 import logging
 import math
+import multiprocessing
 import numpy
 from odemis import model
 from odemis.acq import calibration
 from odemis.model import MD_POS, MD_PIXEL_SIZE, VigilantAttribute
 from odemis.util import img, conversion, polar, limit_invocation, spectrum
 from scipy import ndimage
+import threading
 
 from ._base import Stream
 
@@ -137,6 +139,13 @@ class StaticFluoStream(StaticStream):
         self._updateImage()
 
 
+# Default maximum memory used by a StaticARStream to keep the polar projections
+POLAR_CACHE_SIZE = 512 * 2 ** 20 # B
+# Maximum size of the (largest dimension) of the CCD image used to compute the
+# low resolution polar projection
+POLAR_LOW_RES_SIZE = 256 # px
+
+
 class StaticARStream(StaticStream):
     """
     A angular resolved stream for one set of data.
@@ -153,11 +162,13 @@ class StaticARStream(StaticStream):
        pole (MD_AR_POLE, in px), and acquisition time (MD_ACQ_DATE)
      * multiple CCD images are grouped together in a list
     """
-    def __init__(self, name, data):
+    def __init__(self, name, data, cache_size=POLAR_CACHE_SIZE):
         """
         name (string)
         data (model.DataArray of shape (YX) or list of such DataArray). The
          metadata MD_POS and MD_AR_POLE should be provided
+        cache_size (0<int): maximum memory (in bytes) used to keep the polar
+         projections. The least recently used projections are dropped first.
         """
         Stream.__init__(self, name, None, None, None)
 
@@ -173,9 +184,31 @@ class StaticARStream(StaticStream):
             except KeyError:
                 logging.info("Skipping DataArray without known position")
 
-        # Cached conversion of the CCD image to polar representation
-        self._polar = {} # dict tuple 2 floats -> DataArray
-        # TODO: automatically fill it in a background thread
+        # Cached conversion of the CCD image to polar representation, ordered
+        # from the least recently used to the most recently used.
+        # It is filled in background, and all access must be done with the lock.
+        self._polar = collections.OrderedDict() # tuple 2 floats -> DataArray
+        self._polar_nbytes = 0 # memory used by all the polar projections
+        self._polar_max_nbytes = cache_size
+        self._polar_lock = threading.RLock()
+        # tuple 2 floats -> (Future, bool): projection being computed and
+        # whether it is with priority
+        self._polar_futures = {}
+        # Incremented every time the cache is invalidated, to discard the
+        # projections which were being computed with the old settings.
+        self._polar_gen = 0
+        # The projection of the point displayed is computed in its own
+        # executor, so that it doesn't wait after the background filling.
+        # The executors only exist while there are projections to compute, so
+        # that no thread is left once the stream is not used anymore.
+        self._polar_executor = None
+        self._fill_executor = None
+
+        # To not publish an image older than the one already displayed (as
+        # the low resolution projection can finish after the full one).
+        self._image_lock = threading.Lock()
+        self._image_seq = 0 # incremented at every update request
+        self._image_seq_shown = 0 # sequence number of the image displayed
 
         self.raw = list(self._sempos.values())
 
@@ -203,60 +236,192 @@ class StaticARStream(StaticStream):
                     return float("inf") # for None, None
             self.point.value = min(self._sempos.keys(), key=dis_bbtl)
 
+        self._fillPolarCache()
+
+    def _projectPolar(self, data, low_res=False):
+        """
+        Compute the polar projection of an AR image
+        data (DataArray of shape YX): the CCD image
+        low_res (bool): if True, a quick, low resolution, projection is computed
+        returns DataArray: the polar projection
+        """
+        bg_data = self.background.value
+        if bg_data is None:
+            # Simple version: remove the background value
+            data = polar.ARBackgroundSubtract(data)
+        else:
+            data = img.Subtract(data, bg_data) # metadata from data
+
+        dtype = None # just let the function use the best one
+        if low_res:
+            max_size = POLAR_LOW_RES_SIZE
+        elif numpy.prod(data.shape) > (1280 * 1080):
+            # AR conversion fails one very large images due to too much
+            # memory consumed (> 2Gb). So, rescale + use a "degraded" type that
+            # uses less memory. As the display size is small (compared
+            # to the size of the input image, it shouldn't actually
+            # affect much the output.
+            logging.info("AR image is very large %s, will convert to "
+                         "azymuthal projection in reduced precision.",
+                         data.shape)
+            max_size = 1024
+            dtype = numpy.float16
+        else:
+            max_size = None
+
+        if max_size is not None and max(data.shape) > max_size:
+            y, x = data.shape
+            if y > x:
+                small_shape = max_size, int(round(max_size * x / y))
+            else:
+                small_shape = int(round(max_size * y / x)), max_size
+            # resize
+            data = img.rescale_hq(data, small_shape)
+
+        # 2 x size of original image (on smallest axis) and at most
+        # the size of a full-screen canvas
+        size = min(min(data.shape) * 2, 1134)
+
+        # TODO: could use the size of the canvas that will display
+        # the image to save some computation time.
+        return polar.AngleResolved2Polar(data, size, hole=False, dtype=dtype)
+
+    def _computePolarProjection(self, pos, gen):
+        """
+        Compute the (full resolution) polar projection and store it in the cache.
+        Runs in an executor.
+        pos (tuple of 2 floats): position (must be part of the ._sempos)
+        gen (int): generation of the cache when the computation was requested
+        returns DataArray: the polar projection
+        """
+        with self._polar_lock:
+            if pos in self._polar:
+                return self._polar[pos]
+
+        # Note: in case the background changes during the computation, the
+        # background used might be the new one, but the result is anyway
+        # discarded.
+        polard = self._projectPolar(self._sempos[pos])
+
+        with self._polar_lock:
+            if gen == self._polar_gen:
+                self._polar[pos] = polard
+                self._polar_nbytes += polard.nbytes
+                # Drop the least recently used projections, but never the newest
+                while (self._polar_nbytes > self._polar_max_nbytes and
+                       len(self._polar) > 1):
+                    oldpos, oldd = self._polar.popitem(last=False)
+                    self._polar_nbytes -= oldd.nbytes
+                    logging.debug("Dropped polar projection of %s from the cache",
+                                  oldpos)
+
+        return polard
+
+    def _fillPolarProjection(self, pos, gen):
+        """
+        Compute the polar projection in background, if there is still space in
+        the cache (or if it's the point displayed).
+        """
+        with self._polar_lock:
+            if (self._polar_nbytes >= self._polar_max_nbytes and
+                pos != self.point.value):
+                logging.debug("Polar projection cache full, not computing %s", pos)
+                return None
+        return self._computePolarProjection(pos, gen)
+
+    def _requestPolarProjection(self, pos, priority=False):
+        """
+        Schedule the computation of the polar projection of a point.
+        pos (tuple of 2 floats): position (must be part of the ._sempos)
+        priority (bool): if True, the projection is computed right away, instead
+          of after all the other points which are queued.
+        """
+        with self._polar_lock:
+            if pos in self._polar:
+                return
+            if pos in self._polar_futures:
+                f, fprio = self._polar_futures[pos]
+                # Only needs to be moved if it's still waiting in the queue
+                if not priority or fprio or not f.cancel():
+                    return
+            gen = self._polar_gen
+            if priority:
+                if self._polar_executor is None:
+                    self._polar_executor = model.CancellableThreadPoolExecutor(max_workers=1)
+                f = self._polar_executor.submit(self._computePolarProjection, pos, gen)
+            else:
+                f = self._fill_executor.submit(self._fillPolarProjection, pos, gen)
+            self._polar_futures[pos] = (f, priority)
+
+        f.add_done_callback(lambda f, pos=pos: self._onPolarProjection(pos, f))
+
+    def _onPolarProjection(self, pos, future):
+        """
+        Called when a computation of polar projection is over
+        """
+        with self._polar_lock:
+            if self._polar_futures.get(pos, (None,))[0] is future:
+                del self._polar_futures[pos]
+            # Stop the thread of the priority executor once it's idle
+            if (self._polar_executor is not None and
+                not any(p for f, p in self._polar_futures.values())):
+                self._polar_executor.shutdown(wait=False)
+                self._polar_executor = None
+
+        if future.cancelled():
+            return
+        try:
+            polard = future.result()
+        except Exception:
+            logging.exception("Failed to convert to azymuthal projection")
+            return
+
+        # Refine the image, if it is the point displayed
+        if polard is not None and pos == self.point.value:
+            self._updateImage()
+
+    def _fillPolarCache(self):
+        """
+        Schedule the computation in background of the polar projection of all
+        the points (as long as the cache is not full).
+        """
+        nworkers = max(1, multiprocessing.cpu_count() - 1)
+        self._fill_executor = model.CancellableThreadPoolExecutor(max_workers=nworkers)
+        for pos in sorted(self._sempos.keys()):
+            self._requestPolarProjection(pos)
+        # The queued projections are still computed, then the threads end
+        self._fill_executor.shutdown(wait=False)
+
     def _getPolarProjection(self, pos):
         """
         Return the polar projection of the image at the given position.
+        If the full resolution projection is not yet available, a low
+        resolution version is returned, and the image will be updated once
+        the full resolution is computed.
         pos (tuple of 2 floats): position (must be part of the ._sempos
         returns DataArray: the polar projection
         """
-        if pos in self._polar:
-            polard = self._polar[pos]
-        else:
-            # Compute the polar representation
-            data = self._sempos[pos]
-            try:
-                if numpy.prod(data.shape) > (1280 * 1080):
-                    # AR conversion fails one very large images due to too much
-                    # memory consumed (> 2Gb). So, rescale + use a "degraded" type that
-                    # uses less memory. As the display size is small (compared
-                    # to the size of the input image, it shouldn't actually
-                    # affect much the output.
-                    logging.info("AR image is very large %s, will convert to "
-                                 "azymuthal projection in reduced precision.",
-                                 data.shape)
-                    y, x = data.shape
-                    if y > x:
-                        small_shape = 1024, int(round(1024 * x / y))
-                    else:
-                        small_shape = int(round(1024 * y / x)), 1024
-                    # resize
-                    data = img.rescale_hq(data, small_shape)
-                    dtype = numpy.float16
-                else:
-                    dtype = None # just let the function use the best one
-
-                size = min(min(data.shape) * 2, 1134)
-
-                # TODO: First compute quickly a low resolution and then
-                # compute a high resolution version.
-                # TODO: could use the size of the canvas that will display
-                # the image to save some computation time.
-
-                bg_data = self.background.value
-                if bg_data is None:
-                    # Simple version: remove the background value
-                    data0 = polar.ARBackgroundSubtract(data)
-                else:
-                    data0 = img.Subtract(data, bg_data) # metadata from data
-
-                # 2 x size of original image (on smallest axis) and at most
-                # the size of a full-screen canvas
-                polard = polar.AngleResolved2Polar(data0, size, hole=False, dtype=dtype)
+        with self._polar_lock:
+            if pos in self._polar:
+                # Mark it as the most recently used
+                polard = self._polar.pop(pos)
                 self._polar[pos] = polard
-            except Exception:
-                logging.exception("Failed to convert to azymuthal projection")
-                return data # display it raw as fallback
+                return polard
 
+        self._requestPolarProjection(pos, priority=True)
+
+        # Compute quickly a low resolution version, to show meanwhile
+        data = self._sempos[pos]
+        try:
+            polard = self._projectPolar(data, low_res=True)
+        except Exception:
+            logging.exception("Failed to convert to azymuthal projection")
+            polard = data # display it raw as fallback
+
+        # The full resolution might have been computed in the meantime
+        with self._polar_lock:
+            if pos in self._polar:
+                return self._polar[pos]
         return polard
 
     @limit_invocation(0.1) # Max 10 Hz
@@ -267,10 +432,14 @@ class StaticARStream(StaticStream):
         if not self.raw:
             return
 
+        with self._image_lock:
+            self._image_seq += 1
+            seq = self._image_seq
+
         pos = self.point.value
         try:
             if pos == (None, None):
-                self.image.value = None
+                self._publishImage(None, seq)
             else:
                 polard = self._getPolarProjection(pos)
                 # update the histrogram
@@ -287,10 +456,24 @@ class StaticARStream(StaticStream):
                 rgbim = img.DataArray2RGB(polard, irange)
                 rgbim.flags.writeable = False
                 # For polar view, no PIXEL_SIZE nor POS
-                self.image.value = model.DataArray(rgbim)
+                self._publishImage(model.DataArray(rgbim), seq)
         except Exception:
             logging.exception("Updating %s image", self.__class__.__name__)
 
+    def _publishImage(self, im, seq):
+        """
+        Update .image, unless a more recent update has already been published
+        im (None or DataArray): the new image
+        seq (int): the sequence number of the update
+        """
+        with self._image_lock:
+            if seq < self._image_seq_shown:
+                logging.debug("Dropping image %d, as image %d is already shown",
+                              seq, self._image_seq_shown)
+                return
+            self._image_seq_shown = seq
+            self.image.value = im
+
     def _onPoint(self, pos):
         self._updateImage()
 
@@ -338,8 +521,42 @@ class StaticARStream(StaticStream):
     def _onBackground(self, data):
         """Called when the background is changed"""
         # uncache all the polar images, and update the current image
-        self._polar = {}
+        with self._polar_lock:
+            self._polar_gen += 1
+            self._polar.clear()
+            self._polar_nbytes = 0
+            fs = [f for f, p in self._polar_futures.values()]
+            self._polar_futures.clear()
+        for f in fs:
+            f.cancel()
+
         self._updateImage()
+        self._fillPolarCache()
+
+def _get_sum_dtype(dtype, n):
+    """
+    Find a type which can hold the sum of n values of the given type
+    dtype (numpy.dtype): type of the values
+    n (int): number of values summed
+    returns (numpy.dtype): for integers, the smallest 32 or 64 bits integer
+      which cannot overflow, otherwise a 64 bits float.
+    """
+    if dtype.kind in "iu":
+        idt = numpy.iinfo(dtype)
+        if dtype.kind == "u":
+            candidates = (numpy.uint32, numpy.uint64)
+        else:
+            candidates = (numpy.int32, numpy.int64)
+        for t in candidates:
+            tdt = numpy.iinfo(t)
+            if idt.max * n <= tdt.max and idt.min * n >= tdt.min:
+                return numpy.dtype(t)
+        return numpy.dtype(candidates[-1]) # overflow is very unlikely anyway
+    elif dtype.kind == "b":
+        return numpy.dtype(numpy.uint32) if n < 2 ** 32 else numpy.dtype(numpy.uint64)
+    else:
+        return numpy.dtype(numpy.float64)
+
 
 class StaticSpectrumStream(StaticStream):
     """
@@ -357,6 +574,14 @@ class StaticSpectrumStream(StaticStream):
         wavelength.
         """
         self._calibrated = None # just for the _updateDRange to not complain
+        # Cumulative sum of the calibrated data along C, computed on demand,
+        # to average any band in constant time (cf _get_band_mean())
+        self._cumsum = None
+        # Summed-area table of each wavelength of the calibrated data, computed
+        # on demand, to average the spectrum of any rectangle in O(C)
+        self._sat = None
+        # Cache of the coordinates of the last line used for the line spectrum
+        self._line_coord = None # (start, end, C) -> numpy.array of shape 3NC
         Stream.__init__(self, name, None, None, None)
         # Spectrum stream has in addition to normal stream:
         #  * information about the current bandwidth displayed (avg. spectrum)
@@ -437,6 +662,8 @@ class StaticSpectrumStream(StaticStream):
 
         self.raw = [image] # for compatibility with other streams (like saving...)
         self._calibrated = image # the raw data after calibration
+        self._cumsum = None
+        self._sat = None
 
         self._updateDRange()
         self._updateHistogram()
@@ -496,6 +723,101 @@ class StaticSpectrumStream(StaticStream):
         assert low_px <= high_px
         return low_px, high_px
 
+    def _get_cumsum(self):
+        """
+        Return the cumulative sum of the calibrated data along the C dimension.
+        It is computed only once per calibrated data.
+        returns (numpy.ndarray of shape (C+1)11YX): the first plane is all 0's,
+          and the plane i contains the sum of the planes 0 -> i-1 of the data.
+        """
+        if self._cumsum is None:
+            data = self._calibrated
+            dtype = _get_sum_dtype(data.dtype, data.shape[0])
+            logging.debug("Computing cumulative sum of spectrum data as %s", dtype)
+            cumsum = numpy.empty((data.shape[0] + 1,) + data.shape[1:], dtype=dtype)
+            cumsum[0] = 0
+            numpy.cumsum(data, axis=0, dtype=dtype, out=cumsum[1:])
+            self._cumsum = cumsum
+
+        return self._cumsum
+
+    def _get_band_mean(self, low, high):
+        """
+        Compute the average over a band of the calibrated data
+        low (0<=int): index of the first pixel of the band
+        high (low<=int<C): index of the last pixel of the band (included)
+        returns (numpy.ndarray of float of shape 11YX): the mean of each pixel
+        """
+        cumsum = self._get_cumsum()
+        # Note: the subtraction is done in the type of the cumulative sum, so
+        # it is exact for integers
+        band_sum = cumsum[high + 1] - cumsum[low]
+        return band_sum / (high - low + 1)
+
+    def _get_sat(self):
+        """
+        Return the summed-area table of each wavelength of the calibrated data.
+        It is computed only once per calibrated data.
+        returns (numpy.ndarray of shape C(Y+1)(X+1)): the first row and column
+          are all 0's, and the element c, y, x contains the sum of all the
+          pixels of the wavelength c above and on the left of y, x (excluded).
+        """
+        if self._sat is None:
+            data = self._calibrated[:, 0, 0] # CYX
+            dtype = _get_sum_dtype(data.dtype, data.shape[1] * data.shape[2])
+            logging.debug("Computing summed-area table of spectrum data as %s", dtype)
+            sat = numpy.zeros((data.shape[0], data.shape[1] + 1, data.shape[2] + 1),
+                              dtype=dtype)
+            numpy.cumsum(data, axis=1, dtype=dtype, out=sat[:, 1:, 1:])
+            numpy.cumsum(sat[:, 1:, 1:], axis=2, out=sat[:, 1:, 1:])
+            self._sat = sat
+
+        return self._sat
+
+    def _get_area_mean(self, area):
+        """
+        Compute the mean spectrum of a rectangle of the calibrated data
+        area (4 ints): left, top, right, bottom pixel positions (included)
+        returns (numpy.ndarray of float of shape C): the average intensity for
+          each wavelength
+        """
+        l, t, r, b = area
+        sat = self._get_sat()
+        # Note: with unsigned integers, intermediary results might wrap around,
+        # but the final result is still correct.
+        area_sum = (sat[:, b + 1, r + 1] - sat[:, t, r + 1]) - (sat[:, b + 1, l] - sat[:, t, l])
+        return area_sum / ((b - t + 1) * (r - l + 1))
+
+    def _project_rgb(self, spec_range):
+        """
+        Project the band of the calibrated data on the RGB channels
+        spec_range (2-tuple of int): low and high pixel coordinates (included)
+        returns (numpy.ndarray of float of shape 11YX3): the average of each
+          channel
+        """
+        # Note: For now this method uses three independent bands. To give
+        # a better sense of continuum, and be closer to reality when using
+        # the visible light's band, we should take a weighted average of the
+        # whole spectrum for each band. However, as long as the bands are
+        # contiguous, using the cumulative sum is much faster.
+
+        # divide the range into 3 sub-ranges of almost the same length
+        len_rng = spec_range[1] - spec_range[0] + 1
+        rrange = [spec_range[0], int(round(spec_range[0] + len_rng / 3)) - 1]
+        grange = [rrange[1] + 1, int(round(spec_range[0] + 2 * len_rng / 3)) - 1]
+        brange = [grange[1] + 1, spec_range[1]]
+        # ensure each range contains at least one pixel
+        rrange[1] = max(rrange)
+        grange[1] = max(grange)
+        brange[1] = max(brange)
+
+        shape = self._calibrated.shape[1:]
+        av_data = numpy.empty(shape + (3,), dtype=numpy.float64)
+        for i, rng in enumerate((rrange, grange, brange)):
+            av_data[..., i] = self._get_band_mean(*rng)
+
+        return av_data
+
     def _updateImageAverage(self, data):
         if self.auto_bc.value:
             # The histogram might be slightly old, but not too much
@@ -518,38 +840,17 @@ class StaticSpectrumStream(StaticStream):
         logging.debug("Spectrum range picked: %s px", spec_range)
 
         if not self.fitToRGB.value:
-            # TODO: use better intermediary type if possible?, cf semcomedi
-            av_data = numpy.mean(data[spec_range[0]:spec_range[1] + 1], axis=0)
+            av_data = self._get_band_mean(*spec_range)
             av_data = img.ensure2DImage(av_data)
             rgbim = img.DataArray2RGB(av_data, irange)
         else:
-            # Note: For now this method uses three independent bands. To give
-            # a better sense of continuum, and be closer to reality when using
-            # the visible light's band, we should take a weighted average of the
-            # whole spectrum for each band.
-
-            # divide the range into 3 sub-ranges of almost the same length
-            len_rng = spec_range[1] - spec_range[0] + 1
-            rrange = [spec_range[0], int(round(spec_range[0] + len_rng / 3)) - 1]
-            grange = [rrange[1] + 1, int(round(spec_range[0] + 2 * len_rng / 3)) - 1]
-            brange = [grange[1] + 1, spec_range[1]]
-            # ensure each range contains at least one pixel
-            rrange[1] = max(rrange)
-            grange[1] = max(grange)
-            brange[1] = max(brange)
-
-            # FIXME: unoptimized, as each channel is duplicated 3 times, and discarded
-            av_data = numpy.mean(data[rrange[0]:rrange[1] + 1], axis=0)
-            av_data = img.ensure2DImage(av_data)
-            rgbim = img.DataArray2RGB(av_data, irange)
-            av_data = numpy.mean(data[grange[0]:grange[1] + 1], axis=0)
-            av_data = img.ensure2DImage(av_data)
-            gim = img.DataArray2RGB(av_data, irange)
-            rgbim[:, :, 1] = gim[:, :, 0]
-            av_data = numpy.mean(data[brange[0]:brange[1] + 1], axis=0)
-            av_data = img.ensure2DImage(av_data)
-            bim = img.DataArray2RGB(av_data, irange)
-            rgbim[:, :, 2] = bim[:, :, 0]
+            av_data = self._project_rgb(spec_range)
+            av_data = av_data.reshape(av_data.shape[-3:]) # YXC
+            # Convert the 3 channels at once, as they share the same intensity
+            # range: see them as one greyscale image of width X * 3.
+            y, x, c = av_data.shape
+            gim = img.DataArray2RGB(av_data.reshape(y, x * c), irange)
+            rgbim = numpy.ascontiguousarray(gim[:, :, 0]).reshape(y, x, c)
 
         rgbim.flags.writeable = False
         self.image.value = model.DataArray(rgbim, self._find_metadata(data.metadata))
@@ -576,16 +877,77 @@ class StaticSpectrumStream(StaticStream):
     def get_pixel_spectrum(self):
         """
         Return the (0D) spectrum belonging to the selected pixel.
+        If .width is more than 1, it is the average spectrum of the square of
+        width x width pixels centred on the selected pixel (clipped to the
+        data), like the points of the line spectrum.
         See get_spectrum_range() to know the wavelength values for each index of
          the spectrum dimension
         return (None or DataArray with 1 dimension): the spectrum of the given
-         pixel or None if no spectrum is selected.
+         pixel or None if no spectrum is selected. If averaged over several
+         pixels, it is of type float.
         """
 
         if self.selected_pixel.value == (None, None):
             return None
         x, y = self.selected_pixel.value
-        return self._calibrated[:, 0, 0, y, x]
+        width = self.width.value
+        if width == 1:
+            # simple version for the most usual case
+            return self._calibrated[:, 0, 0, y, x]
+
+        # Average of all the pixels within W/2 (clipped to the data)
+        shape = self._calibrated.shape[-1:-3:-1] # XY
+        spread = (width - 1) // 2
+        area = (max(0, x - spread), max(0, y - spread),
+                min(shape[0] - 1, x + width - 1 - spread),
+                min(shape[1] - 1, y + width - 1 - spread))
+        # Keep the mean as float, to not lose precision with integer data
+        spec0d = self._get_area_mean(area)
+        return model.DataArray(spec0d, self._calibrated.metadata.copy())
+
+    def _get_line_coordinates(self, start, end, n, c, width):
+        """
+        Compute the coordinates of the points to interpolate for the line spectrum
+        start (2 ints): position of the first point of the line in px (X, Y)
+        end (2 ints): position of the last point of the line in px (X, Y)
+        n (int): number of points along the line
+        c (int): number of points along the spectrum
+        width (int): number of points across the line
+        returns (numpy.array of shape 3WNC): the coordinates for each dimension
+          of the data (C, Y, X)
+        """
+        # The coordinates along the line are the same when just the width is
+        # changed, so they are cached
+        key = (tuple(start), tuple(end), c)
+        if self._line_coord is None or self._line_coord[0] != key:
+            # Coordinates of each point: ndim of data (5-2), pos on line (Y), spectrum (X)
+            # The line is scanned from the end till the start so that the spectra
+            # closest to the origin of the line are at the bottom.
+            lcoord = numpy.empty((3, n, c))
+            lcoord[0] = numpy.arange(c) # spectra = all
+            lcoord[1] = numpy.linspace(end[1], start[1], n)[:, numpy.newaxis] # Y axis
+            lcoord[2] = numpy.linspace(end[0], start[0], n)[:, numpy.newaxis] # X axis
+            self._line_coord = (key, lcoord)
+        else:
+            lcoord = self._line_coord[1]
+
+        coord = numpy.empty((3, width, n, c))
+        coord[0] = lcoord[0]
+        if width == 1:
+            coord[1:, 0] = lcoord[1:]
+        else:
+            # Spread over the width, along the perpendicular unit vector
+            v = (end[0] - start[0], end[1] - start[1])
+            l = math.hypot(*v)
+            pv = (-v[1] / l, v[0] / l)
+            spread = (width - 1) / 2
+            width_coord = numpy.empty((2, width))
+            width_coord[0] = numpy.linspace(pv[1] * -spread, pv[1] * spread, width) # Y axis
+            width_coord[1] = numpy.linspace(pv[0] * -spread, pv[0] * spread, width) # X axis
+            coord[1:] = (lcoord[1:, numpy.newaxis] +
+                         width_coord[:, :, numpy.newaxis, numpy.newaxis])
+
+        return coord
 
     def get_line_spectrum(self):
         """
@@ -612,25 +974,7 @@ class StaticSpectrumStream(StaticStream):
         if l < 1: # a line of just one pixel is considered not valid
             return None
 
-        # Coordinates of each point: ndim of data (5-2), pos on line (Y), spectrum (X)
-        # The line is scanned from the end till the start so that the spectra
-        # closest to the origin of the line are at the bottom.
-        coord = numpy.empty((3, width, n, spec2d.shape[0]))
-        coord[0] = numpy.arange(spec2d.shape[0]) # spectra = all
-        coord_spc = coord.swapaxes(2, 3) # just a view to have (line) space as last dim
-        coord_spc[-1] = numpy.linspace(end[0], start[0], n) # X axis
-        coord_spc[-2] = numpy.linspace(end[1], start[1], n) # Y axis
-
-        # Spread over the width
-        # perpendicular unit vector
-        pv = (-v[1] / l, v[0] / l)
-        width_coord = numpy.empty((2, width))
-        spread = (width - 1) / 2
-        width_coord[-1] = numpy.linspace(pv[0] * -spread, pv[0] * spread, width) # X axis
-        width_coord[-2] = numpy.linspace(pv[1] * -spread, pv[1] * spread, width) # Y axis
-
-        coord_cw = coord[1:].swapaxes(0, 2).swapaxes(1, 3) # view with coordinates and width as last dims
-        coord_cw += width_coord
+        coord = self._get_line_coordinates(start, end, n, spec2d.shape[0], width)
 
         # Interpolate the values based on the data
         if width == 1:
@@ -653,22 +997,31 @@ class StaticSpectrumStream(StaticStream):
         md = {MD_PIXEL_SIZE: (None, pxs)} # for the spectrum, use get_spectrum_range()
         return model.DataArray(rgb8, md)
 
-    # TODO: have an "area=None" argument which allows to specify the 2D region
-    # within which the spectrum should be computed
     # TODO: should it also return the wavelength values? Or maybe another method
     # can do it?
-    def getMeanSpectrum(self):
+    def getMeanSpectrum(self, area=None):
         """
         Compute the global spectrum of the data as an average over all the pixels
+        area (None or 4 ints): left, top, right, bottom pixel positions (included)
+          of the rectangle over which the spectrum is averaged. If None, the
+          whole data is used.
         returns (numpy.ndarray of float): average intensity for each wavelength
          You need to use the metadata of the raw data to find out what is the
          wavelength for each pixel, but the range of wavelengthBandwidth is
          the same as the range of this spectrum.
+        raises ValueError: if the area is not within the data
         """
         data = self._calibrated
-        # flatten all but the C dimension, for the average
-        data = data.reshape((data.shape[0], numpy.prod(data.shape[1:])))
-        av_data = numpy.mean(data, axis=1)
+        if area is None:
+            # flatten all but the C dimension, for the average
+            data = data.reshape((data.shape[0], numpy.prod(data.shape[1:])))
+            av_data = numpy.mean(data, axis=1)
+        else:
+            l, t, r, b = area
+            shape = data.shape[-1:-3:-1] # XY
+            if not (0 <= l <= r < shape[0] and 0 <= t <= b < shape[1]):
+                raise ValueError("Area %s is not within the data %s" % (area, shape))
+            av_data = self._get_area_mean(area)
 
         return av_data
 
@@ -702,6 +1055,8 @@ class StaticSpectrumStream(StaticStream):
 
         if data is None:
             self._calibrated = None
+            self._cumsum = None
+            self._sat = None
             return
 
         if not (set(data.metadata.keys()) &
@@ -712,6 +1067,9 @@ class StaticSpectrumStream(StaticStream):
         calibrated = calibration.compensate_spectrum_efficiency(
                                                     data, bckg=bckg, coef=coef)
         self._calibrated = calibrated
+        # need to be recomputed for the new data
+        self._cumsum = None
+        self._sat = None
 
     def _setBackground(self, bckg):
         """
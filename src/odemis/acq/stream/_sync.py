@@ -21,20 +21,102 @@ You should have received a copy of the GNU General Public License along with Ode
 from __future__ import division
 
 from abc import ABCMeta, abstractmethod
+import collections
 from concurrent.futures._base import RUNNING, FINISHED, CANCELLED, TimeoutError, \
     CancelledError
+import itertools
 import logging
 import numpy
 from odemis import model
 from odemis.acq import _futures
 from odemis.acq import drift
+from odemis.dataio import hdf5
 from odemis.model import MD_POS, MD_DESCRIPTION, MD_PIXEL_SIZE
+from odemis.util import limit_invocation, spectrum
+import os
+import tempfile
 import threading
 import time
 
 from ._base import Stream, UNDEFINED_ROI
 
 
+# In software synchronisation with continuous scan, number of SEM frames
+# (roughly) received during one CCD acquisition, and minimum SEM dwell time
+SS_CONT_SEM_FRAMES = 10
+SS_CONT_MIN_DWELL_TIME = 5e-3 # s
+# Number of SEM frames discarded after moving the e-beam, as they might have
+# started before the move. 2 is safe as long as the latency of the SEM dataflow
+# is less than the duration of a frame.
+SS_CONT_SKIP_FRAMES = 2
+
+# Maximum number of CCD frames received but not yet stored, during the software
+# synchronised acquisition
+SS_PIPELINE_SIZE = 4
+
+# Minimum time between two checkpoints of the software synchronised acquisition
+CHECKPOINT_PERIOD = 60 # s
+CHECKPOINT_VERSION = 1
+# Hardware settings which must be identical to resume an acquisition
+CHECKPOINT_EMITTER_VAS = ("magnification", "accelVoltage", "rotation")
+CHECKPOINT_CCD_VAS = ("exposureTime", "binning", "resolution", "readoutRate")
+
+# Minimum time between two updates of the preview during the acquisition
+PREVIEW_PERIOD = 1 # s
+
+
+def readCheckpoint(filename):
+    """
+    Read the information about the acquisition saved in a checkpoint file
+    filename (unicode): the checkpoint file, as in SEMCCDMDStream.checkpoint_file
+    returns (dict): contains:
+      "settings" (dict str -> value): the settings of the acquisition (see
+        SEMCCDMDStream._getCheckpointSettings())
+      "streams" (dict str -> value): the class name and name of each stream
+      "pixels" (int): number of pixels already acquired
+    raises ValueError: if the file is not a checkpoint
+    """
+    state = _readCheckpointState(filename)
+    return {"settings": state["settings"],
+            "streams": state["streams"],
+            "pixels": state["pixels"]}
+
+def _readCheckpointState(filename):
+    """
+    return (dict): the state saved in the checkpoint file
+    raises ValueError: if the file is not a checkpoint
+    """
+    try:
+        spool = hdf5.FrameStore(filename, mode="a")
+    except Exception as ex:
+        raise ValueError("Failed to open checkpoint %s: %s" % (filename, ex))
+    try:
+        state = spool.state
+    finally:
+        spool.close()
+    if not state or state.get("version") != CHECKPOINT_VERSION:
+        raise ValueError("File %s doesn't contain any checkpoint" % (filename,))
+    return state
+
+def _compareSettings(expected, actual):
+    """
+    Compare two sets of settings
+    expected (dict str -> value)
+    actual (dict str -> value)
+    returns (list of str): description of each setting which differs
+    """
+    diffs = []
+    for k in sorted(set(expected) | set(actual)):
+        e, a = expected.get(k), actual.get(k)
+        try:
+            same = numpy.allclose(e, a, rtol=1e-6, atol=0)
+        except (TypeError, ValueError):
+            same = (e == a)
+        if not same:
+            diffs.append("%s is %s instead of %s" % (k, a, e))
+    return diffs
+
+
 class MultipleDetectorStream(Stream):
     """
     Abstract class for all specialized streams which are actually a combination
@@ -72,10 +154,40 @@ class SEMCCDMDStream(MultipleDetectorStream):
        automatically synchronises the CCD. As the dwell time is constant, it
        must be bigger than the worst time for CCD acquisition. Less overhead,
        so good for short dwell times.
+    The CCD data is copied as soon as it is received to its final place (see
+    _onCCDFrame()), which is preallocated by the subclasses with
+    _allocCCDCube(). It is backed by a temporary file, so that the whole
+    acquisition doesn't have to fit in memory.
+    In addition, each SEM and CCD frame is written to a (spool) HDF5 file as
+    soon as it is received, so that the data is not lost if the process dies.
+    In software synchronisation, every CHECKPOINT_PERIOD, the state of the
+    acquisition is also written to this file. If the acquisition fails, the
+    file is kept (see .checkpoint_file), and the acquisition can be continued
+    later with .resume(). If the acquisition is cancelled, the file is
+    deleted, unless keep_cancelled is True (and a checkpoint was saved).
+    Checkpointing is only available with the software synchronisation: in
+    driver synchronisation, the file of a failed acquisition is kept, but
+    the acquisition cannot be resumed.
+    The software synchronisation can also be run in "continuous scan" mode: the
+    SEM keeps scanning the spot (with a short dwell time) during the whole
+    acquisition, and only the e-beam translation is changed between each pixel.
+    This avoids the overhead of starting/stopping the SEM acquisition at every
+    pixel. The SEM value of a pixel is the average of all the SEM frames
+    received during the CCD acquisition.
     TODO: in software synchronisation, we can easily do our own fuzzing.
     """
     __metaclass__ = ABCMeta
-    def __init__(self, name, sem_stream, ccd_stream):
+    def __init__(self, name, sem_stream, ccd_stream, spool_dir=None,
+                 continuous=False, keep_cancelled=False):
+        """
+        spool_dir (None or str): directory where the data is stored during the
+          acquisition. If None, the default temporary directory is used.
+        keep_cancelled (bool): if True, the spool file of a cancelled
+          acquisition is kept, so that it can be resumed later. Otherwise, it
+          is deleted (to not fill up the disk with large files).
+        continuous (bool): if True, use the continuous scan mode for the
+          software synchronised acquisition.
+        """
         MultipleDetectorStream.__init__(self, name, [sem_stream, ccd_stream])
 
         self._sem_stream = sem_stream
@@ -100,11 +212,26 @@ class SEMCCDMDStream(MultipleDetectorStream):
         self._acq_start = 0 # time of acquisition beginning
         self._sem_data = None
         self._ccd_data = None
+        # Array containing all the CCD data, preallocated by the subclass
+        self._ccd_cube = None
+        self._spool_dir = spool_dir or tempfile.gettempdir()
+        self._ss_continuous = continuous
+        self._keep_cancelled = keep_cancelled
+        self._ss_sem_lock = threading.Lock() # for the continuous scan
+        self._ss_sem_buf = [] # SEM frames received for the current pixel
+        self._ss_sem_skip = 0 # number of SEM frames still to be discarded
+        self._acq_sem_ready = threading.Event() # the e-beam is at the spot
+        self._ss_sem_frame = None # SEM data received for the current pixel
 
         # For the drift correction
         self._dc_estimator = None
         self._current_future = None
 
+        # Checkpoint file to resume from on the next acquisition
+        self._resume_fn = None
+        # Checkpoint file of the last acquisition, if it was interrupted
+        self.checkpoint_file = None
+
         self.should_update = model.BooleanVA(False)
         self.is_active = model.BooleanVA(False)
 
@@ -164,6 +291,7 @@ class SEMCCDMDStream(MultipleDetectorStream):
         f = model.ProgressiveFuture(start=est_start,
                                     end=est_start + self.estimateAcquisitionTime())
         self._current_future = f
+        self.checkpoint_file = None
         self._acq_state = RUNNING # TODO: move to per acquisition
         # for progress time estimation
         self._prog_n = 0
@@ -189,16 +317,107 @@ class SEMCCDMDStream(MultipleDetectorStream):
         self._acq_thread.start()
         return f
 
+    def resume(self, filename):
+        """
+        Continue an acquisition which was interrupted, from its last checkpoint.
+        The settings of the streams and of the hardware must be the same as
+        during the interrupted acquisition.
+        filename (unicode): the checkpoint file (see .checkpoint_file)
+        returns (ProgressiveFuture): same as .acquire()
+        raises:
+          ValueError: if the file is not a checkpoint of such stream, or the
+            settings are different
+        """
+        state = _readCheckpointState(filename)
+        diffs = _compareSettings(state["settings"], self._getCheckpointSettings())
+        if diffs:
+            raise ValueError("Current settings differ from the checkpoint: %s" %
+                             ", ".join(diffs))
+
+        self._resume_fn = filename
+        try:
+            return self.acquire()
+        except Exception:
+            self._resume_fn = None
+            raise
+
+    def _getCheckpointSettings(self):
+        """
+        return (dict str -> value): all the settings which must be identical
+          to continue an acquisition
+        """
+        settings = {"stream": self.__class__.__name__,
+                    "emitter": self._emitter.name,
+                    "sem_detector": self._semd.name,
+                    "ccd": self._ccd.name,
+                    "repetition": tuple(self._ccd_stream.repetition.value),
+                    "roi": tuple(self._ccd_stream.roi.value),
+                    "continuous": self._ss_continuous,
+                    "dc_region": tuple(self._sem_stream.dcRegion.value),
+                    "dc_dwell_time": self._sem_stream.dcDwellTime.value,
+                    "dc_period": self._sem_stream.dcPeriod.value,
+                   }
+        for comp, vanames in ((self._emitter, CHECKPOINT_EMITTER_VAS),
+                              (self._ccd, CHECKPOINT_CCD_VAS)):
+            for vaname in vanames:
+                va = getattr(comp, vaname, None)
+                if isinstance(va, model.VigilantAttributeBase):
+                    settings["%s.%s" % (comp.name, vaname)] = va.value
+        return settings
+
+    def _ssWriteCheckpoint(self, spool, settings, npixels, nanchors, drift_tot):
+        """
+        Save the state of the acquisition, so that it can be resumed later
+        spool (hdf5.FrameStore): the file where the data is stored
+        settings (dict): the settings of the acquisition
+        npixels (int): number of pixels completely acquired and stored
+        nanchors (int): number of anchor areas stored
+        drift_tot (numpy array of 2 floats): total drift correction applied to
+          the spot positions
+        """
+        if self._dc_estimator is not None:
+            dc_state = self._dc_estimator.getState()
+        else:
+            dc_state = None
+        spool.state = {"version": CHECKPOINT_VERSION,
+                       "settings": settings,
+                       "streams": {"sem": (self._sem_stream.__class__.__name__,
+                                           self._sem_stream.name.value),
+                                   "ccd": (self._ccd_stream.__class__.__name__,
+                                           self._ccd_stream.name.value),
+                                   "md": self.name.value},
+                       "pixels": npixels,
+                       "anchors": nanchors,
+                       "drift": tuple(drift_tot),
+                       "dc": dc_state,
+                      }
+        spool.flush()
+        logging.debug("Checkpoint saved after %d pixels", npixels)
+
     @abstractmethod
     def _onSEMCCDData(self, sem_data, ccd_data):
         """
         called at the end of an entire acquisition
         sem_data (DataArray): the SEM data
         ccd_data (list of DataArray): the CCD data (ordered, with X changing
-          fast, then Y slow)
+          fast, then Y slow), as returned by _onCCDFrame()
         """
         pass
 
+    def _onCCDFrame(self, n, rep, data):
+        """
+        Called for each CCD frame, in order, as soon as it is received. It allows
+        the subclasses to copy the data directly at its final place (in
+        ._ccd_cube, allocated with _allocCCDCube()), instead of assembling
+        everything at the end.
+        n (int): index of the frame (with X changing fast, then Y slow)
+        rep (tuple of 2 int): X/Y repetition
+        data (DataArray): the CCD frame
+        return (DataArray): the frame to keep. It can be a view on ._ccd_cube,
+          in which case it must share the metadata of data.
+        """
+        return data
+
     def _updateProgress(self, future, dur, tot, bonus=0):
         """
         update end time of future by indicating the time for one new pixel
@@ -231,17 +450,21 @@ class SEMCCDMDStream(MultipleDetectorStream):
 
         # Do it in any case, to be sure
         self._semd_df.unsubscribe(self._ssOnSEMImage)
+        self._semd_df.unsubscribe(self._ssOnSEMImageContinuous)
         self._ccd_df.unsubscribe(self._ssOnCCDImage)
         self._ccd_df.synchronizedOn(None)
         # set the events, so the acq thread doesn't wait for them
         self._acq_ccd_complete.set()
         self._acq_sem_complete.set()
+        self._acq_sem_ready.set()
         return True
 
-    def _ssAdjustHardwareSettings(self):
+    def _ssAdjustHardwareSettings(self, continuous=False):
         """
         Read the SEM and AR stream settings and adapt the SEM scanner
         accordingly.
+        continuous (bool): if True, the dwell time is set for the continuous
+          scan mode (ie, a fraction of the CCD time)
         return (float): estimated time for a whole CCD image
         """
         # Set SEM to spot mode, without caring about actual position (set later)
@@ -255,8 +478,13 @@ class SEMCCDMDStream(MultipleDetectorStream):
         # Dwell time as long as possible, but better be slightly shorter than
         # CCD to be sure it is not slowing thing down.
         readout = numpy.prod(ccd_size) / self._ccd.readoutRate.value
+        dt = exp + readout
+        if continuous:
+            # Several SEM frames per CCD acquisition, to quickly know when the
+            # e-beam has moved to the next spot
+            dt = min(dt, max(dt / SS_CONT_SEM_FRAMES, SS_CONT_MIN_DWELL_TIME))
         rng = self._emitter.dwellTime.range
-        self._emitter.dwellTime.value = sorted(rng + (exp + readout,))[1] # clip
+        self._emitter.dwellTime.value = sorted(rng + (dt,))[1] # clip
 
         return exp + readout
 
@@ -290,26 +518,89 @@ class SEMCCDMDStream(MultipleDetectorStream):
         pos[:, :, 1] = numpy.linspace(lim_sem[1], lim_sem[3], repetition[1])
         return pos
 
+    def _allocCCDCube(self, shape, dtype):
+        """
+        Allocate the array to contain all the CCD data of the acquisition. It is
+        mapped on an (anonymous) temporary file in the spool directory, so that
+        the operating system can write it to the disk instead of keeping it
+        all in memory. The file is deleted as soon as the array is not used
+        anymore.
+        shape (tuple of ints): shape of the array
+        dtype (numpy.dtype): type of the data
+        return (numpy.memmap): the array, with undefined content
+        """
+        with tempfile.TemporaryFile(dir=self._spool_dir) as f:
+            # The memory map stays valid after the file is closed
+            return numpy.memmap(f, dtype=dtype, mode="w+", shape=shape)
+
+    def _createSpool(self):
+        """
+        Create the spool file to store the data while it's being acquired
+        return (hdf5.FrameStore): the file
+        """
+        fn = os.path.join(self._spool_dir, "odemis-acq-%d-%s.h5" %
+                          (os.getpid(), time.strftime("%Y%m%d-%H%M%S")))
+        logging.debug("Storing the acquisition data in %s", fn)
+        return hdf5.FrameStore(fn)
+
     def _ssRunAcquisition(self, future):
         """
         Acquires SEM/CCD images via software synchronisation.
-        Warning: can be quite memory consuming if the grid is big
+        The CCD data is stored on disk as soon as it is received, and the
+        state of the acquisition is saved at each checkpoint.
         returns (list of DataArray): all the data acquired
         raises:
           CancelledError() if cancelled
           Exceptions if error
         """
-        # TODO: handle better very large grid acquisition (than memory oops)
+        spool = None
+        store_executor = None
+        ccd_buf = None
+        ccd_frames = []
+        anchor_buf = None
+        dc_future = None
+        drift_tot = numpy.zeros(2) # total drift correction applied
+        checkpointed = False
+        continuous = self._ss_continuous
+        resume_fn, self._resume_fn = self._resume_fn, None
         try:
-            ccd_time = self._ssAdjustHardwareSettings()
+            settings = self._getCheckpointSettings()
+            ccd_time = self._ssAdjustHardwareSettings(continuous)
             dwell_time = self._emitter.dwellTime.value
             spot_pos = self._getSpotPositions()
             logging.debug("Generating %s spots for %g (=%g) s", spot_pos.shape[:2], ccd_time, dwell_time)
             rep = self._ccd_stream.repetition.value
             roi = self._ccd_stream.roi.value
-            self._sem_data = []
+            tot_num = numpy.prod(rep)
             self._ccd_data = None
-            ccd_buf = []
+            self._ccd_cube = None
+            if resume_fn is None:
+                spool = self._createSpool()
+                self._sem_data = spool.create_sequence("SEM", tot_num)
+                ccd_buf = spool.create_sequence("CCD", tot_num)
+                anchor_buf = spool.create_sequence("Anchor", tot_num + 1)
+                n_start = 0
+            else:
+                spool = hdf5.FrameStore(resume_fn, mode="a")
+                state = spool.state
+                n_start = state["pixels"]
+                logging.info("Resuming acquisition from %s at pixel %d/%d",
+                             resume_fn, n_start, tot_num)
+                self._sem_data = spool.open_sequence("SEM")
+                ccd_buf = spool.open_sequence("CCD")
+                anchor_buf = spool.open_sequence("Anchor")
+                # Drop anything received after the checkpoint
+                self._sem_data.truncate(n_start)
+                ccd_buf.truncate(n_start)
+                anchor_buf.truncate(state["anchors"])
+                drift_tot += state["drift"]
+                spot_pos -= drift_tot
+                if self._dc_estimator is not None and state["dc"] is not None:
+                    self._dc_estimator.setState(state["dc"], list(anchor_buf))
+                checkpointed = True
+
+            for k in range(n_start):
+                ccd_frames.append(self._onCCDFrame(k, rep, ccd_buf[k]))
             self._ccd_stream.raw = []
             self._sem_stream.raw = []
             logging.debug("Starting CCD acquisition with components %s and %s",
@@ -321,9 +612,23 @@ class SEMCCDMDStream(MultipleDetectorStream):
             trigger = self._ccd.softwareTrigger
             self._ccd_df.synchronizedOn(trigger)
             self._ccd_df.subscribe(self._ssOnCCDImage)
+            if continuous:
+                acquirePixel = self._ssAcquirePixelContinuous
+            else:
+                acquirePixel = self._ssAcquirePixel
+
+            # The CCD data is processed and stored in a separate thread, so that
+            # the next pixel is acquired meanwhile. Only one thread, to keep the
+            # order of the frames.
+            store_executor = model.CancellableThreadPoolExecutor(max_workers=1)
+            pending = collections.deque() # futures of the frames being stored
 
-            tot_num = numpy.prod(rep)
             n = 0
+            n_done = n_start
+            last_checkpoint = time.time()
+            # The drift is computed in the background while the next pixels are
+            # acquired, and applied at the beginning of the first pixel after
+            # the computation is over.
 
             # Translate dc_period to a number of pixels
             if self._dc_estimator is not None:
@@ -336,60 +641,54 @@ class SEMCCDMDStream(MultipleDetectorStream):
 
                 # First acquisition of anchor area
                 self._dc_estimator.acquire()
+                anchor_buf.append(self._dc_estimator.raw[-1])
+                if n_start > 0:
+                    # The sample might have drifted while interrupted
+                    dc_future = self._dc_estimator.estimateAsync()
+                    drift_tot += self._ssApplyDrift(spot_pos, dc_future)
+                    dc_future = None
             else:
                 dc_acq_time = 0
                 cur_dc_period = tot_num
 
-            for i in numpy.ndindex(*rep[::-1]): # last dim (X) iterates first
-                self._emitter.translation.value = (spot_pos[i[::-1]][0],
-                                                   spot_pos[i[::-1]][1])
-                logging.debug("E-beam spot after drift correction: %s",
-                              self._emitter.translation.value)
+            if continuous:
+                # The SEM stays subscribed during the whole acquisition
+                self._ss_sem_skip = -1 # nothing to record until the first move
+                self._semd_df.subscribe(self._ssOnSEMImageContinuous)
 
-                self._acq_sem_complete.clear()
-                self._acq_ccd_complete.clear()
-                self._semd_df.subscribe(self._ssOnSEMImage)
-                time.sleep(0) # give more chances spot has been already processed
-                start = time.time()
-                trigger.notify()
-
-                if not self._acq_ccd_complete.wait(ccd_time * 2 + 5):
-                    raise TimeoutError("Acquisition of CCD for pixel %s timed out after %g s"
-                                       % (i, ccd_time * 2 + 5))
-                if self._acq_state == CANCELLED:
-                    raise CancelledError()
-                dur = time.time() - start
-                if dur < ccd_time:
-                    logging.warning("CCD acquisition took less that %g s: %g s",
-                                    ccd_time, dur)
-
-                # FIXME: with the semcomedi, it fails if exposure time > 30s ?!
-                # Normally, the SEM acquisition has already completed
-                if not self._acq_sem_complete.wait(dwell_time * 1.5 + 1):
-                    raise TimeoutError("Acquisition of SEM pixel %s timed out after %g s"
-                                       % (i, dwell_time * 1.5 + 1))
-                # TODO: we don't really need to stop it, we could have a small
-                # dwell time, move the ebeam to the new position, and as soon as
-                # we get next acquisition we can expect the spot has moved. The
-                # advantage would be to avoid setting the ebeam back to resting
-                # position, and reduce overhead of stopping/starting.
-                self._semd_df.unsubscribe(self._ssOnSEMImage)
+            # last dim (X) iterates first
+            for i in itertools.islice(numpy.ndindex(*rep[::-1]), n_start, None):
+                if dc_future is not None and dc_future.done():
+                    drift_tot += self._ssApplyDrift(spot_pos, dc_future)
+                    dc_future = None
 
+                # The CCD doesn't report when its exposure is over, so the
+                # e-beam is only moved once the whole frame is received.
+                pos = tuple(spot_pos[i[::-1]])
+                self._ssMoveBeam(pos, continuous)
+                logging.debug("E-beam spot after drift correction: %s", pos)
+
+                start = acquirePixel(i, trigger, ccd_time, dwell_time)
                 if self._acq_state == CANCELLED:
                     raise CancelledError()
 
                 # MD_POS default to the center of the stage, but it needs to be
                 # the position of the e-beam
-                ccd_data = self._ccd_data
-                ccd_data.metadata[MD_POS] = self._sem_data[-1].metadata[MD_POS]
-                ccd_data.metadata[MD_DESCRIPTION] = self._ccd_stream.name.value
-                ccd_buf.append(ccd_data)
+                pos = self._sem_data[-1].metadata[MD_POS]
+                pending.append(store_executor.submit(self._ssStoreCCDData,
+                                                     ccd_buf, ccd_frames, rep,
+                                                     self._ccd_data, pos))
+                # Don't let too many frames wait (and check for errors)
+                while pending and (len(pending) > SS_PIPELINE_SIZE or pending[0].done()):
+                    pending.popleft().result()
 
                 n += 1
+                n_done += 1
                 # guess how many drift anchors to acquire
-                n_anchor = (tot_num - n) // cur_dc_period
+                n_anchor = (tot_num - n_done) // cur_dc_period
                 anchor_time = n_anchor * dc_acq_time
-                self._updateProgress(future, time.time() - start, tot_num, anchor_time)
+                self._updateProgress(future, time.time() - start,
+                                     tot_num - n_start, anchor_time)
 
                 # Check if it is time for drift correction
                 if self._dc_estimator is not None and n >= cur_dc_period:
@@ -397,20 +696,50 @@ class SEMCCDMDStream(MultipleDetectorStream):
 
                     # Cannot cancel during this time, but hopefully it's short
                     # Acquisition of anchor area
+                    if dc_future is not None:
+                        # Normally already finished, as it had a whole period
+                        drift_tot += self._ssApplyDrift(spot_pos, dc_future)
+                        dc_future = None
+                    if continuous:
+                        self._semd_df.unsubscribe(self._ssOnSEMImageContinuous)
                     self._dc_estimator.acquire()
+                    anchor_buf.append(self._dc_estimator.raw[-1])
 
                     if self._acq_state == CANCELLED:
                         raise CancelledError()
+                    if continuous:
+                        self._semd_df.subscribe(self._ssOnSEMImageContinuous)
 
-                    # Estimate drift and update next positions
-                    shift = self._dc_estimator.estimate()
-                    spot_pos[:, :, 0] -= shift[0]
-                    spot_pos[:, :, 1] -= shift[1]
+                    # Estimate drift (in the background), and update the next
+                    # positions once it is known
+                    dc_future = self._dc_estimator.estimateAsync()
 
                     n = 0
 
+                if time.time() > last_checkpoint + CHECKPOINT_PERIOD:
+                    # The state must correspond to all the frames stored
+                    while pending:
+                        pending.popleft().result()
+                    if dc_future is not None:
+                        drift_tot += self._ssApplyDrift(spot_pos, dc_future)
+                        dc_future = None
+                    self._ssWriteCheckpoint(spool, settings, n_done,
+                                            len(anchor_buf), drift_tot)
+                    checkpointed = True
+                    last_checkpoint = time.time()
+
+            self._semd_df.unsubscribe(self._ssOnSEMImage)
+            self._semd_df.unsubscribe(self._ssOnSEMImageContinuous)
             self._ccd_df.unsubscribe(self._ssOnCCDImage)
             self._ccd_df.synchronizedOn(None)
+            if self._dc_estimator is not None:
+                # Drift estimated after the last pixel is not needed
+                self._dc_estimator.close()
+
+            # Wait for all the frames to be stored
+            while pending:
+                pending.popleft().result()
+            store_executor.shutdown()
 
             with self._acq_lock:
                 if self._acq_state == CANCELLED:
@@ -420,13 +749,43 @@ class SEMCCDMDStream(MultipleDetectorStream):
             sem_one = self._assembleSEMData(rep, roi, self._sem_data) # shape is (Y, X)
             # explicitly add names to make sure they are different
             sem_one.metadata[MD_DESCRIPTION] = self._sem_stream.name.value
-            self._onSEMCCDData(sem_one, ccd_buf)
+            self._onSEMCCDData(sem_one, ccd_frames)
+            # All the data is now in memory
+            spool.close(delete=True)
         except Exception as exp:
+            if self._dc_estimator is not None:
+                self._dc_estimator.close()
+            if store_executor is not None:
+                # Stop storing before closing the file
+                store_executor.cancel()
+                store_executor.shutdown()
+            if spool is not None:
+                # Keep the data acquired so far, unless it was not wanted.
+                # A file passed to resume() always belongs to the caller.
+                cancelled = isinstance(exp, CancelledError) or self._acq_state == CANCELLED
+                keep = (not cancelled or resume_fn is not None or
+                        (checkpointed and self._keep_cancelled))
+                if keep and ccd_buf is not None:
+                    try:
+                        if (dc_future is not None and not dc_future.cancelled()
+                            and dc_future.exception() is None):
+                            drift_tot += dc_future.result()
+                        self._ssWriteCheckpoint(spool, settings, len(ccd_buf),
+                                                len(anchor_buf), drift_tot)
+                    except Exception:
+                        logging.exception("Failed to save the checkpoint")
+                    self.checkpoint_file = spool.filename
+                spool.close(delete=not keep)
+                if keep:
+                    logging.warning("Partial acquisition data kept in %s, "
+                                    "the acquisition can be resumed from it",
+                                    spool.filename)
             if not isinstance(exp, CancelledError):
                 logging.exception("Software sync acquisition of SEM/CCD failed")
 
             # make sure it's all stopped
             self._semd_df.unsubscribe(self._ssOnSEMImage)
+            self._semd_df.unsubscribe(self._ssOnSEMImageContinuous)
             self._ccd_df.unsubscribe(self._ssOnCCDImage)
             self._ccd_df.synchronizedOn(None)
 
@@ -439,16 +798,207 @@ class SEMCCDMDStream(MultipleDetectorStream):
         else:
             return self.raw
         finally:
-            del self._sem_data # regain a bit of memory
+            self._sem_data = None
+            self._ccd_data = None # regain a bit of memory
+            self._ccd_cube = None
+            self._ss_sem_buf = []
+
+    def _ssApplyDrift(self, spot_pos, dc_future):
+        """
+        Shift the spot positions by the drift estimated
+        spot_pos (numpy array of shape YxXx2): the spot positions, updated
+        dc_future (Future): drift estimation, as returned by
+          AnchoredEstimator.estimateAsync(). It will be waited for, if not yet
+          finished.
+        return (float, float): the shift applied
+        """
+        shift = dc_future.result()
+        logging.debug("Applying drift correction of %s px", shift)
+        spot_pos[:, :, 0] -= shift[0]
+        spot_pos[:, :, 1] -= shift[1]
+        return shift
+
+    def _ssStoreCCDData(self, ccd_buf, ccd_frames, rep, data, pos):
+        """
+        Update the metadata of a CCD frame and store it
+        ccd_buf (FrameSequence): where to save the frame (on disk)
+        ccd_frames (list of DataArray): where to keep the frame (as returned
+          by _onCCDFrame())
+        rep (tuple of 2 int): X/Y repetition
+        data (DataArray): the CCD frame
+        pos (float, float): position of the e-beam during the acquisition
+        """
+        data.metadata[MD_POS] = pos
+        data.metadata[MD_DESCRIPTION] = self._ccd_stream.name.value
+        frame = self._onCCDFrame(len(ccd_frames), rep, data)
+        ccd_buf.append(frame)
+        ccd_frames.append(frame)
+
+    def _ssMoveBeam(self, pos, continuous):
+        """
+        Move the e-beam to a new spot
+        pos (float, float): the e-beam translation
+        continuous (bool): True if the SEM is scanning during the whole
+          acquisition (see _ssAcquirePixelContinuous())
+        """
+        if not continuous:
+            # Stop scanning, so that the SEM data received is from the new spot
+            self._semd_df.unsubscribe(self._ssOnSEMImage)
+        self._emitter.translation.value = pos
+        if continuous:
+            # The e-beam translation has just been changed. It's only effective
+            # for the SEM frames started after, so discard the first ones received.
+            with self._ss_sem_lock:
+                self._ss_sem_buf = []
+                self._ss_sem_skip = SS_CONT_SKIP_FRAMES
+                self._acq_sem_ready.clear()
+                self._acq_sem_complete.clear()
+        else:
+            # The SEM keeps scanning the spot until the next move, which
+            # ensures the e-beam stays at the right place
+            self._acq_sem_complete.clear()
+            self._semd_df.subscribe(self._ssOnSEMImage)
+
+    def _ssWaitCCD(self, i, start, ccd_time):
+        """
+        Wait for the CCD data of the current pixel (stored in ._ccd_data)
+        i (tuple of int): index of the pixel (for logging)
+        start (float): time the CCD acquisition was triggered
+        ccd_time (float): expected duration of the CCD acquisition
+        raises TimeoutError if the CCD takes too long
+        """
+        if not self._acq_ccd_complete.wait(ccd_time * 2 + 5):
+            raise TimeoutError("Acquisition of CCD for pixel %s timed out after %g s"
+                               % (i, ccd_time * 2 + 5))
+        if self._acq_state == CANCELLED:
+            raise CancelledError()
+        dur = time.time() - start
+        if dur < ccd_time:
+            logging.warning("CCD acquisition took less that %g s: %g s",
+                            ccd_time, dur)
+
+    def _ssWaitSEM(self, i, dwell_time):
+        """
+        Wait for the SEM data of the current pixel, and append it to ._sem_data
+        i (tuple of int): index of the pixel (for logging)
+        dwell_time (float): SEM dwell time
+        raises TimeoutError if the SEM takes too long
+        """
+        # FIXME: with the semcomedi, it fails if exposure time > 30s ?!
+        # Normally, the SEM acquisition has already completed
+        if not self._acq_sem_complete.wait(dwell_time * 1.5 + 1):
+            raise TimeoutError("Acquisition of SEM pixel %s timed out after %g s"
+                               % (i, dwell_time * 1.5 + 1))
+        if self._acq_state == CANCELLED:
+            raise CancelledError()
+        self._sem_data.append(self._ss_sem_frame)
+
+    def _ssAcquirePixel(self, i, trigger, ccd_time, dwell_time):
+        """
+        Acquire the SEM and CCD data for the pixel at the current e-beam
+        position, by starting and stopping the SEM acquisition.
+        The SEM data is appended to ._sem_data, and the CCD data is in ._ccd_data.
+        i (tuple of int): index of the pixel (for logging)
+        trigger (Event): the software trigger of the CCD
+        ccd_time (float): expected duration of the CCD acquisition
+        dwell_time (float): SEM dwell time
+        return (float): time the CCD acquisition was triggered
+        """
+        self._acq_ccd_complete.clear()
+        # If cancelled before the event was cleared, no one will set it anymore
+        if self._acq_state == CANCELLED:
+            raise CancelledError()
+        time.sleep(0) # give more chances spot has been already processed
+        start = time.time()
+        trigger.notify()
+
+        self._ssWaitCCD(i, start, ccd_time)
+        self._ssWaitSEM(i, dwell_time)
+        self._semd_df.unsubscribe(self._ssOnSEMImage)
+        return start
+
+    def _ssAcquirePixelContinuous(self, i, trigger, ccd_time, dwell_time):
+        """
+        Acquire the SEM and CCD data for the pixel at the current e-beam
+        position, while the SEM is continuously scanning.
+        Same arguments and return value as _ssAcquirePixel().
+        """
+        timeout = dwell_time * (SS_CONT_SKIP_FRAMES + 1) * 1.5 + 1
+        if not self._acq_sem_ready.wait(timeout):
+            raise TimeoutError("E-beam move to pixel %s timed out after %g s"
+                               % (i, timeout))
+        # The e-beam is now on the spot
+        self._acq_ccd_complete.clear()
+        # If cancelled before the event was cleared, no one will set it anymore
+        if self._acq_state == CANCELLED:
+            raise CancelledError()
+
+        start = time.time()
+        trigger.notify()
+
+        self._ssWaitCCD(i, start, ccd_time)
+        self._ssWaitSEMContinuous(i, dwell_time)
+        return start
+
+    def _ssWaitSEMContinuous(self, i, dwell_time):
+        """
+        Wait for the SEM data of the current pixel, in continuous scan mode, and
+        append their average to ._sem_data
+        i (tuple of int): index of the pixel (for logging)
+        dwell_time (float): SEM dwell time
+        raises TimeoutError if the SEM takes too long
+        """
+        # Typically, several SEM frames have been already received
+        if not self._acq_sem_complete.wait(dwell_time * 1.5 + 1):
+            raise TimeoutError("Acquisition of SEM pixel %s timed out after %g s"
+                               % (i, dwell_time * 1.5 + 1))
+        if self._acq_state == CANCELLED:
+            raise CancelledError()
+        with self._ss_sem_lock:
+            sem_frames = self._ss_sem_buf
+            self._ss_sem_buf = []
+            # Don't record anything more until the next move
+            self._ss_sem_skip = -1
+        self._sem_data.append(self._mergeSEMFrames(sem_frames))
+
+    def _mergeSEMFrames(self, das):
+        """
+        Average the SEM frames acquired at the same spot
+        das (list of DataArray of shape (1, 1)): the frames
+        return (DataArray of shape (1, 1)): the average, with the same dtype and
+          the metadata of the first frame
+        """
+        if len(das) == 1:
+            return das[0]
+
+        md = das[0].metadata.copy()
+        if model.MD_DWELL_TIME in md:
+            md[model.MD_DWELL_TIME] *= len(das)
+        dtype = das[0].dtype
+        mean = numpy.mean(das, axis=0)
+        if dtype.kind in "biu":
+            mean = numpy.round(mean)
+        return model.DataArray(mean.astype(dtype), md)
 
     def _ssOnSEMImage(self, df, data):
         logging.debug("SEM data received")
         # Do not stop the acquisition, as it ensures the e-beam is at the right place
         if not self._acq_sem_complete.is_set():
             # only use the first data per pixel
-            self._sem_data.append(data)
+            self._ss_sem_frame = data
             self._acq_sem_complete.set()
 
+    def _ssOnSEMImageContinuous(self, df, data):
+        with self._ss_sem_lock:
+            if self._ss_sem_skip > 0:
+                # The frame might have been (partly) acquired before the move
+                self._ss_sem_skip -= 1
+                if self._ss_sem_skip == 0:
+                    self._acq_sem_ready.set()
+            elif self._ss_sem_skip == 0:
+                self._ss_sem_buf.append(data)
+                self._acq_sem_complete.set()
+
     def _ssOnCCDImage(self, df, data):
         logging.debug("CCD data received")
         self._ccd_data = data
@@ -461,8 +1011,9 @@ class SEMCCDMDStream(MultipleDetectorStream):
 
         rep (tuple of 2 0<ints): X/Y repetition
         roi (tupel of 3 0<floats<=1): region of interest in logical coordinates
-        data_list (list of M DataArray of shape (1, 1)): all the data received,
-        with X variating first, then Y.
+        data_list (sequence of M DataArray of shape (1, 1)): all the data
+        received, with X variating first, then Y. It can be a list or a
+        hdf5.FrameSequence.
         """
         assert len(data_list) > 0
 
@@ -494,8 +1045,8 @@ class SEMCCDMDStream(MultipleDetectorStream):
         md.update({MD_POS: (posx, posy),
                    MD_PIXEL_SIZE: pxs})
 
-        # concatenate data into one big array of (number of pixels,1)
-        sem_data = numpy.concatenate(data_list)
+        # read all the data into one big array of (number of pixels, 1, 1)
+        sem_data = numpy.asarray(data_list[:])
         # reshape to (Y, X)
         sem_data.shape = rep[::-1]
         sem_data = model.DataArray(sem_data, metadata=md)
@@ -572,13 +1123,22 @@ class SEMCCDMDStream(MultipleDetectorStream):
           CancelledError() if cancelled
           Exceptions if error
         """
+        # The CCD frames are copied to their final place, and stored on disk,
+        # in a separate thread, as the dataflow subscribers must be fast
+        self._acq_ccd_executor = model.CancellableThreadPoolExecutor(max_workers=1)
+        self._acq_ccd_pending = []
+        self._acq_ccd_buf = []
+        spool = None
         try:
             # reset everything (ready for one acquisition)
             tot_time = self._dsAdjustHardwareSettings()
             rep = self._ccd_stream.repetition.value
             self._acq_ccd_tot = numpy.prod(rep)
+            spool = self._createSpool()
+            self._acq_ccd_seq = spool.create_sequence("CCD", self._acq_ccd_tot)
+            self._acq_rep = rep
+            self._ccd_cube = None
             self._acq_ccd_n = 0
-            self._acq_ccd_buf = []
             self._sem_data = None # One DataArray
             self._acq_ccd_complete.clear()
             self._acq_sem_complete.clear()
@@ -595,6 +1155,10 @@ class SEMCCDMDStream(MultipleDetectorStream):
                 raise TimeoutError("Acquisition of SEM/CCD timed out")
             self._ccd_df.synchronizedOn(None)
 
+            # Wait for all the frames to be copied (and check for errors)
+            for f in self._acq_ccd_pending:
+                f.result()
+
             with self._acq_lock:
                 if self._acq_state == CANCELLED:
                     raise CancelledError()
@@ -612,9 +1176,19 @@ class SEMCCDMDStream(MultipleDetectorStream):
                 d.metadata[MD_DESCRIPTION] = ccd_stream_name
             sem_md[MD_DESCRIPTION] = self._sem_stream.name.value
             self._onSEMCCDData(self._sem_data, self._acq_ccd_buf)
+            # All the data is now in the final arrays
+            spool.close(delete=True)
         except Exception as exp:
             if not isinstance(exp, CancelledError):
                 logging.exception("Driver sync acquisition of SEM/CCD failed")
+            if spool is not None:
+                # Stop storing before closing the file
+                self._acq_ccd_executor.cancel()
+                self._acq_ccd_executor.shutdown()
+                cancelled = isinstance(exp, CancelledError) or self._acq_state == CANCELLED
+                spool.close(delete=cancelled)
+                if not cancelled:
+                    logging.warning("Partial CCD data kept in %s", spool.filename)
 
             # make sure it's all stopped
             self._semd_df.unsubscribe(self._dsOnSEMImage)
@@ -630,7 +1204,12 @@ class SEMCCDMDStream(MultipleDetectorStream):
         else:
             return self.raw
         finally:
+            self._acq_ccd_executor.cancel()
+            self._acq_ccd_executor.shutdown()
             del self._acq_ccd_buf # regain a bit of memory
+            self._acq_ccd_seq = None
+            self._acq_ccd_pending = []
+            self._ccd_cube = None
 
     def _dsUpdateCCDMetadata(self, das, rep, pos, pxs):
         """
@@ -648,10 +1227,23 @@ class SEMCCDMDStream(MultipleDetectorStream):
             d.metadata[MD_POS] = (pos0[0] + idx[1] * pxs[0],
                                   pos0[1] + idx[0] * pxs[1])
 
+    def _dsStoreCCDData(self, n, data):
+        """
+        Copy a CCD frame to its final place, and store it on disk
+        n (int): index of the frame
+        data (DataArray): the CCD frame
+        """
+        frame = self._onCCDFrame(n, self._acq_rep, data)
+        self._acq_ccd_seq.append(frame)
+        self._acq_ccd_buf[n] = frame
+
     def _dsOnCCDImage(self, df, data):
         # the data array subscribers must be fast, so the real processing
         # takes place later
         self._acq_ccd_buf.append(data)
+        f = self._acq_ccd_executor.submit(self._dsStoreCCDData,
+                                          self._acq_ccd_n, data)
+        self._acq_ccd_pending.append(f)
 
         self._acq_ccd_n += 1
         # FIXME: update to new interface of updateProgress()
@@ -672,17 +1264,38 @@ class SEMSpectrumMDStream(SEMCCDMDStream):
     Multiple detector Stream made of SEM + Spectrum.
     It handles acquisition, but not rendering (so .image always returns an empty
     image).
+    During the acquisition, a preview of the data acquired so far is provided
+    in .previewImage (the mean over .previewBandwidth of each spectrum, as a
+    float DataArray of shape Y, X, with NaN for the pixels not yet acquired),
+    and .lastSpectrum (the latest spectrum acquired). They are updated at most
+    every PREVIEW_PERIOD.
     """
+    def __init__(self, name, sem_stream, ccd_stream, **kwargs):
+        SEMCCDMDStream.__init__(self, name, sem_stream, ccd_stream, **kwargs)
+
+        # Wavelength range (in m) used for the preview image. By default,
+        # everything.
+        self.previewBandwidth = model.TupleContinuous((0, 1), ((0, 0), (1, 1)),
+                                                      unit="m",
+                                                      cls=(int, long, float))
+        self.previewImage = model.VigilantAttribute(None)
+        self.lastSpectrum = model.VigilantAttribute(None)
+
+        self._preview_lock = threading.Lock()
+        self._preview = None # numpy array Y, X of float
+        self._preview_band = slice(None) # indices of the preview band
+        self._preview_n = 0 # number of pixels in the preview
+        self._last_spec = None # DataArray of shape N
+        self.previewBandwidth.subscribe(self._onPreviewBandwidth)
 
     def _onSEMCCDData(self, sem_data, ccd_data):
         """
         cf SEMCCDMDStream._onSEMCCDData()
         """
         assert ccd_data[0].shape[-2] == 1 # should be a spectra (Y == 1)
-        repetition = sem_data.shape[-1:-3:-1] # 1,1,1,Y,X -> X, Y
 
-        # assemble all the CCD data into one
-        spec_data = self._assembleSpecData(ccd_data, repetition)
+        # All the data is already in place
+        spec_data = model.DataArray(self._ccd_cube, ccd_data[0].metadata.copy())
         md_sem = sem_data.metadata
         try:
             spec_data.metadata[MD_PIXEL_SIZE] = md_sem[MD_PIXEL_SIZE]
@@ -694,31 +1307,85 @@ class SEMSpectrumMDStream(SEMCCDMDStream):
         self._ccd_stream.raw = [spec_data]
         self._sem_stream.raw = [sem_data]
 
-    def _assembleSpecData(self, data_list, repetition):
+    def _onCCDFrame(self, n, rep, data):
         """
-        Take all the data received from the spectrometer and assemble it in a
-        cube.
-
-        data_list (list of M DataArray of shape (1, N)): all the data received
-        repetition (list of 2 int): X,Y shape of the high dimensions of the cube
-         so that X * Y = M
-        return (DataArray)
+        cf SEMCCDMDStream._onCCDFrame()
         """
-        assert len(data_list) > 0
-
-        # each element of acq_spect_buf has a shape of (1, N)
-        # reshape to (N, 1)
-        for e in data_list:
-            e.shape = e.shape[::-1]
-        # concatenate into one big array of (N, number of pixels)
-        spec_data = numpy.concatenate(data_list, axis=1)
-        # reshape to (C, 1, 1, Y, X) (as C must be the 5th dimension)
-        spec_res = data_list[0].shape[0]
-        spec_data.shape = (spec_res, 1, 1, repetition[1], repetition[0])
+        if n == 0:
+            # Allocate the whole cube (C, 1, 1, Y, X) at the first spectrum
+            spec_res = data.shape[-1]
+            cube = self._allocCCDCube((spec_res, 1, 1, rep[1], rep[0]), data.dtype)
+            with self._preview_lock:
+                # No pixel of the preview is computed from the new cube yet
+                self._ccd_cube = cube
+                self._preview_n = 0
+        y, x = divmod(n, rep[0])
+        spec = self._ccd_cube[:, 0, 0, y, x]
+        spec[...] = data[0]
+
+        # Update the preview incrementally: only the new pixel is computed
+        with self._preview_lock:
+            self._last_spec = model.DataArray(spec, data.metadata)
+            if n == 0:
+                self._preview = numpy.empty((rep[1], rep[0]), dtype=numpy.float64)
+                self._preview[...] = numpy.nan
+                self._preview_band = self._getPreviewBand(self._last_spec,
+                                                          self.previewBandwidth.value)
+            self._preview[y, x] = spec[self._preview_band].mean()
+            self._preview_n = n + 1
+        self._updatePreview()
+
+        # Keep a view, with shape (1, N), to release the original data
+        return model.DataArray(spec[numpy.newaxis], data.metadata)
+
+    def _getPreviewBand(self, spec, bandwidth):
+        """
+        Find the indices corresponding to the wavelength band
+        spec (DataArray of shape N): a spectrum, with the wavelength metadata
+        bandwidth (float, float): min/max wavelength (in m)
+        return (slice): the indices in the band. If not possible to know, or
+          if empty, all the spectrum is used.
+        """
+        try:
+            wl = numpy.asarray(spectrum.get_wavelength_per_pixel(spec))
+        except (AttributeError, KeyError, ValueError):
+            logging.debug("No wavelength information, using the whole spectrum for preview")
+            return slice(None)
+
+        inband = numpy.nonzero((bandwidth[0] <= wl) & (wl <= bandwidth[1]))[0]
+        if len(inband) == 0:
+            logging.info("No wavelength in %s, using the whole spectrum for preview",
+                         bandwidth)
+            return slice(None)
+        return slice(inband[0], inband[-1] + 1)
+
+    def _onPreviewBandwidth(self, bandwidth):
+        with self._preview_lock:
+            # The acquisition thread drops the cube when it's over
+            cube = self._ccd_cube
+            if self._preview is None or cube is None:
+                return # no acquisition running
+            self._preview_band = self._getPreviewBand(self._last_spec, bandwidth)
+            # Recompute the pixels already acquired, directly from the cube
+            n = self._preview_n
+            flat_cube = cube.reshape(cube.shape[0], -1)
+            self._preview.reshape(-1)[:n] = flat_cube[self._preview_band, :n].mean(axis=0)
+        self._updatePreview()
+
+    @limit_invocation(PREVIEW_PERIOD)
+    def _updatePreview(self):
+        """
+        Publish the preview of the current acquisition
+        """
+        with self._preview_lock:
+            if self._preview is None:
+                return
+            im = model.DataArray(self._preview.copy(),
+                                 {MD_DESCRIPTION: self.name.value})
+            spec = model.DataArray(self._last_spec.copy(), self._last_spec.metadata.copy())
 
-        # copy the metadata from the first point and add the ones from metadata
-        md = data_list[0].metadata
-        return model.DataArray(spec_data, metadata=md)
+        self.previewImage.value = im
+        self.lastSpectrum.value = spec
 
 
 class SEMARMDStream(SEMCCDMDStream):
@@ -732,14 +1399,28 @@ class SEMARMDStream(SEMCCDMDStream):
         """
         cf SEMCCDMDStream._onSEMCCDData()
         """
-        # Not much to do: just save everything as is
+        # Not much to do: just save everything as is (each image is already
+        # part of the preallocated array)
 
         # MD_AR_POLE is set automatically, copied from the lens property.
         # In theory it's dependant on MD_POS, but so slightly that we don't need
         # to correct it.
-        self._ccd_stream.raw = ccd_data
+        self._ccd_stream.raw = list(ccd_data)
         self._sem_stream.raw = [sem_data]
 
+    def _onCCDFrame(self, n, rep, data):
+        """
+        cf SEMCCDMDStream._onCCDFrame()
+        """
+        if n == 0:
+            # Allocate all the images at once, as (Y, X, h, w)
+            self._ccd_cube = self._allocCCDCube((rep[1], rep[0]) + data.shape,
+                                                data.dtype)
+        y, x = divmod(n, rep[0])
+        im = self._ccd_cube[y, x]
+        im[...] = data
+        return model.DataArray(im, data.metadata)
+
 
 # On the SPARC, it's possible that both the AR and Spectrum are acquired in the
 # same acquisition, but it doesn't make much sense to acquire them
@@ -24,9 +24,11 @@ import logging
 import numpy
 from odemis import model, acq
 import odemis
+from odemis.acq import _futures, timing
 from odemis.util import driver
 import os
 import subprocess
+import threading
 import time
 import unittest
 from unittest.case import skip
@@ -44,11 +46,141 @@ CONFIG_PATH = os.path.dirname(__file__) + "/../../../../install/linux/usr/share/
 SPARC_CONFIG = CONFIG_PATH + "sparc-sim.odm.yaml"
 SECOM_CONFIG = CONFIG_PATH + "secom-sim.odm.yaml"
 
+class FakeComponent(model.HwComponent):
+    def __init__(self, name):
+        model.HwComponent.__init__(self, name, "fake")
+
+class FakeAcqStream(object):
+    """
+    Just enough of a stream to be acquired: it waits the given duration and
+    returns a small image.
+    """
+    def __init__(self, name, detector, emitter, duration):
+        self.name = model.StringVA(name)
+        self._detector = detector
+        self._emitter = emitter
+        self._duration = duration
+        self.cancelled = False
+
+    def estimateAcquisitionTime(self):
+        return self._duration
+
+    def acquire(self):
+        f = model.ProgressiveFuture(end=time.time() + self._duration)
+        ended = threading.Event()
+
+        def run():
+            if ended.wait(self._duration):
+                raise CancelledError()
+            return [model.DataArray(numpy.zeros((4, 4)),
+                                    {model.MD_DESCRIPTION: self.name.value})]
+
+        def cancel(future):
+            self.cancelled = True
+            ended.set()
+            return True
+
+        f.task_canceller = cancel
+        thread = threading.Thread(target=_futures.executeTask, args=(f, run))
+        thread.start()
+        return f
+
+class FakeOpticalStream(FakeAcqStream):
+    pass
+
+stream.OpticalStream.register(FakeOpticalStream)
+
+class FakeEMStream(FakeAcqStream):
+    pass
+
+stream.EMStream.register(FakeEMStream)
+
 class TestNoBackend(unittest.TestCase):
     # No backend, and only fake streams that don't generate anything
 
-    # TODO
-    pass
+    @classmethod
+    def setUpClass(cls):
+        cls.ebeam = FakeComponent("ebeam")
+        cls.sed = FakeComponent("sed")
+        cls.bsd = FakeComponent("bsd")
+        cls.light = FakeComponent("light")
+        cls.ccd = FakeComponent("camera")
+
+    def setUp(self):
+        # Don't learn from (or store) the fake acquisitions
+        timing._model = timing.TimingModel()
+
+    def tearDown(self):
+        timing._model = None
+
+    def test_concurrent(self):
+        """
+        Streams using different hardware are acquired simultaneously
+        """
+        s1 = FakeAcqStream("sem", self.sed, self.ebeam, 1)
+        s2 = FakeAcqStream("optical", self.ccd, self.light, 1.5)
+        streams = [s1, s2]
+        self.assertAlmostEqual(acq.estimateTime(streams), 1.5)
+
+        start = time.time()
+        f = acq.acquire(streams)
+        data, e = f.result()
+        dur = time.time() - start
+        self.assertIsNone(e)
+        self.assertEqual(len(data), 2)
+        self.assertLess(dur, 2.3)
+
+    def test_conflict(self):
+        """
+        Streams sharing hardware are acquired one after another
+        """
+        s1 = FakeAcqStream("sem", self.sed, self.ebeam, 1)
+        s2 = FakeAcqStream("sem bsd", self.bsd, self.ebeam, 1)
+        s3 = FakeAcqStream("optical", self.ccd, self.light, 0.5)
+        streams = [s1, s2, s3]
+        self.assertAlmostEqual(acq.estimateTime(streams), 2)
+
+        start = time.time()
+        f = acq.acquire(streams)
+        data, e = f.result()
+        dur = time.time() - start
+        self.assertIsNone(e)
+        self.assertEqual(len(data), 3)
+        self.assertGreaterEqual(dur, 2)
+        self.assertLess(dur, 3)
+
+    def test_optical_em(self):
+        """
+        Optical and SEM streams are not acquired simultaneously, even if they
+        use different hardware
+        """
+        s1 = FakeEMStream("sem", self.sed, self.ebeam, 1)
+        s2 = FakeOpticalStream("brightfield", self.ccd, self.light, 1)
+        streams = [s1, s2]
+        self.assertAlmostEqual(acq.estimateTime(streams), 2)
+
+        start = time.time()
+        f = acq.acquire(streams)
+        data, e = f.result()
+        dur = time.time() - start
+        self.assertIsNone(e)
+        self.assertEqual(len(data), 2)
+        self.assertGreaterEqual(dur, 2)
+
+    def test_cancel(self):
+        """
+        All the streams being acquired are cancelled
+        """
+        s1 = FakeAcqStream("sem", self.sed, self.ebeam, 2)
+        s2 = FakeAcqStream("optical", self.ccd, self.light, 2)
+        s3 = FakeAcqStream("sem bsd", self.bsd, self.ebeam, 2)
+        f = acq.acquire([s1, s2, s3])
+        time.sleep(0.5)
+        self.assertTrue(f.running())
+        f.cancel()
+        self.assertRaises(CancelledError, f.result, 1)
+        self.assertTrue(s1.cancelled or s3.cancelled)
+        self.assertTrue(s2.cancelled)
 
 #@skip("simple")
 class SECOMTestCase(unittest.TestCase):
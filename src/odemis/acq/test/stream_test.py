@@ -21,15 +21,20 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 # Test module for model.Stream classes
 from __future__ import division
 
+from concurrent import futures
 import logging
 import numpy
 from odemis import model
 import odemis
 from odemis.acq import stream, calibration
+from odemis.acq.stream import _sync
 from odemis.driver import simcam
 from odemis.util import driver, conversion, timeout, img
 import os
+import shutil
 import subprocess
+import tempfile
+import threading
 import time
 import unittest
 from unittest.case import skip
@@ -652,6 +657,18 @@ class SPARCTestCase(unittest.TestCase):
         self.assertIn(model.MD_POS, md)
         self.assertIn(model.MD_AR_POLE, md)
 
+        # The images must be in order: X changes first, then Y
+        pos = [d.metadata[model.MD_POS] for d in ars.raw]
+        rep = ars.repetition.value
+        for y in range(rep[1]):
+            line = pos[y * rep[0]:(y + 1) * rep[0]]
+            for p0, p1 in zip(line[:-1], line[1:]):
+                self.assertLess(p0[0], p1[0])
+                self.assertAlmostEqual(p0[1], p1[1])
+        for p0, p1 in zip(pos[:-rep[0]], pos[rep[0]:]):
+            self.assertAlmostEqual(p0[0], p1[0])
+            self.assertNotAlmostEqual(p0[1], p1[1])
+
 #    @skip("simple")
     def test_acq_spec(self):
         """
@@ -718,6 +735,189 @@ class SPARCTestCase(unittest.TestCase):
         self.assertAlmostEqual(sem_md[model.MD_POS], spec_md[model.MD_POS])
         self.assertAlmostEqual(sem_md[model.MD_PIXEL_SIZE], spec_md[model.MD_PIXEL_SIZE])
 
+    def test_acq_spec_continuous(self):
+        """
+        Compare the acquisition for Spectrometer with and without continuous
+        scan mode
+        """
+        self.spec.exposureTime.value = 0.01 # s
+        durs = {}
+        for continuous in (False, True):
+            sems = stream.SEMStream("test sem", self.sed, self.sed.data, self.ebeam)
+            specs = stream.SpectrumSettingsStream("test spec", self.spec, self.spec.data, self.ebeam)
+            sps = stream.SEMSpectrumMDStream("test sem-spec", sems, specs,
+                                             continuous=continuous)
+            specs.roi.value = (0.15, 0.6, 0.8, 0.8)
+            specs.repetition.value = (10, 8)
+            exp_shape = specs.repetition.value[::-1]
+
+            timeout = 5 + 3 * sps.estimateAcquisitionTime()
+            start = time.time()
+            f = sps.acquire()
+            data = f.result(timeout)
+            durs[continuous] = time.time() - start
+            logging.info("Acquisition with continuous=%s took %g s",
+                         continuous, durs[continuous])
+
+            self.assertEqual(len(data), 2)
+            self.assertEqual(sems.raw[0].shape, exp_shape)
+            sshape = specs.raw[0].shape
+            self.assertEqual(sshape[-2:], exp_shape)
+            sem_md = sems.raw[0].metadata
+            spec_md = specs.raw[0].metadata
+            self.assertAlmostEqual(sem_md[model.MD_POS], spec_md[model.MD_POS])
+
+        # Not starting/stopping the SEM at each pixel should be faster
+        self.assertLess(durs[True], durs[False])
+
+    def test_acq_spec_drift(self):
+        """
+        Test acquisition for Spectrometer with drift correction
+        """
+        sems = stream.SEMStream("test sem", self.sed, self.sed.data, self.ebeam)
+        specs = stream.SpectrumSettingsStream("test spec", self.spec, self.spec.data, self.ebeam)
+        sps = stream.SEMSpectrumMDStream("test sem-spec", sems, specs)
+
+        specs.roi.value = (0.15, 0.6, 0.8, 0.8)
+        self.spec.exposureTime.value = 0.01 # s
+        specs.repetition.value = (10, 8)
+        exp_shape = specs.repetition.value[::-1]
+
+        sems.dcRegion.value = (0.525, 0.525, 0.6, 0.6)
+        sems.dcPeriod.value = 0.1 # s => correct every few pixels
+        sems.dcDwellTime.value = 1e-06
+
+        timeout = 5 + 3 * sps.estimateAcquisitionTime()
+        f = sps.acquire()
+        data = f.result(timeout)
+        self.assertEqual(len(data), 2)
+        self.assertEqual(sems.raw[0].shape, exp_shape)
+        self.assertEqual(specs.raw[0].shape[-2:], exp_shape)
+
+        # The anchor area is acquired several times, and the estimation thread
+        # is stopped at the end
+        dc_estimator = sps._dc_estimator
+        self.assertGreater(len(dc_estimator.raw), 2)
+        self.assertIsNone(dc_estimator._executor)
+
+    def test_acq_spec_resume(self):
+        """
+        Test an interrupted acquisition for Spectrometer can be resumed
+        """
+        sems = stream.SEMStream("test sem", self.sed, self.sed.data, self.ebeam)
+        specs = stream.SpectrumSettingsStream("test spec", self.spec, self.spec.data, self.ebeam)
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir)
+        sps = stream.SEMSpectrumMDStream("test sem-spec", sems, specs,
+                                         spool_dir=spool_dir)
+        sps_keep = stream.SEMSpectrumMDStream("test sem-spec", sems, specs,
+                                              spool_dir=spool_dir, keep_cancelled=True)
+
+        specs.roi.value = (0.15, 0.6, 0.8, 0.8)
+        self.spec.exposureTime.value = 0.05 # s
+        specs.repetition.value = (8, 6)
+        exp_shape = specs.repetition.value[::-1]
+
+        # Checkpoint after every pixel
+        orig_period = _sync.CHECKPOINT_PERIOD
+        _sync.CHECKPOINT_PERIOD = 0
+        try:
+            # By default, the spool file is deleted when cancelling
+            f = sps.acquire()
+            time.sleep(sps.estimateAcquisitionTime() / 2)
+            f.cancel()
+            self.assertTrue(f.cancelled())
+            # The file is deleted by the acquisition thread, once it's stopped
+            sps._acq_thread.join(10)
+            self.assertIsNone(sps.checkpoint_file)
+            self.assertEqual(os.listdir(spool_dir), [])
+
+            sps = sps_keep
+            f = sps.acquire()
+            time.sleep(sps.estimateAcquisitionTime() / 2)
+            f.cancel()
+            self.assertTrue(f.cancelled())
+            sps._acq_thread.join(10)
+        finally:
+            _sync.CHECKPOINT_PERIOD = orig_period
+
+        fn = sps.checkpoint_file
+        self.assertTrue(os.path.isfile(fn))
+        cp = stream.readCheckpoint(fn)
+        self.assertGreater(cp["pixels"], 0)
+        self.assertLess(cp["pixels"], numpy.prod(exp_shape))
+        self.assertEqual(cp["settings"]["repetition"], specs.repetition.value)
+
+        # Not possible with different settings
+        self.spec.exposureTime.value = 0.1 # s
+        with self.assertRaises(ValueError):
+            sps.resume(fn)
+        self.spec.exposureTime.value = 0.05 # s
+
+        timeout = 5 + 1.5 * sps.estimateAcquisitionTime()
+        f = sps.resume(fn)
+        data = f.result(timeout)
+        self.assertEqual(len(data), 2)
+        self.assertEqual(sems.raw[0].shape, exp_shape)
+        self.assertEqual(specs.raw[0].shape[-2:], exp_shape)
+        self.assertIsNone(sps.checkpoint_file)
+        self.assertFalse(os.path.exists(fn))
+
+        # The spectrum cube is stored in a (temporary) file, not in memory
+        base = specs.raw[0]
+        while base is not None and not isinstance(base, numpy.memmap):
+            base = base.base
+        self.assertIsNotNone(base)
+
+    def test_acq_spec_preview(self):
+        """
+        Test the preview is updated during the acquisition for Spectrometer
+        """
+        sems = stream.SEMStream("test sem", self.sed, self.sed.data, self.ebeam)
+        specs = stream.SpectrumSettingsStream("test spec", self.spec, self.spec.data, self.ebeam)
+        sps = stream.SEMSpectrumMDStream("test sem-spec", sems, specs)
+
+        specs.roi.value = (0.15, 0.6, 0.8, 0.8)
+        self.spec.exposureTime.value = 0.05 # s
+        specs.repetition.value = (8, 6)
+        exp_shape = specs.repetition.value[::-1]
+
+        previews = []
+        def on_preview(im):
+            previews.append(im)
+        sps.previewImage.subscribe(on_preview)
+
+        timeout = 1 + 1.5 * sps.estimateAcquisitionTime()
+        start = time.time()
+        f = sps.acquire()
+        # Changing the band recomputes the preview from the cube acquired so
+        # far. Both bands contain all the wavelengths, so the result is the same.
+        bandwidths = [(0, 0.5), (0, 1)]
+        i = 0
+        while not f.done() and time.time() < start + timeout:
+            sps.previewBandwidth.value = bandwidths[i % 2]
+            i += 1
+            time.sleep(0.01)
+        f.result(timeout)
+        dur = time.time() - start
+        # The last update can be delayed
+        time.sleep(stream.PREVIEW_PERIOD + 0.5)
+        # No acquisition => nothing to recompute
+        sps.previewBandwidth.value = (0, 0.5)
+
+        # Updates should be limited in rate
+        self.assertGreaterEqual(len(previews), 1)
+        self.assertLessEqual(len(previews), dur / stream.PREVIEW_PERIOD + 2)
+
+        # The last preview should contain all the pixels
+        im = sps.previewImage.value
+        self.assertEqual(im.shape, exp_shape)
+        self.assertFalse(numpy.isnan(im).any())
+        spec_data = specs.raw[0]
+        numpy.testing.assert_allclose(im, spec_data[:, 0, 0].mean(axis=0))
+        numpy.testing.assert_array_equal(sps.lastSpectrum.value,
+                                         spec_data[:, 0, 0, -1, -1])
+
     def test_count(self):
         cs = stream.CameraCountStream("test count", self.spec, self.spec.data, self.ebeam)
         self.spec.exposureTime.value = 0.1
@@ -832,6 +1032,73 @@ class TestStaticStreams(unittest.TestCase):
 
         self.assertFalse(im2d1 is im2dc)
 
+    def test_ar_cache(self):
+        """Test StaticARStream polar projection cache"""
+        md = {model.MD_SW_VERSION: "1.0-test",
+             model.MD_HW_NAME: "fake ccd",
+             model.MD_DESCRIPTION: "AR",
+             model.MD_ACQ_DATE: time.time(),
+             model.MD_BPP: 12,
+             model.MD_BINNING: (1, 1), # px, px
+             model.MD_SENSOR_PIXEL_SIZE: (13e-6, 13e-6), # m/px
+             model.MD_PIXEL_SIZE: (4e-5, 4e-5), # m/px
+             model.MD_EXP_TIME: 1.2, # s
+             model.MD_AR_POLE: (126.5, 32.5),
+             model.MD_LENS_MAG: 0.4, # ratio
+            }
+
+        data = []
+        for i in range(4):
+            mdi = dict(md)
+            mdi[model.MD_POS] = (1.2e-3 + i * 1e-4, -30e-3)
+            data.append(model.DataArray(1500 + numpy.zeros((256, 512), dtype=numpy.uint16), mdi))
+
+        nthreads = threading.active_count()
+        # Only enough space for a couple of projections (each is 512x512 float)
+        cache_size = 2 * 512 * 512 * 8
+        ars = stream.StaticARStream("test", data, cache_size=cache_size)
+
+        # It should be filled in background
+        fs = [f for f, p in ars._polar_futures.values()]
+        futures.wait(fs, timeout=300)
+        self.assertGreaterEqual(len(ars._polar), 1)
+        self.assertLessEqual(len(ars._polar), 3)
+
+        # The point displayed should always get its full resolution projection
+        full_res = threading.Event()
+        def on_image(im):
+            if (im is not None and im.shape == (512, 512, 3) and
+                ars.point.value in ars._polar):
+                full_res.set()
+        ars.image.subscribe(on_image)
+        # Start with no point, so that each point selected is a change
+        ars.point.value = (None, None)
+        for p in sorted(ars.point.choices):
+            if p == (None, None):
+                continue
+            full_res.clear()
+            ars.point.value = p
+            self.assertTrue(full_res.wait(300))
+            self.assertIn(p, ars._polar)
+
+        # Once all the computations are over, the image is still the full
+        # resolution one (ie, not overridden by the low resolution one)
+        fs = [f for f, p in ars._polar_futures.values()]
+        futures.wait(fs, timeout=300)
+        self.assertEqual(ars.image.value.shape, (512, 512, 3))
+
+        # The memory used is bounded (but the newest projection is always kept)
+        self.assertLessEqual(len(ars._polar), 3)
+        self.assertLessEqual(ars._polar_nbytes, cache_size + 512 * 512 * 8)
+
+        # No thread left for the projections (only the histogram thread of
+        # the stream)
+        for i in range(100):
+            if threading.active_count() <= nthreads + 1:
+                break
+            time.sleep(0.1)
+        self.assertLessEqual(threading.active_count(), nthreads + 1)
+
     def _create_spec_data(self):
         # Spectrum
         data = numpy.ones((251, 1, 1, 200, 300), dtype="uint16")
@@ -891,6 +1158,37 @@ class TestStaticStreams(unittest.TestCase):
         self.assertEqual(sp0d.dtype, spec.dtype)
         self.assertTrue(numpy.all(sp0d <= spec.max()))
 
+        # Check 0D spectrum with a larger width
+        specs.width.value = 3
+        specs.selected_pixel.value = (3, 10)
+        sp0d = specs.get_pixel_spectrum()
+        self.assertEqual(sp0d.shape, (spec.shape[0],))
+        self.assertEqual(sp0d.dtype.kind, "f") # not truncated
+        sp0d_ex = numpy.mean(spec[:, 0, 0, 9:12, 2:5], axis=(1, 2))
+        numpy.testing.assert_allclose(sp0d, sp0d_ex)
+
+    def test_spec_mean(self):
+        """Test StaticSpectrumStream mean spectrum"""
+        spec = self._create_spec_data()
+        specs = stream.StaticSpectrumStream("test", spec)
+
+        msp = specs.getMeanSpectrum()
+        self.assertEqual(msp.shape, (spec.shape[0],))
+        numpy.testing.assert_almost_equal(msp, numpy.mean(spec, axis=(1, 2, 3, 4)))
+
+        # whole data as an area
+        msp = specs.getMeanSpectrum((0, 0, 299, 199))
+        numpy.testing.assert_almost_equal(msp, numpy.mean(spec, axis=(1, 2, 3, 4)))
+
+        for area in ((3, 0, 3, 0), (1, 2, 50, 60), (250, 190, 299, 199)):
+            l, t, r, b = area
+            msp = specs.getMeanSpectrum(area)
+            msp_ex = numpy.mean(spec[:, 0, 0, t:b + 1, l:r + 1], axis=(1, 2))
+            numpy.testing.assert_almost_equal(msp, msp_ex)
+
+        with self.assertRaises(ValueError):
+            specs.getMeanSpectrum((0, 0, 300, 10))
+
     def test_spec_1d(self):
         """Test StaticSpectrumStream 1D"""
         spec = self._create_spec_data()
@@ -959,6 +1257,34 @@ class TestStaticStreams(unittest.TestCase):
         self.assertEqual(sp1d.dtype, numpy.uint8)
         self.assertEqual(wl1d.shape, (spec.shape[0],))
 
+    def test_spec_band_mean(self):
+        """Test StaticSpectrumStream band average via cumulative sum"""
+        spec = self._create_spec_data()
+        specs = stream.StaticSpectrumStream("test", spec)
+
+        for low, high in ((0, 0), (0, 250), (2, 2), (10, 200), (250, 250)):
+            av = specs._get_band_mean(low, high)
+            av_ex = numpy.mean(spec[low:high + 1], axis=0)
+            numpy.testing.assert_almost_equal(av, av_ex)
+
+        # RGB projection: 3 sub-bands of 4 pixels
+        av = specs._project_rgb((10, 21))
+        self.assertEqual(av.shape, spec.shape[1:] + (3,))
+        for i in range(3):
+            av_ex = numpy.mean(spec[10 + i * 4:14 + i * 4], axis=0)
+            numpy.testing.assert_almost_equal(av[..., i], av_ex)
+
+        # The cumulative sum should be recomputed after calibration
+        dcalib = numpy.array([1, 1.3, 2, 3.5, 4, 5, 1.3, 6, 9.1], dtype=numpy.float)
+        dcalib.shape = (dcalib.shape[0], 1, 1, 1, 1)
+        wl_calib = 400e-9 + numpy.array(range(dcalib.shape[0])) * 10e-9
+        calib = model.DataArray(dcalib, metadata={model.MD_WL_LIST: wl_calib})
+        specs.efficiencyCompensation.value = calib
+
+        calibrated = specs._calibrated
+        av = specs._get_band_mean(10, 200)
+        av_ex = numpy.mean(calibrated[10:201], axis=0)
+        numpy.testing.assert_almost_equal(av, av_ex)
 
     def test_spec_calib(self):
         """Test StaticSpectrumStream calibration"""
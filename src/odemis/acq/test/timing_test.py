@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 19 Oct 2026
+
+@author: agent
+
+Copyright © 2026 agent
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License version 2 as published by the Free Software Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with Odemis. If not, see http://www.gnu.org/licenses/.
+'''
+# Test cases for the acquisition timing model
+
+from __future__ import division
+
+import logging
+from odemis import model
+from odemis.acq import timing
+import os
+import shutil
+import tempfile
+import unittest
+
+
+logging.getLogger().setLevel(logging.DEBUG)
+
+
+class FakeVA(object):
+    def __init__(self, value):
+        self.value = value
+
+class FakeComponent(object):
+    def __init__(self, name):
+        self.name = name
+
+class FakeStream(object):
+    """
+    Just enough of a stream for the timing model
+    """
+    def __init__(self, detector, rep=None):
+        self._detector = FakeComponent(detector)
+        if rep is not None:
+            self.repetition = FakeVA(rep)
+
+    def estimateAcquisitionTime(self):
+        return 1
+
+
+class TestTimingModel(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dirname, "test-timing.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_correct(self):
+        tm = timing.TimingModel()
+        s = FakeStream("ccd", (10, 10))
+        # Nothing known => no correction
+        self.assertEqual(tm.correct(s, 5), 5)
+
+        # Overhead of 1 s + 10 ms per pixel
+        for rep in ((10, 10), (20, 10), (5, 5), (30, 30)):
+            s = FakeStream("ccd", rep)
+            n = rep[0] * rep[1]
+            tm.record(s, 2, 2 + 1 + 0.01 * n)
+
+        entries = tm.getEntries()
+        self.assertEqual(len(entries), 1)
+        e = entries["FakeStream/ccd"]
+        self.assertEqual(e["count"], 4)
+        self.assertAlmostEqual(e["fixed"], 1)
+        self.assertAlmostEqual(e["per_pixel"], 0.01)
+
+        s = FakeStream("ccd", (100, 10))
+        self.assertAlmostEqual(tm.correct(s, 3), 3 + 1 + 0.01 * 1000)
+
+        # Another detector is not affected
+        s2 = FakeStream("sed", (100, 10))
+        self.assertEqual(tm.correct(s2, 3), 3)
+
+        tm.reset("FakeStream/ccd")
+        self.assertEqual(tm.correct(s, 3), 3)
+        with self.assertRaises(KeyError):
+            tm.reset("FakeStream/ccd")
+
+    def test_single_frame(self):
+        tm = timing.TimingModel()
+        s = FakeStream("camera")
+        for i in range(5):
+            tm.record(s, 0.5, 0.8)
+        self.assertAlmostEqual(tm.correct(s, 0.5), 0.8)
+
+    def test_save(self):
+        tm = timing.TimingModel(self.filename)
+        s = FakeStream("ccd", (10, 10))
+        for i in range(5):
+            tm.record(s, 2, 3)
+        tm.save()
+        corrected = tm.correct(s, 2)
+        self.assertAlmostEqual(corrected, 3)
+
+        tm2 = timing.TimingModel(self.filename)
+        self.assertEqual(tm2.getEntries(), tm.getEntries())
+        self.assertAlmostEqual(tm2.correct(s, 2), corrected)
+
+        tm2.reset()
+        self.assertEqual(tm2.getEntries(), {})
+
+    def test_get_model_no_backend(self):
+        """
+        Without backend, a generic model is used
+        """
+        try:
+            model.getMicroscope()
+        except Exception:
+            pass
+        else:
+            self.skipTest("Backend is running")
+
+        tm = timing.get_model(self.dirname)
+        self.assertEqual(os.path.dirname(tm.filename), self.dirname)
+        self.assertIn("default", os.path.basename(tm.filename))
+        s = FakeStream("ccd", (10, 10))
+        for i in range(5):
+            tm.record(s, 2, 3)
+        tm.save()
+
+        # The same file is read again
+        tm2 = timing.get_model(self.dirname)
+        self.assertIsNot(tm2, tm)
+        self.assertEqual(tm2.getEntries(), tm.getEntries())
+
+        # The generic model is cached too, until the microscope is looked up again
+        orig = timing._model, timing._model_generic, timing._model_retry
+        try:
+            timing._model = None
+            tm = timing.get_model()
+            self.assertIs(timing.get_model(), tm)
+            self.assertTrue(timing._model_generic)
+
+            # Still no microscope => the same model is kept
+            timing._model_retry = 0
+            self.assertIs(timing.get_model(), tm)
+            self.assertGreater(timing._model_retry, 0)
+        finally:
+            timing._model, timing._model_generic, timing._model_retry = orig
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 19 Oct 2026
+
+@author: agent
+
+Copyright © 2026 agent
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License version 2 as published by the Free Software Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with Odemis. If not, see http://www.gnu.org/licenses/.
+'''
+
+# Learns how long the acquisitions actually take on this microscope, in order
+# to correct the (theoretical) estimations of the streams. Only the total
+# duration of each acquisition is known, so the correction is per type of
+# stream, not per phase of the acquisition.
+
+from __future__ import division
+
+import json
+import logging
+import numpy
+from odemis import model
+import os
+import threading
+import time
+
+
+TIMING_DIR = os.path.join(os.path.expanduser(u"~"), u".config", u"odemis")
+TIMING_FILE_PATTERN = u"acq-timing-%s.json" # %s is replaced by the microscope name
+TIMING_VERSION = 1
+
+# How much each past acquisition still counts when a new one is recorded. The
+# lower, the faster the model follows changes in the hardware.
+FORGET_FACTOR = 0.9
+# Minimum number of acquisitions recorded before correcting the estimations
+MIN_SAMPLES = 3
+# The corrected estimation is never less than this ratio of the original one
+MIN_CORRECTION_RATIO = 0.1
+# While the microscope is not known, the generic model is used, and the
+# microscope is only looked up again after this period (s)
+MICROSCOPE_RETRY_PERIOD = 10
+
+
+class TimingModel(object):
+    """
+    Model of the acquisition time of each type of stream, calibrated from the
+    actual duration of the acquisitions.
+    For each type of stream (class + detector), the difference between the
+    actual duration and the estimated duration is modelled as:
+      overhead = fixed + per_pixel * number of pixels
+    where the number of pixels is the repetition of the stream (or 1 for
+    streams acquiring a single frame).
+    It is a single linear regression on the total duration of the
+    acquisitions: the different phases of an acquisition (hardware set up,
+    readout, drift correction...) are not measured, nor corrected,
+    separately. Their extra time only ends up in fixed or per_pixel depending
+    on whether it grows with the number of pixels.
+    The model is fitted by weighted least squares, with the weight of the old
+    acquisitions decreasing exponentially. It is stored as a JSON file.
+    """
+    def __init__(self, filename=None):
+        """
+        filename (None or str): file where the model is stored. If None, the
+          model is only kept in memory.
+        """
+        self._filename = filename
+        self._lock = threading.Lock()
+        # str -> dict str -> float: sums needed for the least squares fit
+        self._entries = {}
+        if filename is not None and os.path.exists(filename):
+            try:
+                self._load()
+            except Exception:
+                logging.exception("Failed to load acquisition timing from %s, "
+                                  "will start from scratch", filename)
+                self._entries = {}
+
+    @property
+    def filename(self):
+        return self._filename
+
+    def record(self, stream, estimated, actual):
+        """
+        Record the duration of an acquisition
+        stream (Stream): the stream acquired
+        estimated (0<=float): estimated duration of the acquisition (in s),
+          as computed by the stream itself
+        actual (0<=float): actual duration of the acquisition (in s)
+        """
+        key = _get_stream_key(stream)
+        x = _get_npixels(stream)
+        y = actual - estimated
+        logging.debug("Acquisition of %s (%d px) took %g s, while estimated %g s",
+                      key, x, actual, estimated)
+        with self._lock:
+            e = self._entries.setdefault(key, {"count": 0, "sw": 0, "sx": 0,
+                                               "sxx": 0, "sy": 0, "sxy": 0})
+            for k in ("sw", "sx", "sxx", "sy", "sxy"):
+                e[k] *= FORGET_FACTOR
+            e["count"] += 1
+            e["sw"] += 1
+            e["sx"] += x
+            e["sxx"] += x * x
+            e["sy"] += y
+            e["sxy"] += x * y
+
+    def correct(self, stream, estimated):
+        """
+        Correct the estimation of the acquisition time of a stream
+        stream (Stream): the stream to acquire
+        estimated (0<=float): estimated duration of the acquisition (in s), as
+          computed by the stream itself
+        return (0<=float): corrected estimation (in s). If not enough
+          acquisitions of such stream have been recorded, it's the same as
+          estimated.
+        """
+        key = _get_stream_key(stream)
+        with self._lock:
+            e = self._entries.get(key)
+            if e is None or e["count"] < MIN_SAMPLES:
+                return estimated
+            fixed, per_pixel = self._fit(e)
+
+        corrected = estimated + fixed + per_pixel * _get_npixels(stream)
+        return max(corrected, estimated * MIN_CORRECTION_RATIO)
+
+    def getEntries(self):
+        """
+        return (dict str -> dict): for each type of stream recorded, a dict with:
+          "count" (int): number of acquisitions recorded
+          "fixed" (float): time added to each acquisition (in s)
+          "per_pixel" (float): time added for each pixel (in s)
+        """
+        ret = {}
+        with self._lock:
+            for key, e in self._entries.items():
+                fixed, per_pixel = self._fit(e)
+                ret[key] = {"count": e["count"], "fixed": fixed,
+                            "per_pixel": per_pixel}
+        return ret
+
+    def reset(self, key=None):
+        """
+        Forget the acquisitions recorded
+        key (None or str): the type of stream to forget (as returned by
+          .getEntries()). If None, everything is forgotten.
+        raises KeyError: if key is not known
+        """
+        with self._lock:
+            if key is None:
+                self._entries = {}
+            else:
+                del self._entries[key]
+
+    def save(self):
+        """
+        Write the model to its file (if it has one)
+        """
+        if self._filename is None:
+            return
+        with self._lock:
+            content = {"version": TIMING_VERSION, "entries": self._entries}
+            dirname = os.path.dirname(self._filename)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            # Write to a temporary file first, to never leave a broken file
+            tmpfn = self._filename + ".tmp"
+            with open(tmpfn, "w") as f:
+                json.dump(content, f, indent=1, sort_keys=True)
+            os.rename(tmpfn, self._filename)
+
+    def _load(self):
+        with open(self._filename) as f:
+            content = json.load(f)
+        if content.get("version") != TIMING_VERSION:
+            raise ValueError("Unsupported version %s" % (content.get("version"),))
+        self._entries = content["entries"]
+
+    @staticmethod
+    def _fit(e):
+        """
+        Compute the model parameters from the sums
+        e (dict str -> float): the sums of one type of stream
+        return (float, float): fixed, per_pixel
+        """
+        sw, sx, sxx, sy, sxy = e["sw"], e["sx"], e["sxx"], e["sy"], e["sxy"]
+        det = sw * sxx - sx * sx
+        if abs(det) <= 1e-9 * max(sw * sxx, 1e-30):
+            # All the acquisitions had the same number of pixels => cannot
+            # separate the fixed and per-pixel time. As the number of pixels is
+            # mostly constant, consider it's all per pixel.
+            if sx == 0:
+                return 0, 0
+            return 0, sy / sx
+        fixed = (sxx * sy - sx * sxy) / det
+        per_pixel = (sw * sxy - sx * sy) / det
+        return fixed, per_pixel
+
+
+def _get_stream_key(stream):
+    """
+    return (str): identifies the type of the stream, as "class/detector"
+    """
+    name = stream.__class__.__name__
+    # For the multiple-detector streams, the CCD is the slowest one
+    for attr in ("_ccd", "_detector"):
+        comp = getattr(stream, attr, None)
+        if comp is not None:
+            return "%s/%s" % (name, comp.name)
+    return name
+
+
+def _get_npixels(stream):
+    """
+    return (1<=int): number of pixels (ie, frames or e-beam positions)
+      acquired by the stream
+    """
+    for s in (stream, getattr(stream, "_ccd_stream", None)):
+        rep = getattr(s, "repetition", None)
+        if rep is not None:
+            return int(numpy.prod(rep.value))
+    return 1
+
+
+_model = None # TimingModel of the microscope, in TIMING_DIR
+_model_generic = False # True if _model is the generic model
+_model_retry = 0 # time after which the microscope is looked up again
+_model_lock = threading.Lock()
+
+def get_model(dirname=None):
+    """
+    dirname (None or str): directory where the model is stored. If None, it
+      is the user configuration directory (TIMING_DIR), and the same model is
+      returned at every call.
+    return (TimingModel): the timing model of the current microscope. If the
+      microscope is not known, a generic model is returned. With the default
+      directory, it is replaced by the model of the microscope as soon as it
+      is found (at most every MICROSCOPE_RETRY_PERIOD).
+    """
+    global _model, _model_generic, _model_retry
+    with _model_lock:
+        if dirname is None and _model is not None:
+            if not _model_generic or time.time() < _model_retry:
+                return _model
+
+        try:
+            name = model.getMicroscope().name.replace(u"/", u"_")
+        except Exception:
+            logging.info("Failed to find the microscope name, will use a "
+                         "generic acquisition timing model")
+            name = None
+
+        if dirname is None:
+            _model_retry = time.time() + MICROSCOPE_RETRY_PERIOD
+            if name is None and _model is not None:
+                # Still the generic model, no need to read it again
+                return _model
+
+        fn = os.path.join(dirname or TIMING_DIR,
+                          TIMING_FILE_PATTERN % (name or u"default",))
+        tm = TimingModel(fn)
+        if dirname is None:
+            _model = tm
+            _model_generic = name is None
+        return tm
+
+def correctTime(stream):
+    """
+    Estimate the acquisition time of a stream, corrected by the timing model of
+    the microscope.
+    stream (Stream): the stream to acquire
+    return (0 <= float): estimated time in s.
+    """
+    return get_model().correct(stream, stream.estimateAcquisitionTime())
@@ -19,6 +19,7 @@ You should have received a copy of the GNU General Public License along with Ode
 # file formats supported by Odemis.
 # Example usage:
 # convert --input file-as.hdf5 --output file-as.ome.tiff
+# convert --input file-ar.hdf5 --ar-polar 201 --output file-ar-polar.hdf5
 
 from __future__ import division
 
@@ -28,7 +29,7 @@ import logging
 import numpy
 from odemis import dataio, model
 import odemis
-from odemis.util import spectrum
+from odemis.util import spectrum, polar, img
 import os
 import sys
 
@@ -95,6 +96,8 @@ def open_ec(fn):
 def save_acq(fn, data, thumbs):
     """
     Saves to a file the data and thumbnail
+    data (list or iterable of DataArray): if it's not a list, and the exporter
+      supports it, each DataArray is saved as soon as it is available.
     """
     exporter = dataio.find_fittest_exporter(fn)
 
@@ -103,6 +106,12 @@ def save_acq(fn, data, thumbs):
         thumb = thumbs[0]
     else:
         thumb = None
+
+    if not isinstance(data, list):
+        if hasattr(exporter, "export_iter"):
+            exporter.export_iter(fn, data, thumb)
+            return
+        data = list(data)
     exporter.export(fn, data, thumb)
 
 def da_sub(daa, dab):
@@ -157,6 +166,56 @@ def minus(data_a, data_b):
                          (len(data_b), len(data_a)))
     return ret
 
+def ar_to_polar(data, size):
+    """
+    Converts the angle resolved images to polar projection, with the baseline
+      background removed. The conversion is done in parallel, and the images
+      are returned as soon as they are converted.
+    data (list of DataArrays): the data, only the AR images (ie, with
+      MD_AR_POLE metadata) are converted, the others are passed as-is.
+      As they are all already in memory, only the memory used by the converted
+      images is saved by writing them one at a time.
+    size (int): size of the polar projection (in px)
+    yields (DataArray): the data, in the same order. The projections don't
+      have MD_AR_POLE (nor MD_PIXEL_SIZE), so they are not taken for raw AR
+      images when the file is opened again.
+    """
+    ar_data = [img.ensure2DImage(d) for d in data if model.MD_AR_POLE in d.metadata]
+    logging.info("Converting %d angle resolved images to polar projection",
+                 len(ar_data))
+    polar_data = polar.AngleResolved2PolarBatch(ar_data, size, hole=False)
+    for d in data:
+        if model.MD_AR_POLE in d.metadata:
+            yield next(polar_data)
+        else:
+            yield d
+
+def align_stack(data, running_mean=False):
+    """
+    Registers all the images of the same shape as the first image, and
+      replaces them by their average after alignment.
+    data (list of DataArrays): the data, the first one is used as reference
+    running_mean (bool): register each image against the mean of the
+      previous images, instead of the first one.
+    returns (list of DataArrays): the average, followed by the data of
+      different shape (unchanged)
+    """
+    # Only import when needed, as it's pretty slow to load
+    from odemis.acq import drift
+
+    if not data:
+        raise ValueError("No image to align")
+    shape = data[0].shape
+    stack = [d for d in data if d.shape == shape]
+    others = [d for d in data if d.shape != shape]
+    logging.info("Aligning %d images of shape %s", len(stack), shape)
+    shifts, confs, avg = drift.RegisterStack(stack, running_mean=running_mean,
+                                             average=True)
+    for i, (s, c) in enumerate(zip(shifts, confs)):
+        logging.info("Image %d shifted by %s px (confidence = %.2f)", i, s, c)
+
+    return [avg] + others
+
 def main(args):
     """
     Handles the command line arguments
@@ -181,6 +240,16 @@ def main(args):
     parser.add_argument("--minus", "-m", dest="minus", action='append',
             help="name of an acquisition file whose data is subtracted from the input file.")
 
+    parser.add_argument("--ar-polar", dest="arpolar", type=int,
+            help="convert the angle resolved images to polar projection of the given size (in px).")
+
+    parser.add_argument("--align-stack", dest="alignstack", action="store_true",
+            help="align all the images of the same shape as the first one, "
+            "and replace them by their average.")
+    parser.add_argument("--running-mean", dest="runningmean", action="store_true",
+            help="with --align-stack, align each image on the mean of the "
+            "previous ones instead of the first one.")
+
     # TODO: --range parameter to select which image to select from the input
     #      (like: 1-4,5,6-10,12)
 
@@ -221,6 +290,19 @@ def main(args):
             sdata, sthumbs = open_acq(fn)
             data = minus(data, sdata)
 
+    if options.alignstack:
+        if thumbs:
+            logging.info("Dropping thumbnail due to alignment")
+            thumbs = []
+        data = align_stack(data, options.runningmean)
+    elif options.runningmean:
+        raise ValueError("--running-mean can only be used with --align-stack")
+
+    if options.arpolar:
+        if options.arpolar <= 0:
+            raise ValueError("--ar-polar size must be positive")
+        data = ar_to_polar(data, options.arpolar)
+
     save_acq(outfn, data, thumbs)
 
     logging.info("Successfully generated file %s", outfn)
@@ -568,6 +568,58 @@ def acquire(comp_name, dataflow_names, filename):
     except IOError as exc:
         raise IOError(u"Failed to save to '%s': %s" % (filename, exc))
 
+def resume_acquisition(filename, output):
+    """
+    Continue an interrupted SEM/CCD acquisition from its checkpoint file, and
+    save the complete data
+    filename (unicode): the checkpoint file
+    output (unicode): name of the output file (format depends on the extension)
+    """
+    # Only import when needed, as it's pretty slow to load
+    from odemis.acq import stream
+
+    cp = stream.readCheckpoint(filename)
+    settings = cp["settings"]
+    logging.info("Resuming acquisition %s after %d pixels", cp["streams"]["md"],
+                 cp["pixels"])
+
+    emitter = get_component(settings["emitter"])
+    semd = get_detector(settings["sem_detector"])
+    ccd = get_detector(settings["ccd"])
+
+    try:
+        sem_cls, sem_name = cp["streams"]["sem"]
+        ccd_cls, ccd_name = cp["streams"]["ccd"]
+        sem_stream = getattr(stream, sem_cls)(sem_name, semd, semd.data, emitter)
+        ccd_stream = getattr(stream, ccd_cls)(ccd_name, ccd, ccd.data, emitter)
+        md_cls = getattr(stream, settings["stream"])
+    except AttributeError as exc:
+        raise ValueError("Checkpoint %s refers to an unknown stream: %s" % (filename, exc))
+    md_stream = md_cls(cp["streams"]["md"], sem_stream, ccd_stream,
+                       continuous=settings["continuous"], keep_cancelled=True)
+
+    ccd_stream.roi.value = settings["roi"]
+    ccd_stream.repetition.value = settings["repetition"]
+    sem_stream.dcRegion.value = settings["dc_region"]
+    sem_stream.dcDwellTime.value = settings["dc_dwell_time"]
+    sem_stream.dcPeriod.value = settings["dc_period"]
+
+    f = md_stream.resume(filename)
+    try:
+        data = f.result()
+    except KeyboardInterrupt:
+        f.cancel()
+        raise IOError("Acquisition interrupted, can be resumed again from %s" %
+                      (md_stream.checkpoint_file,))
+    except Exception as exc:
+        raise IOError("Failed to resume the acquisition: %s" % (exc,))
+
+    exporter = dataio.find_fittest_exporter(output)
+    try:
+        exporter.export(output, data)
+    except IOError as exc:
+        raise IOError(u"Failed to save to '%s': %s" % (output, exc))
+
 def live_display(comp_name, df_name):
     """
     Acquire an image from one (or more) dataflow
@@ -682,6 +734,10 @@ def main(args):
     dm_grpe.add_argument("--acquire", "-a", dest="acquire", nargs="+",
                          metavar=("<component>", "data-flow"),
                          help="acquire an image (default data-flow is \"data\")")
+    dm_grpe.add_argument("--resume-acquisition", dest="resume", metavar="<file>",
+                         help="continue an interrupted SEM/CCD acquisition from "
+                         "its checkpoint file, and save it in the output file. "
+                         "Only software synchronised acquisitions save checkpoints.")
     dm_grp.add_argument("--output", "-o", dest="output",
                         help="name of the file where the image should be saved "
                         "after acquisition. The file format is derived from the extension "
@@ -721,10 +777,11 @@ def main(args):
         options.list, options.stop, options.move,
         options.position, options.reference,
         options.listprop, options.setattr, options.upmd,
-        options.acquire, options.live)):
+        options.acquire, options.resume, options.live)):
         logging.error("No action specified.")
         return 127
-    if options.acquire is not None and options.output is None:
+    if ((options.acquire is not None or options.resume is not None)
+        and options.output is None):
         logging.error("Name of the output file must be specified.")
         return 127
     if options.setattr:
@@ -799,6 +856,10 @@ def main(args):
                 dataflows = options.acquire[1:]
             filename = options.output.decode(sys.getfilesystemencoding())
             acquire(component, dataflows, filename)
+        elif options.resume is not None:
+            fs_enc = sys.getfilesystemencoding()
+            resume_acquisition(options.resume.decode(fs_enc),
+                               options.output.decode(fs_enc))
         elif options.live is not None:
             component = options.live[0]
             if len(options.live) == 1:
@@ -22,6 +22,7 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 from __future__ import division
 
 import h5py
+import json
 import logging
 import numpy
 from odemis import model
@@ -1026,14 +1027,14 @@ def _mergeCorrectionMetadata(da):
     img.mergeMetadata(md)
     return model.DataArray(da, md) # create a view
 
-def _saveAsHDF5(filename, ldata, thumbnail, compressed=True):
+def _createHDF5(filename, thumbnail, compressed=True):
     """
-    Saves a list of DataArray as a HDF5 (SVI) file.
+    Create a new HDF5 (SVI) file, with just the thumbnail.
     filename (string): name of the file to save
-    ldata (list of DataArray): list of 2D (up to 5D) data of int or float. 
-     Should have at least one array.
     thumbnail (None or DataArray): see export
     compressed (boolean): whether the file is compressed or not.
+    returns (h5py.File, dict): the opened file, and the arguments to pass
+      when creating the datasets.
     """
     # h5py will extend the current file by default, so we want to make sure
     # there is no file at all.
@@ -1057,6 +1058,19 @@ def _saveAsHDF5(filename, ldata, thumbnail, compressed=True):
         ids = _create_image_dataset(prevg, "Image", thumbnail, compression=compression)
         _add_image_info(prevg, ids, thumbnail)
 
+    return f, {"compression": compression}
+
+def _saveAsHDF5(filename, ldata, thumbnail, compressed=True):
+    """
+    Saves a list of DataArray as a HDF5 (SVI) file.
+    filename (string): name of the file to save
+    ldata (list of DataArray): list of 2D (up to 5D) data of int or float. 
+     Should have at least one array.
+    thumbnail (None or DataArray): see export
+    compressed (boolean): whether the file is compressed or not.
+    """
+    f, kwargs = _createHDF5(filename, thumbnail, compressed)
+
     # merge correction metadata (as we cannot save them separatly in OME-TIFF)
     ldata = [_mergeCorrectionMetadata(da) for da in ldata]
 
@@ -1064,7 +1078,7 @@ def _saveAsHDF5(filename, ldata, thumbnail, compressed=True):
     acq, mds = _groupImages(ldata)
     for i, da in enumerate(acq):
         ga = f.create_group("Acquisition%d" % i)
-        _add_acquistion_svi(ga, da, mds[i], compression=compression)
+        _add_acquistion_svi(ga, da, mds[i], **kwargs)
 
     f.close()
 
@@ -1093,6 +1107,282 @@ def export(filename, data, thumbnail=None):
         data = [data]
     _saveAsHDF5(filename, data, thumbnail)
 
+def export_iter(filename, data, thumbnail=None):
+    '''
+    Write an HDF5 file with the given images, saving each of them as soon as it
+    is available. This allows to save large data without having everything in
+    memory simultaneously.
+    filename (unicode): filename of the file to create (including path)
+    data (iterable of model.DataArray): the data to export, see export().
+        Contrarily to export(), the images are never aggregated, each of them
+        is saved as a separate acquisition.
+    thumbnail (None or model.DataArray): see export()
+    returns (int): the number of images saved
+    '''
+    f, kwargs = _createHDF5(filename, thumbnail)
+    try:
+        n = 0
+        for da in data:
+            da = _adjustDimensions(_mergeCorrectionMetadata(da))
+            ga = f.create_group("Acquisition%d" % n)
+            _add_acquistion_svi(ga, da, None, **kwargs)
+            f.flush()
+            n += 1
+    finally:
+        f.close()
+
+    return n
+
+def _toJSONable(obj):
+    """
+    Convert an object to a structure which can be stored as JSON, while keeping
+    the type of the tuples and numpy arrays (as in the metadata).
+    obj (object): composed only of dict (with str keys), list, tuple, numpy
+      arrays, numbers, bool, strings and None.
+    return (object): the same object, with only JSON types
+    raises TypeError: if the object contains an unsupported type
+    """
+    if isinstance(obj, dict):
+        return dict((k, _toJSONable(v)) for k, v in obj.items())
+    elif isinstance(obj, list):
+        return [_toJSONable(v) for v in obj]
+    elif isinstance(obj, tuple):
+        return {"__tuple__": [_toJSONable(v) for v in obj]}
+    elif isinstance(obj, numpy.ndarray):
+        return {"__ndarray__": obj.tolist(), "dtype": obj.dtype.str}
+    elif isinstance(obj, numpy.generic):
+        return obj.item()
+    elif obj is None or isinstance(obj, (basestring, bool, int, long, float)):
+        return obj
+    raise TypeError("Cannot store value %r of type %s" % (obj, type(obj)))
+
+def _fromJSONable(obj):
+    """
+    Reverse of _toJSONable()
+    """
+    if isinstance(obj, dict):
+        if "__tuple__" in obj:
+            return tuple(_fromJSONable(v) for v in obj["__tuple__"])
+        elif "__ndarray__" in obj:
+            return numpy.array(obj["__ndarray__"], dtype=obj["dtype"])
+        return dict((k, _fromJSONable(v)) for k, v in obj.items())
+    elif isinstance(obj, list):
+        return [_fromJSONable(v) for v in obj]
+    return obj
+
+def _dumpJSON(obj):
+    """
+    return (str): obj serialised as JSON (see _toJSONable())
+    """
+    return json.dumps(_toJSONable(obj))
+
+def _loadJSON(s):
+    return _fromJSONable(json.loads(s))
+
+class FrameStore(object):
+    """
+    HDF5 file used to store on disk the data of an acquisition while it is
+    running, frame by frame (eg, one CCD image per e-beam position). This keeps
+    the memory usage low for very large acquisitions, and the data acquired is
+    not lost if the process dies. The file can be reopened later, to read back
+    the frames and continue storing new ones.
+    Note: the file is not in the SVI format, it is only meant as a temporary
+    storage, which can be read back via h5py.
+    """
+    def __init__(self, filename, mode="w"):
+        """
+        filename (unicode): name of the file
+        mode ("w" or "a"): "w" to create the file (overwritten if existing),
+          "a" to open an existing file and continue storing frames.
+        raises IOError: if the file cannot be opened
+        """
+        if mode not in ("w", "a"):
+            raise ValueError("mode must be 'w' or 'a', not '%s'" % (mode,))
+        self.filename = filename
+        if mode == "a" and not os.path.exists(filename):
+            raise IOError("File %s doesn't exist" % (filename,))
+        self._file = h5py.File(filename, mode)
+        self._sequences = []
+
+    def create_sequence(self, name, count):
+        """
+        Create a new sequence of frames in the file.
+        name (str): name of the sequence
+        count (0<int): maximum number of frames
+        return (FrameSequence): the sequence, initially empty
+        """
+        seq = FrameSequence(self._file, name, count)
+        self._sequences.append(seq)
+        return seq
+
+    def open_sequence(self, name):
+        """
+        Open a sequence of frames previously created in the file. Only the
+        frames stored before the last flush() are available.
+        name (str): name of the sequence
+        return (FrameSequence): the sequence
+        raises KeyError: if no such sequence exists
+        """
+        if name not in self._file:
+            raise KeyError("No sequence %s in %s" % (name, self.filename))
+        seq = FrameSequence(self._file, name)
+        self._sequences.append(seq)
+        return seq
+
+    def _get_state(self):
+        """
+        (None or dict): any extra information about the acquisition (eg, to
+          be able to resume it). It is stored as JSON, so only dict, list,
+          tuple, numpy arrays, numbers, bool, strings and None are allowed.
+        """
+        if "State" not in self._file.attrs:
+            return None
+        return _loadJSON(self._file.attrs["State"])
+
+    def _set_state(self, state):
+        self._file.attrs["State"] = _dumpJSON(state)
+
+    state = property(_get_state, _set_state)
+
+    def flush(self):
+        """
+        Write all the frames and the state to the disk
+        """
+        for seq in self._sequences:
+            seq._flush()
+        self._file.flush()
+
+    def close(self, delete=False):
+        """
+        Close the file. No sequence can be used afterwards.
+        delete (bool): if True, the file is also deleted
+        """
+        if self._file is None:
+            return
+        if not delete:
+            self.flush()
+        self._sequences = []
+        self._file.close()
+        self._file = None
+        if delete:
+            try:
+                os.remove(self.filename)
+            except OSError:
+                logging.warning("Failed to delete file %s", self.filename)
+
+class FrameSequence(object):
+    """
+    Sequence of frames of the same shape and type, stored in a preallocated
+    HDF5 dataset, with one chunk per frame. The dataset is created on the first
+    frame, as only then the shape and dtype are known.
+    It behaves mostly like a list of DataArrays: indexing with an int returns
+    a DataArray (with its metadata), and indexing with a slice returns a
+    numpy array of all the frames. The metadata is kept in memory, and also
+    stored (as JSON) in the file.
+    """
+    def __init__(self, parent, name, count=None):
+        """
+        Should only be created by FrameStore.create_sequence() or .open_sequence()
+        parent (h5py.Group): where the sequence is stored
+        name (str): name of the sequence
+        count (None or 0<int): maximum number of frames. If None, the sequence
+          is read from the file.
+        """
+        self._name = name
+        self._mds = [] # metadata of each frame
+        if count is None:
+            self._group = parent[name]
+            self._count = int(self._group.attrs["Count"])
+            self._dataset = self._group.get("Data")
+            self._mdset = self._group["Metadata"]
+            length = int(self._group.attrs["Length"])
+            for i in range(length):
+                self._mds.append(_loadJSON(self._mdset[i]))
+        else:
+            self._group = parent.create_group(name)
+            self._count = count
+            self._group.attrs["Count"] = count
+            self._group.attrs["Length"] = 0
+            self._dataset = None
+            self._mdset = self._group.create_dataset("Metadata", shape=(count,),
+                                dtype=h5py.special_dtype(vlen=str))
+
+    def append(self, data):
+        """
+        Store a new frame at the end of the sequence.
+        data (DataArray): the frame. All the frames must have the same shape and
+          dtype.
+        raises:
+          IndexError: if the maximum number of frames is already reached
+          ValueError: if the frame has a different shape from the first one
+        """
+        n = len(self._mds)
+        if n >= self._count:
+            raise IndexError("Sequence %s already full with %d frames" %
+                             (self._name, n))
+        if self._dataset is None:
+            self._dataset = self._group.create_dataset("Data",
+                                     shape=(self._count,) + data.shape,
+                                     dtype=data.dtype,
+                                     chunks=(1,) + data.shape)
+        elif data.shape != self._dataset.shape[1:]:
+            raise ValueError("Frame of shape %s differs from the sequence shape %s" %
+                             (data.shape, self._dataset.shape[1:]))
+
+        self._dataset[n] = data
+        md = getattr(data, "metadata", {})
+        try:
+            smd = _dumpJSON(md)
+        except TypeError:
+            # Drop the metadata which cannot be stored, rather than the frame
+            md = md.copy()
+            for k, v in md.items():
+                try:
+                    _toJSONable(v)
+                except TypeError:
+                    logging.warning("Not storing metadata %s of frame %d", k, n)
+                    del md[k]
+            smd = _dumpJSON(md)
+        self._mdset[n] = smd
+        self._mds.append(md)
+
+    def truncate(self, n):
+        """
+        Forget all the frames after the first n ones. The next frame appended
+        will be at index n.
+        n (0<=int): number of frames to keep
+        """
+        del self._mds[n:]
+        self._flush()
+
+    def _flush(self):
+        self._group.attrs["Length"] = len(self._mds)
+
+    def __len__(self):
+        return len(self._mds)
+
+    def __getitem__(self, key):
+        n = len(self._mds)
+        if isinstance(key, slice):
+            start, stop, step = key.indices(n)
+            if step != 1:
+                raise ValueError("Slicing with steps is not supported")
+            if stop <= start:
+                if self._dataset is None:
+                    return numpy.empty((0,))
+                return numpy.empty((0,) + self._dataset.shape[1:], self._dataset.dtype)
+            return self._dataset[start:stop]
+
+        if key < 0:
+            key += n
+        if not 0 <= key < n:
+            raise IndexError("Frame %d out of range" % (key,))
+        return model.DataArray(self._dataset[key], self._mds[key])
+
+    def __iter__(self):
+        for i in range(len(self._mds)):
+            yield self[i]
+
 def read_data(filename):
     """
     Read an HDF5 file and return its content (skipping the thumbnail).
@@ -128,6 +128,112 @@ class TestHDF5IO(unittest.TestCase):
 
         os.remove(FILENAME)
 
+    def testExportIter(self):
+        """Export images one at a time, from a generator"""
+        size = (512, 256)
+        white = (12, 52) # non symmetric position
+        dtype = numpy.dtype("uint16")
+        num = 3
+
+        def gen_data():
+            for i in range(num):
+                a = model.DataArray(numpy.zeros(size[-1:-3:-1], dtype))
+                a[white[-1:-3:-1]] = 124 + i
+                a.metadata[model.MD_POS] = (1e-3 * i, 0)
+                yield a
+
+        # export
+        n = hdf5.export_iter(FILENAME, gen_data())
+        self.assertEqual(n, num)
+
+        # check it's here, with each image as a separate acquisition
+        rdata = hdf5.read_data(FILENAME)
+        self.assertEqual(len(rdata), num)
+        for i, im in enumerate(rdata):
+            self.assertEqual(im.shape[-2:], size[::-1])
+            self.assertEqual(im[..., white[-1], white[-2]].max(), 124 + i)
+
+        os.remove(FILENAME)
+
+    def testFrameStore(self):
+        """Store frames one at a time and read them back"""
+        shape = (1, 128)
+        dtype = numpy.dtype("uint16")
+        num = 10
+
+        store = hdf5.FrameStore(FILENAME)
+        seq = store.create_sequence("CCD", num)
+        self.assertEqual(len(seq), 0)
+        for i in range(num):
+            a = model.DataArray(numpy.zeros(shape, dtype) + i)
+            a.metadata[model.MD_POS] = (1e-3 * i, 0)
+            seq.append(a)
+
+        self.assertEqual(len(seq), num)
+        with self.assertRaises(IndexError):
+            seq.append(a)
+
+        # Single frame => DataArray with metadata
+        im = seq[-1]
+        self.assertEqual(im.shape, shape)
+        self.assertEqual(im.metadata[model.MD_POS], (1e-3 * (num - 1), 0))
+        numpy.testing.assert_array_equal(im, num - 1)
+
+        # Slice => all the frames in one array
+        frames = seq[2:5]
+        self.assertEqual(frames.shape, (3,) + shape)
+        numpy.testing.assert_array_equal(frames[:, 0, 0], [2, 3, 4])
+        self.assertEqual(len(list(seq)), num)
+
+        store.close(delete=True)
+        self.assertFalse(os.path.exists(FILENAME))
+
+    def testFrameStoreReopen(self):
+        """Reopen a file to read the frames and continue storing new ones"""
+        shape = (3, 5)
+        num = 10
+
+        store = hdf5.FrameStore(FILENAME)
+        seq = store.create_sequence("CCD", num)
+        for i in range(6):
+            a = model.DataArray(numpy.zeros(shape, numpy.uint16) + i)
+            a.metadata[model.MD_POS] = (1e-3 * i, 0)
+            a.metadata[model.MD_WL_LIST] = numpy.linspace(500e-9, 600e-9, 4)
+            seq.append(a)
+        store.state = {"pixels": 4, "drift": (0.5, -2)}
+        store.close()
+
+        store = hdf5.FrameStore(FILENAME, mode="a")
+        # Stored as JSON, but the tuples must stay tuples
+        self.assertEqual(store.state, {"pixels": 4, "drift": (0.5, -2)})
+        self.assertIsInstance(store.state["drift"], tuple)
+        with self.assertRaises(KeyError):
+            store.open_sequence("SEM")
+        seq = store.open_sequence("CCD")
+        self.assertEqual(len(seq), 6)
+        im = seq[5]
+        self.assertEqual(im.metadata[model.MD_POS], (5e-3, 0))
+        numpy.testing.assert_array_equal(im.metadata[model.MD_WL_LIST],
+                                         numpy.linspace(500e-9, 600e-9, 4))
+        numpy.testing.assert_array_equal(im, 5)
+
+        # Drop the last frames and overwrite them
+        seq.truncate(4)
+        self.assertEqual(len(seq), 4)
+        for i in range(4, num):
+            a = model.DataArray(numpy.zeros(shape, numpy.uint16) + i * 10)
+            a.metadata[model.MD_POS] = (1e-3 * i, 1)
+            seq.append(a)
+        store.close()
+
+        store = hdf5.FrameStore(FILENAME, mode="a")
+        seq = store.open_sequence("CCD")
+        self.assertEqual(len(seq), num)
+        numpy.testing.assert_array_equal(seq[3], 3)
+        numpy.testing.assert_array_equal(seq[4], 40)
+        self.assertEqual(seq[-1].metadata[model.MD_POS], (1e-3 * (num - 1), 1))
+        store.close(delete=True)
+
 #    @skip("Doesn't work")
     def testExportThumbnail(self):
         # create 2 simple greyscale images
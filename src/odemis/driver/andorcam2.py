@@ -553,6 +553,8 @@ class AndorCam2(model.DigitalCamera):
         self._got_event = threading.Event()
         self._late_events = collections.deque() # events which haven't been handled yet
         self._ready_for_acq_start = False
+        # to be held when checking/changing _ready_for_acq_start and _late_events
+        self._sync_lock = threading.Lock()
 
         self.data = AndorCam2DataFlow(self)
         # Convenience event for the user to connect and fire
@@ -1716,6 +1718,13 @@ class AndorCam2(model.DigitalCamera):
                     self.acquire_must_stop.clear()
                     raise
             self.atcore.FreeInternalMemory() # TODO not sure it's needed
+            # Events not handled are for this acquisition, don't let them
+            # start the next one
+            with self._sync_lock:
+                if self._late_events:
+                    logging.warning("Dropping %d synchronization events not handled",
+                                    len(self._late_events))
+                    self._late_events.clear()
             self.acquisition_lock.release()
             gc.collect()
             logging.debug("Acquisition thread closed")
@@ -1728,14 +1737,16 @@ class AndorCam2(model.DigitalCamera):
          is synchronized, wait for the Event to be triggered.
         raises CancelledError if the acquisition must stop
         """
-        # catch up late events if we missed the start
-        if self._late_events:
-            event_time = self._late_events.popleft()
-            logging.warning("starting acquisition late by %g s", time.time() - event_time)
-            self.atcore.StartAcquisition()
-            return
+        with self._sync_lock:
+            # catch up late events if we missed the start
+            if self._late_events:
+                event_time = self._late_events.popleft()
+                logging.warning("starting acquisition late by %g s", time.time() - event_time)
+                self.atcore.StartAcquisition()
+                return
 
-        self._ready_for_acq_start = True
+            # From now on, onEvent() will directly start the acquisition
+            self._ready_for_acq_start = True
         try:
             # wait until onEvent was called (it will directly start acquisition)
             # or must stop
@@ -1751,7 +1762,8 @@ class AndorCam2(model.DigitalCamera):
                     self._got_event.clear()
                     return
         finally:
-            self._ready_for_acq_start = False
+            with self._sync_lock:
+                self._ready_for_acq_start = False
 
         raise CancelledError()
 
@@ -1760,12 +1772,13 @@ class AndorCam2(model.DigitalCamera):
         """
         Called by the Event when it is triggered
         """
-        if not self._ready_for_acq_start:
-            if self.acquire_thread and self.acquire_thread.isAlive():
-                logging.warning("Received synchronization event but acquisition not ready")
-                # queue the events, it's bad but less bad than skipping it
-                self._late_events.append(time.time())
-            return
+        with self._sync_lock:
+            if not self._ready_for_acq_start:
+                if self.acquire_thread and self.acquire_thread.isAlive():
+                    logging.warning("Received synchronization event but acquisition not ready")
+                    # queue the events, it's bad but less bad than skipping it
+                    self._late_events.append(time.time())
+                return
 
         logging.debug("starting sync acquisition")
         self.atcore.StartAcquisition()
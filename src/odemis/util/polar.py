@@ -16,13 +16,17 @@ You should have received a copy of the GNU General Public License along with Ode
 '''
 from __future__ import division
 
+import collections
+from concurrent import futures
+import logging
 import math
-from matplotlib import tri
-from matplotlib.delaunay.triangulate import DuplicatePointWarning
+import multiprocessing
 from numpy import ma
 import numpy
 from odemis import model
-import warnings
+from odemis.util import img
+from scipy import sparse, spatial
+import threading
 
 
 # Functions to convert/manipulate Angle resolved image to polar projection
@@ -40,6 +44,16 @@ AR_FOCUS_DISTANCE = 0.5e-3  # m, the vertical mirror cutoff, iow the min distanc
 AR_PARABOLA_F = 2.5e-3  # m, parabola_parameter=1/4f
 
 
+# Number of projection geometries (and mirror masks) kept in cache. Each of
+# them can take up to ~100 MB in memory for the largest images.
+GEOMETRY_CACHE_SIZE = 4
+# (shape, pixel size, pole, hole, output size, dtype) -> Future of sparse.csr_matrix
+_geometry_cache = collections.OrderedDict()
+# (shape, pixel size, pole, hole) -> Future of boolean ndarray
+_mask_cache = collections.OrderedDict()
+_cache_lock = threading.Lock() # only held while accessing the caches
+
+
 def AngleResolved2Polar(data, output_size, hole=True, dtype=None):
     """
     Converts an angle resolved image to polar representation
@@ -49,6 +63,8 @@ def AngleResolved2Polar(data, output_size, hole=True, dtype=None):
       metadata. Pixel size is the sensor pixel size * binning / magnification.
     output_size (int): The size of the output DataArray (assumed to be square)
     hole (boolean): Crop the pole if True
+    dtype (None or numpy.dtype): precision of the projection. Use float16 (or
+      float32) to reduce the memory usage on very large images.
     returns (model.DataArray): converted image in polar view
     """
     assert(len(data.shape) == 2)  # => 2D with greyscale
@@ -60,55 +76,233 @@ def AngleResolved2Polar(data, output_size, hole=True, dtype=None):
     except KeyError:
         raise ValueError("Metadata required: MD_PIXEL_SIZE, MD_AR_POLE.")
 
-    if dtype is None:
-        dtype = numpy.float64
+    # As all the images of an acquisition share the same geometry, all the
+    # heavy computation is done only once, and the projection itself is
+    # just a (sparse) matrix product.
+    weights = _GetPolarGeometry(data.shape, pixel_size, (mirror_x, mirror_y),
+                                hole, output_size, dtype)
+    qz = weights.dot(numpy.ravel(data))
+    qz.shape = (output_size, output_size)
+    result = model.DataArray(qz, data.metadata)
+
+    return result
+
+
+def _GetPolarGeometry(shape, pixel_size, pole_pos, hole, output_size, dtype=None):
+    """
+    Return the linear operator converting an angle resolved image to polar
+    representation. It is cached, so the first call for a given set of
+    parameters is slow, but the next ones are immediate.
+    shape (2 ints): shape of the input image (Y, X)
+    pixel_size (2 floats): effective pixel size (X/Y)
+    pole_pos (2 floats): x/y coordinates of the pole (MD_AR_POLE)
+    hole (boolean): Crop the pole if True
+    output_size (int): The size of the output image (assumed to be square)
+    dtype (None or numpy.dtype): precision of the projection
+    returns (sparse.csr_matrix of shape (output_size², Y * X)): the weight of
+      each input pixel for each output pixel
+    """
+    if dtype is None or numpy.dtype(dtype).itemsize < 4:
+        # sparse matrices do not support float16
+        dtype = numpy.float64 if dtype is None else numpy.float32
+    key = (tuple(shape), tuple(pixel_size), tuple(pole_pos), hole, output_size,
+           numpy.dtype(dtype))
+    return _GetCached(_geometry_cache, key, _ComputePolarGeometry,
+                      shape, pixel_size, pole_pos, hole, output_size, dtype)
+
+
+def _GetMirrorMask(shape, pixel_size, pole_pos, hole=True):
+    """
+    Cached version of _CreateMirrorMask(). See it for the parameters.
+    shape (2 ints): shape of the image (Y, X)
+    returns (boolean ndarray): Mask. It must not be modified.
+    """
+    key = (tuple(shape), tuple(pixel_size), tuple(pole_pos), hole)
+    return _GetCached(_mask_cache, key, _CreateMirrorMask,
+                      numpy.empty(shape, dtype=numpy.bool), pixel_size, pole_pos, hole)
+
+
+def _GetCached(cache, key, compute, *args):
+    """
+    Look for a value in a cache, and compute it if it's not there.
+    cache (OrderedDict): the cache, with the least recently used first
+    key (hashable): the key of the value in the cache
+    compute (callable): function to compute the value
+    args: arguments passed to compute
+    returns (object): the value
+    """
+    # The cache contains the future of each value, so that the value is only
+    # computed once, even if several threads need it at the same time, while
+    # the values of the other keys are still available (or computed) meanwhile.
+    with _cache_lock:
+        try:
+            f = cache.pop(key)
+            must_compute = False
+        except KeyError:
+            f = futures.Future()
+            must_compute = True
+            if len(cache) >= GEOMETRY_CACHE_SIZE:
+                cache.popitem(last=False)
+        cache[key] = f # most recently used
+
+    if must_compute:
+        logging.debug("Computing %s for %s", compute.__name__, key)
+        try:
+            f.set_result(compute(*args))
+        except BaseException as ex:
+            # Don't keep the failure: the next call will try again
+            with _cache_lock:
+                if cache.get(key) is f:
+                    del cache[key]
+            f.set_exception(ex)
+            raise
 
-    # Crop the input image to half circle
-    cropped_image = _CropHalfCircle(data, pixel_size, (mirror_x, mirror_y), hole)
+    return f.result()
 
-    theta_data = numpy.empty(shape=cropped_image.shape, dtype=dtype)
-    phi_data = numpy.empty(shape=cropped_image.shape, dtype=dtype)
-    omega_data = numpy.empty(shape=cropped_image.shape)
 
-    # For each pixel of the input ndarray, input metadata is used to
-    # calculate the corresponding theta, phi and radiant intensity
-    image_x, image_y = cropped_image.shape
-    jj = numpy.linspace(0, image_y - 1, image_y)
-    xpix = mirror_x - jj
+def _ComputePolarGeometry(shape, pixel_size, pole_pos, hole, output_size, dtype):
+    """
+    Computes the linear operator converting an angle resolved image to polar
+    representation. See _GetPolarGeometry() for the parameters.
+    """
+    mirror_x, mirror_y = pole_pos
 
-    for i in xrange(image_x):
-        ypix = (i - mirror_y) + (2 * AR_PARABOLA_F) / pixel_size[1]
-        theta, phi, omega = _FindAngle(xpix, ypix, pixel_size)
+    # For each pixel of the input image, find the corresponding theta, phi and
+    # solid angle
+    image_x, image_y = shape
+    xpix = mirror_x - numpy.arange(image_y)
+    ypix = (numpy.arange(image_x) - mirror_y) + (2 * AR_PARABOLA_F) / pixel_size[1]
+    theta, phi, omega = _FindAngle(xpix[numpy.newaxis, :], ypix[:, numpy.newaxis],
+                                   pixel_size)
 
-        theta_data[i, :] = theta
-        phi_data[i, :] = phi
-        omega_data[i, :] = cropped_image[i] / omega
+    # Only keep the pixels within the mirror (the others are 0), and convert
+    # intensity to radiant intensity
+    circle_mask = _GetMirrorMask(shape, pixel_size, pole_pos, hole)
+    scale = numpy.where(circle_mask, 1 / omega, 0).ravel()
 
     # Convert into polar coordinates
     h_output_size = output_size / 2
-    theta = theta_data * (h_output_size / math.pi * 2)
-    phi = phi_data
-    theta_data = numpy.cos(phi) * theta
-    phi_data = numpy.sin(phi) * theta
-
-    # Interpolation into 2d array
-#    xi = numpy.linspace(-h_output_size, h_output_size, 2 * h_output_size + 1)
-#    yi = numpy.linspace(-h_output_size, h_output_size, 2 * h_output_size + 1)
-#    qz = mlab.griddata(phi_data.flat, theta_data.flat, omega_data.flat, xi, yi, interp="linear")
-
-    # FIXME: need rotation (=swap axes), but swapping theta/phi slows down the
-    # interpolation by 3 ?!
-    with warnings.catch_warnings():
-        # Some points might be so close that they are identical (within float
-        # precision). It's fine, no need to generate a warning.
-        warnings.simplefilter("ignore", DuplicatePointWarning)
-        triang = tri.delaunay.Triangulation(theta_data.flat, phi_data.flat)
-    interp = triang.linear_interpolator(omega_data.flat, default_value=0)
-    qz = interp[-h_output_size:h_output_size:complex(0, output_size), # Y
-                - h_output_size:h_output_size:complex(0, output_size)] # X
-    qz = qz.swapaxes(0, 1)[:, ::-1] # rotate by 90°
-    result = model.DataArray(qz, data.metadata)
+    theta *= (h_output_size / math.pi * 2)
+    npts = theta.size
+    points = numpy.empty((npts, 2))
+    points[:, 0] = (numpy.cos(phi) * theta).ravel()
+    points[:, 1] = (numpy.sin(phi) * theta).ravel()
+    del theta, phi, omega
+
+    # Find the barycentric coordinates of each output pixel in the Delaunay
+    # triangulation of the input pixels. Note: some points might be so close
+    # that they are identical (within float precision), they are just
+    # ignored by the triangulation.
+    triang = spatial.Delaunay(points)
+    # Output pixels, rotated by 90°: row r, column c is at (Y = N-1-c, X = r)
+    # on the grid
+    grid = numpy.linspace(-h_output_size, h_output_size, output_size)
+    opoints = numpy.empty((output_size, output_size, 2))
+    opoints[:, :, 0] = grid[:, numpy.newaxis] # X
+    opoints[:, :, 1] = grid[numpy.newaxis, ::-1] # Y
+    opoints.shape = (-1, 2)
+
+    simplex = triang.find_simplex(opoints)
+    inside = numpy.flatnonzero(simplex >= 0) # outside the hull => 0
+    simplex = simplex[inside]
+    trans = triang.transform[simplex]
+    bary = numpy.empty((len(inside), 3))
+    bary[:, :2] = numpy.einsum("ijk,ik->ij", trans[:, :2],
+                               opoints[inside] - trans[:, 2])
+    bary[:, 2] = 1 - bary[:, 0] - bary[:, 1]
+    vertices = triang.vertices[simplex]
+
+    # Fold the scaling of the input pixels into the weights
+    weights = sparse.csr_matrix(((bary * scale[vertices]).ravel(),
+                                 (numpy.repeat(inside, 3), vertices.ravel())),
+                                shape=(output_size * output_size, npts),
+                                dtype=dtype)
+    return weights
+
+
+def AngleResolved2PolarBatch(data, output_size, hole=True, background=None,
+                             dtype=None, nprocs=None):
+    """
+    Converts a set of angle resolved images to polar representation, with the
+    background removed. The images are processed in parallel, by several
+    processes.
+    data (iterable of model.DataArray): The images, as accepted by
+      AngleResolved2Polar(). The conversion is much faster if they all have
+      the same shape and metadata (except for the position).
+    output_size (int): The size of the output DataArray (assumed to be square)
+    hole (boolean): Crop the pole if True
+    background (None or model.DataArray): background image (same shape as each
+      image) to subtract from the data. If None, the baseline is subtracted
+      (see ARBackgroundSubtract()).
+    dtype (None or numpy.dtype): see AngleResolved2Polar()
+    nprocs (None or 0<int): number of processes to use. None means as many as
+      CPUs available.
+    yields (model.DataArray): the converted images, in the same order as the
+      data. They have no MD_AR_POLE and MD_PIXEL_SIZE metadata. Only a few
+      images are sent to the processes in advance of the one being read, so
+      that the converted images don't pile up if the caller is slower. Note
+      that this doesn't limit the memory used by the input data.
+    """
+    if nprocs is None:
+        nprocs = multiprocessing.cpu_count()
+
+    it = iter(data)
+    try:
+        first = next(it)
+    except StopIteration:
+        return
+
+    # Convert the first image directly, so that the geometry (in cache) is
+    # inherited by all the worker processes.
+    yield _ProjectARImage(first, output_size, hole, background, dtype)
+
+    pool = multiprocessing.Pool(nprocs, _InitBatchWorker,
+                                (output_size, hole, background, dtype))
+    try:
+        queue = collections.deque()
+        for d in it:
+            queue.append(pool.apply_async(_ProjectARImageWorker, (d,)))
+            if len(queue) >= 2 * nprocs:
+                yield queue.popleft().get()
+        while queue:
+            yield queue.popleft().get()
+        pool.close()
+    finally:
+        # In case of error (or the caller stopped early), don't wait
+        pool.terminate()
+        pool.join()
+
+
+# Arguments shared by all the calls in the worker processes of
+# AngleResolved2PolarBatch(). They are only passed once, at initialisation.
+_batch_args = None
+
 
+def _InitBatchWorker(*args):
+    global _batch_args
+    _batch_args = args
+
+
+def _ProjectARImageWorker(data):
+    return _ProjectARImage(data, *_batch_args)
+
+
+def _ProjectARImage(data, output_size, hole, background, dtype):
+    """
+    Remove the background and convert one angle resolved image to polar
+    returns (model.DataArray): the polar projection. Its metadata doesn't
+      contain MD_AR_POLE and MD_PIXEL_SIZE anymore, as they only apply to the
+      raw image (and would cause the projection to be taken for a raw AR image).
+    """
+    if background is None:
+        data = ARBackgroundSubtract(data)
+    else:
+        data = img.Subtract(data, background)
+    result = AngleResolved2Polar(data, output_size, hole=hole, dtype=dtype)
+    md = result.metadata.copy()
+    for k in (model.MD_AR_POLE, model.MD_PIXEL_SIZE):
+        md.pop(k, None)
+    result.metadata = md
     return result
 
 
@@ -166,7 +360,7 @@ def ARBackgroundSubtract(data):
             pole_pos = data.metadata[model.MD_AR_POLE]
         except KeyError:
             raise ValueError("Metadata required: MD_PIXEL_SIZE, MD_AR_POLE.")
-        circle_mask = _CreateMirrorMask(data, pxs, pole_pos, hole=False)
+        circle_mask = _GetMirrorMask(data.shape, pxs, pole_pos, hole=False)
         masked_image = ma.array(data, mask=circle_mask)
 
         # Calculate the average value of the outside pixels
@@ -182,21 +376,6 @@ def ARBackgroundSubtract(data):
     result = model.DataArray(ret_data, data.metadata)
     return result
 
-def _CropHalfCircle(data, pixel_size, pole_pos, hole=True):
-    """
-    Crops the image to half circle shape based on AR_FOCUS_DISTANCE, AR_XMAX,
-      AR_PARABOLA_F, and AR_HOLE_DIAMETER
-    data (model.DataArray): The DataArray with the image
-    pixel_size (float, float): effective pixel sie = sensor_pixel_size * binning / magnification
-    pole_pos (float, float): x/y coordinates of the pole (MD_AR_POLE)
-    hole (boolean): Crop the area around the pole if True
-    returns (model.DataArray): Cropped image
-    """
-    # Create mirror mask and apply to the image
-    circle_mask = _CreateMirrorMask(data, pixel_size, pole_pos, hole)
-    image = numpy.where(circle_mask, data, 0)
-    return image
-
 def _CreateMirrorMask(data, pixel_size, pole_pos, hole=True):
     """
     Creates half circle mask (i.e. True inside half circle, False outside it) based
@@ -221,7 +400,7 @@ def _CreateMirrorMask(data, pixel_size, pole_pos, hole=True):
     circle_mask = x * x + y * y <= r * r
 
     # Create half circle mask
-    circle_mask[:lower_y, :] = False
+    circle_mask[:int(lower_y), :] = False
 
     # Crop the pole making hole of AR_HOLE_DIAMETER
     if hole:
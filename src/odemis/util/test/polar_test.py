@@ -16,10 +16,13 @@ You should have received a copy of the GNU General Public License along with Ode
 '''
 from __future__ import division
 
+import collections
 import numpy
 from odemis import model
 from odemis.dataio import hdf5
 from odemis.util import polar
+import threading
+import time
 import unittest
 
 
@@ -293,6 +296,111 @@ class TestPolarConversion(unittest.TestCase):
 
         numpy.testing.assert_allclose(result, desired_output[0], rtol=1e-04)
 
+    def test_same_geometry(self):
+        """
+        Tests the conversion of several images with the same metadata
+        """
+        data = self.data
+        C, T, Z, Y, X = data[0].shape
+        data[0].shape = Y, X
+        data[0] = data[0].astype(numpy.float)
+
+        tstart = time.time()
+        result = polar.AngleResolved2Polar(data[0], 201)
+        dur_first = time.time() - tstart
+
+        # The geometry is reused, so it should be much faster
+        data2 = model.DataArray(data[0] * 2, data[0].metadata)
+        tstart = time.time()
+        result2 = polar.AngleResolved2Polar(data2, 201)
+        dur_second = time.time() - tstart
+        self.assertLess(dur_second, dur_first)
+
+        numpy.testing.assert_allclose(result2, result * 2, rtol=1e-04)
+
+        desired_output = hdf5.read_data("desired201x201image.h5")
+        C, T, Z, Y, X = desired_output[0].shape
+        desired_output[0].shape = Y, X
+        numpy.testing.assert_allclose(result, desired_output[0], rtol=1e-04)
+
+    def test_batch(self):
+        """
+        Tests the parallel conversion of several images gives the same result
+        as one by one
+        """
+        data = self.data
+        C, T, Z, Y, X = data[0].shape
+        data[0].shape = Y, X
+        images = [model.DataArray(data[0] * (i + 1), data[0].metadata)
+                  for i in range(6)]
+
+        results = list(polar.AngleResolved2PolarBatch(images, 201, nprocs=2))
+        self.assertEqual(len(results), len(images))
+        for im, res in zip(images, results):
+            clean_data = polar.ARBackgroundSubtract(im)
+            expected = polar.AngleResolved2Polar(clean_data, 201)
+            numpy.testing.assert_allclose(res, expected, rtol=1e-04)
+            # The projection must not be taken for a raw AR image
+            self.assertNotIn(model.MD_AR_POLE, res.metadata)
+            self.assertNotIn(model.MD_PIXEL_SIZE, res.metadata)
+            md = im.metadata.copy()
+            del md[model.MD_AR_POLE], md[model.MD_PIXEL_SIZE]
+            self.assertEqual(res.metadata, md)
+
+
+class TestGetCached(unittest.TestCase):
+    """
+    Test the cache of the projection geometries
+    """
+    def test_concurrent(self):
+        """
+        A value needed by several threads is only computed once, without
+        blocking the other values of the cache
+        """
+        cache = collections.OrderedDict()
+        calls = []
+        release = threading.Event()
+        def compute(v):
+            calls.append(v)
+            if v == "slow":
+                release.wait(10)
+            return v * 2
+
+        results = []
+        def get_slow():
+            results.append(polar._GetCached(cache, "s", compute, "slow"))
+
+        threads = [threading.Thread(target=get_slow) for i in range(2)]
+        for t in threads:
+            t.start()
+        time.sleep(0.1)
+
+        # Another key is available while the slow one is being computed
+        self.assertEqual(polar._GetCached(cache, "f", compute, "fast"), "fastfast")
+        release.set()
+        for t in threads:
+            t.join(10)
+
+        self.assertEqual(results, ["slowslow", "slowslow"])
+        self.assertEqual(calls, ["slow", "fast"])
+        # Now it's in the cache
+        self.assertEqual(polar._GetCached(cache, "s", compute, "slow"), "slowslow")
+        self.assertEqual(calls, ["slow", "fast"])
+
+    def test_error(self):
+        """
+        A failed computation is not cached
+        """
+        cache = collections.OrderedDict()
+        def compute(v):
+            if v is None:
+                raise ValueError("No value")
+            return v
+
+        with self.assertRaises(ValueError):
+            polar._GetCached(cache, "k", compute, None)
+        self.assertEqual(polar._GetCached(cache, "k", compute, 1), 1)
+
 
 if __name__ == "__main__":
 #     import sys;sys.argv = ['', 'TestPolarConversionOutput.test_2000x2000']
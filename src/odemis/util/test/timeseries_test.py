@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 19 Oct 2026
+
+@author: agent
+
+Copyright © 2026 agent
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License version 2 as published by the Free Software Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with Odemis. If not, see http://www.gnu.org/licenses/.
+'''
+# Test cases for the time series buffer
+
+from __future__ import division
+
+import h5py
+import logging
+import numpy
+from odemis.util import timeseries
+import os
+import unittest
+
+
+logging.getLogger().setLevel(logging.DEBUG)
+
+FILENAME = "test-spill.h5"
+
+
+class TestTimeSeriesBuffer(unittest.TestCase):
+
+    def tearDown(self):
+        try:
+            os.remove(FILENAME)
+        except OSError:
+            pass
+
+    def test_append(self):
+        buf = timeseries.TimeSeriesBuffer(10)
+        self.assertEqual(len(buf), 0)
+        values, dates = buf.get_last()
+        self.assertEqual(len(values), 0)
+
+        for i in range(5):
+            buf.append(i * 2, i)
+        self.assertEqual(len(buf), 5)
+        values, dates = buf.get_last()
+        numpy.testing.assert_array_equal(values, [0, 2, 4, 6, 8])
+        numpy.testing.assert_array_equal(dates, range(5))
+
+        # Go beyond the capacity => only the latest values are kept
+        for i in range(5, 23):
+            buf.append(i * 2, i)
+        self.assertEqual(len(buf), 10)
+        self.assertEqual(buf.count, 23)
+        values, dates = buf.get_last()
+        numpy.testing.assert_array_equal(dates, range(13, 23))
+        numpy.testing.assert_array_equal(values, numpy.arange(13, 23) * 2)
+
+        values, dates = buf.get_last(3)
+        numpy.testing.assert_array_equal(dates, [20, 21, 22])
+
+        # views should not be writeable
+        with self.assertRaises(ValueError):
+            values[0] = 1
+
+    def test_window(self):
+        buf = timeseries.TimeSeriesBuffer(100)
+        for i in range(250):
+            buf.append(i, i * 0.1)
+
+        values, dates = buf.get_window(2)
+        numpy.testing.assert_allclose(dates[0], 22.9)
+        numpy.testing.assert_allclose(dates[-1], 24.9)
+        self.assertEqual(len(values), 21)
+
+        # Longer than the buffer => everything in the buffer
+        values, dates = buf.get_window(1e6)
+        self.assertEqual(len(values), 100)
+
+        # Just the last value
+        values, dates = buf.get_window(0)
+        numpy.testing.assert_array_equal(values, [249])
+
+        buf.clear()
+        values, dates = buf.get_window(2)
+        self.assertEqual(len(values), 0)
+
+    def test_spill(self):
+        buf = timeseries.TimeSeriesBuffer(16, spill_file=FILENAME, spill_block=4)
+        n = 103
+        for i in range(n):
+            buf.append(i, i)
+        values, dates = buf.get_last()
+        numpy.testing.assert_array_equal(values, range(n - 16, n))
+        buf.close()
+
+        # Everything should be in the file
+        f = h5py.File(FILENAME, "r")
+        numpy.testing.assert_array_equal(f["value"][...], range(n))
+        numpy.testing.assert_array_equal(f["date"][...], range(n))
+        f.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
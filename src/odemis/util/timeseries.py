@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+"""
+Created on 19 Oct 2026
+
+@author: agent
+
+Copyright © 2026 agent
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License version 2 as published by the Free
+Software Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Odemis. If not, see http://www.gnu.org/licenses/.
+
+"""
+
+# Storage of values acquired over time (eg, the count of a detector), with a
+# bounded memory usage.
+
+from __future__ import division
+
+import h5py
+import logging
+import numpy
+import threading
+
+
+class TimeSeriesBuffer(object):
+    """
+    Fixed-capacity ring buffer of values with their timestamp.
+    Appending a value is O(1) and never reallocates memory. The latest values
+    are always available as a contiguous (read-only) view, without copy.
+    To do so, each value is written twice, at position i and i + capacity of
+    an array twice as large as the capacity.
+    Optionally, the values which are dropped from the buffer can be saved
+    (by blocks) into an HDF5 file, to keep the complete history of long runs.
+    """
+
+    def __init__(self, capacity, dtype=numpy.float64, spill_file=None,
+                 spill_block=None):
+        """
+        capacity (0<int): maximum number of values kept in memory
+        dtype (numpy.dtype): type of the values
+        spill_file (None or str): if a filename is given, the values which are
+          older than the capacity are written into this HDF5 file, in the
+          datasets "value" and "date". The file is overwritten.
+        spill_block (None or 0<int<=capacity): number of values written
+          at once to the spill file. If None, a quarter of the capacity is used.
+        """
+        if capacity <= 0:
+            raise ValueError("Capacity must be positive, got %s" % (capacity,))
+        self.capacity = int(capacity)
+        self._values = numpy.zeros(2 * self.capacity, dtype=dtype)
+        self._dates = numpy.zeros(2 * self.capacity, dtype=numpy.float64)
+        self._count = 0  # total number of values appended since the beginning
+        self._lock = threading.Lock()
+
+        self._spill_file = None
+        self._nspilled = 0  # number of values (since last clear) saved in the file
+        if spill_file is not None:
+            if spill_block is None:
+                spill_block = max(1, self.capacity // 4)
+            if not 0 < spill_block <= self.capacity:
+                raise ValueError("spill_block must be between 1 and %d, got %s" %
+                                 (self.capacity, spill_block))
+            self._spill_block = int(spill_block)
+            self._spill_file = h5py.File(spill_file, "w")
+            for name, dt in (("value", dtype), ("date", numpy.float64)):
+                self._spill_file.create_dataset(name, shape=(0,), dtype=dt,
+                                                maxshape=(None,),
+                                                chunks=(self._spill_block,))
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    @property
+    def count(self):
+        """
+        (int): total number of values appended since the buffer creation
+          (or last clear)
+        """
+        return self._count
+
+    def append(self, value, date):
+        """
+        Add a new value at the end of the buffer. If the buffer is full, the
+        oldest value is dropped (after being written to the spill file, if any).
+        value (number): the new value
+        date (float): the time of the value (in s). It should be greater or
+          equal to the dates of the values already in the buffer.
+        """
+        with self._lock:
+            if (self._spill_file is not None and
+                self._count - self._nspilled >= self.capacity):
+                self._write_spill(self._spill_block)
+
+            i = self._count % self.capacity
+            self._values[i] = value
+            self._values[i + self.capacity] = value
+            self._dates[i] = date
+            self._dates[i + self.capacity] = date
+            self._count += 1
+
+    def get_last(self, n=None):
+        """
+        Return the latest values, oldest first.
+        n (None or 0<=int): maximum number of values to return. If None, all the
+          values in the buffer are returned.
+        return (tuple of 2 numpy.ndarray): the values and their dates. They are
+          read-only views on the buffer, so they will be modified by further
+          calls to append() once the buffer wraps around. Copy them if they are
+          to be kept.
+        """
+        with self._lock:
+            l = len(self)
+            if n is not None:
+                l = min(l, n)
+            end = self._count % self.capacity
+            if self._count >= self.capacity:
+                end += self.capacity
+            values = self._values[end - l:end]
+            dates = self._dates[end - l:end]
+
+        values.flags.writeable = False
+        dates.flags.writeable = False
+        return values, dates
+
+    def get_window(self, period, end=None):
+        """
+        Return the values acquired during the given period of time, up to the
+        last value.
+        period (0<=float): duration of the window (in s)
+        end (None or float): date of the end of the window. If None, the date
+          of the latest value is used.
+        return (tuple of 2 numpy.ndarray): the values and their dates, as
+          read-only views (see get_last()).
+        """
+        values, dates = self.get_last()
+        if not len(dates):
+            return values, dates
+        if end is None:
+            end = dates[-1]
+        # The dates are in increasing order, so just need a binary search
+        first = numpy.searchsorted(dates, end - period, side="left")
+        return values[first:], dates[first:]
+
+    def clear(self):
+        """
+        Remove all the values from the buffer. The spill file is kept, and the
+        values which were not yet saved are written to it.
+        """
+        with self._lock:
+            self._flush_spill()
+            self._count = 0
+            self._nspilled = 0
+
+    def _flush_spill(self):
+        """
+        Write all the values not yet saved to the spill file.
+        Must be called with the lock taken.
+        """
+        if self._spill_file is None:
+            return
+        n = self._count - self._nspilled
+        if n > 0:
+            self._write_spill(n)
+
+    def _write_spill(self, n):
+        """
+        Write the n oldest values not yet saved to the end of the spill file.
+        Must be called with the lock taken.
+        n (0<int<=capacity): number of values to write
+        """
+        start = self._nspilled % self.capacity
+        for name, a in (("value", self._values), ("date", self._dates)):
+            ds = self._spill_file[name]
+            sz = ds.shape[0]
+            ds.resize((sz + n,))
+            ds[sz:] = a[start:start + n]
+        self._nspilled += n
+        self._spill_file.flush()
+
+    def close(self):
+        """
+        Write the values still in memory to the spill file (if any), and close it.
+        The buffer can still be used afterwards, but nothing more is saved.
+        """
+        with self._lock:
+            if self._spill_file is None:
+                return
+            try:
+                self._flush_spill()
+                self._spill_file.close()
+            except Exception:
+                logging.exception("Failed to close spill file")
+            self._spill_file = None